@@ -1,13 +1,27 @@
 from __future__ import annotations
-import os, io, re, base64, sqlite3, uuid, csv
-from datetime import datetime
+import os, io, re, math, base64, binascii, socket, sqlite3, uuid, csv, hashlib, hmac, struct, threading, tempfile, time, json, zlib, zipfile, gc, functools
+from collections import OrderedDict, deque
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING
 
-from flask import Flask, request, redirect, url_for, send_file, abort, render_template, flash, session, make_response
-from PIL import Image, ImageDraw, ImageFont
-import qrcode
-import qrcode.constants
+from flask import Flask, request, redirect, url_for, send_file, abort, render_template, flash, session, make_response, jsonify, g, has_app_context, Response
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.exceptions import RequestEntityTooLarge
+import click
+
+from pdfsheet import PdfSheetWriter, LAYOUTS
+from xlsxstream import iter_xlsx
+from zipstream import ZipSink, iter_zip
+from metrics import Registry, SamplingProfiler
+from cardcode import CardSigner, CardVerifier, PREFIX as CARD_CODE_PREFIX, ALG_ED25519, HAS_ED25519, SIGNER_ALGS
+
+if TYPE_CHECKING:
+    # Pillow and qrcode are imported by the functions that draw: a process
+    # that only serves forms and lists never loads them
+    import qrcode
+    from PIL import Image, ImageDraw
 
 APP_NAME = "Adeseun Ogundoyin Polytechnic Eruwa – Computerized Identity Card Using QR Code"
 SCHOOL_NAME = "ADESEUN OGUNDOYIN POLYTECHNIC ERUWA"
@@ -19,6 +33,8 @@ UPLOAD_DIR = "uploads"
 SIGN_DIR = "signatures"
 RECEIPT_DIR = "receipts"
 ASSETS_DIR = "assets"
+CACHE_DIR = os.path.join("cache", "cards")
+JOB_DIR = os.path.join("cache", "jobs")
 
 # CR80 standard size 3.375" × 2.125" at 300 DPI
 CARD_SIZE = (1012, 638)
@@ -26,7 +42,7 @@ MARGIN = 26
 
 # ensure directories
 os.makedirs("data", exist_ok=True)
-for d in [UPLOAD_DIR, SIGN_DIR, RECEIPT_DIR, ASSETS_DIR]:
+for d in [UPLOAD_DIR, SIGN_DIR, RECEIPT_DIR, ASSETS_DIR, CACHE_DIR, JOB_DIR]:
     os.makedirs(d, exist_ok=True)
 
 app = Flask(__name__)
@@ -34,6 +50,52 @@ app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-key")
 
 # Limit upload size (MB) via env MAX_UPLOAD_MB (default 16MB)
 app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get("MAX_UPLOAD_MB", "16")) * 1024 * 1024
+# Non-file form fields (including data-URL snapshots from older pages) are held
+# in memory by the form parser; anything larger is rejected while parsing.
+app.config['MAX_FORM_MEMORY_SIZE'] = int(float(os.environ.get("MAX_FORM_FIELD_MB", "4")) * 1024 * 1024)
+
+# ---------------- Metrics ----------------
+# Request latency per endpoint and timing spans around the hot paths, served
+# at /metrics in Prometheus text format. PROFILE_SAMPLE_MS>0 also starts a
+# sampling profiler whose folded stacks are served at /metrics/profile (and
+# written to PROFILE_OUTPUT on exit).
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+METRICS_ALLOW_LOCAL = os.environ.get("METRICS_ALLOW_LOCAL", "0") == "1"
+PROFILE_SAMPLE_MS = float(os.environ.get("PROFILE_SAMPLE_MS", "0"))
+PROFILE_OUTPUT = os.environ.get("PROFILE_OUTPUT", "")
+
+metrics = Registry(enabled=METRICS_ENABLED, prefix="aop_")
+metrics.describe("http_request_duration_seconds", "histogram", "Time to produce a response, by Flask endpoint.")
+metrics.describe("http_requests_total", "counter", "Responses by Flask endpoint and status.")
+metrics.describe("stage_duration_seconds", "histogram", "Time spent in instrumented stages (card render, uploads, DB, passwords).")
+profiler = SamplingProfiler(PROFILE_SAMPLE_MS / 1000) if PROFILE_SAMPLE_MS > 0 else None
+
+def stage(name: str):
+    """with stage("card.qr"): ... records into aop_stage_duration_seconds."""
+    return metrics.span("stage_duration_seconds", (("stage", name),))
+
+def timed_stage(name: str):
+    return metrics.timed("stage_duration_seconds", (("stage", name),))
+
+@app.before_request
+def _start_request_timer():
+    g.request_t0 = time.perf_counter()
+    if profiler is not None and not profiler.running:
+        profiler.start()  # here rather than at import, so every forked worker samples itself
+    start_job_workers()  # likewise: threads started before a fork do not survive into the workers
+
+@app.after_request
+def _record_request_time(resp):
+    # streamed bodies (exports, batch PDFs) are timed up to the first byte
+    t0 = g.pop('request_t0', None)
+    if t0 is not None and METRICS_ENABLED:
+        endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+        labels = (("endpoint", endpoint), ("method", request.method))
+        metrics.observe("http_request_duration_seconds", labels, time.perf_counter() - t0)
+        metrics.inc("http_requests_total", labels + (("status", str(resp.status_code)),))
+    return resp
 
 @app.errorhandler(RequestEntityTooLarge)
 def handle_large(e):
@@ -58,28 +120,336 @@ CREATE TABLE IF NOT EXISTS users (
     receipt_path TEXT,
     is_approved INTEGER DEFAULT 0,
     id_print_count INTEGER DEFAULT 0,
-    created_at TEXT NOT NULL
+    created_at TEXT NOT NULL,
+    card_serial INTEGER
 );
 CREATE TABLE IF NOT EXISTS print_log (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
     printed_at TEXT NOT NULL,
+    operator_id INTEGER,  -- admin who printed it; NULL for student self-service and the CLI
     FOREIGN KEY(user_id) REFERENCES users(id)
 );
+CREATE INDEX IF NOT EXISTS idx_print_log_user ON print_log(user_id, printed_at);
+CREATE INDEX IF NOT EXISTS idx_print_log_time ON print_log(printed_at);
+CREATE TABLE IF NOT EXISTS render_jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL CHECK(kind IN ('card','batch')),
+    user_id INTEGER,
+    requested_by INTEGER NOT NULL,
+    params TEXT,
+    dedup_key TEXT,
+    status TEXT NOT NULL DEFAULT 'queued' CHECK(status IN ('queued','running','done','failed')),
+    result_path TEXT,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT,
+    worker TEXT,
+    heartbeat_at TEXT,
+    prints_recorded INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_render_jobs_status ON render_jobs(status, created_at);
+CREATE INDEX IF NOT EXISTS idx_render_jobs_dedup ON render_jobs(dedup_key, status);
+CREATE TABLE IF NOT EXISTS student_stats (
+    id INTEGER PRIMARY KEY CHECK(id = 1),
+    total INTEGER NOT NULL,
+    approved INTEGER NOT NULL,
+    pending INTEGER NOT NULL,
+    prints INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO student_stats (id, total, approved, pending, prints)
+    SELECT 1, COUNT(*), COALESCE(SUM(is_approved=1),0), COALESCE(SUM(is_approved=0),0), COALESCE(SUM(id_print_count),0)
+    FROM users WHERE role='student';
+CREATE TRIGGER IF NOT EXISTS trg_student_stats_insert AFTER INSERT ON users WHEN NEW.role='student' BEGIN
+    UPDATE student_stats SET total=total+1, approved=approved+IFNULL(NEW.is_approved=1,0), pending=pending+IFNULL(NEW.is_approved=0,0),
+        prints=prints+COALESCE(NEW.id_print_count,0) WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_student_stats_delete AFTER DELETE ON users WHEN OLD.role='student' BEGIN
+    UPDATE student_stats SET total=total-1, approved=approved-IFNULL(OLD.is_approved=1,0), pending=pending-IFNULL(OLD.is_approved=0,0),
+        prints=prints-COALESCE(OLD.id_print_count,0) WHERE id=1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_student_stats_update AFTER UPDATE OF role, is_approved, id_print_count ON users
+WHEN OLD.role='student' OR NEW.role='student' BEGIN
+    UPDATE student_stats SET
+        total=total-(OLD.role='student')+(NEW.role='student'),
+        approved=approved-IFNULL(OLD.role='student' AND OLD.is_approved=1,0)+IFNULL(NEW.role='student' AND NEW.is_approved=1,0),
+        pending=pending-IFNULL(OLD.role='student' AND OLD.is_approved=0,0)+IFNULL(NEW.role='student' AND NEW.is_approved=0,0),
+        prints=prints-(CASE WHEN OLD.role='student' THEN COALESCE(OLD.id_print_count,0) ELSE 0 END)
+                     +(CASE WHEN NEW.role='student' THEN COALESCE(NEW.id_print_count,0) ELSE 0 END)
+    WHERE id=1;
+END;
+-- change log read by the in-memory verification index (VerifyIndex)
+CREATE TABLE IF NOT EXISTS user_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    changed_at INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS trg_user_changes_insert AFTER INSERT ON users BEGIN
+    INSERT INTO user_changes (user_id, changed_at) VALUES (NEW.id, strftime('%s','now'));
+END;
+CREATE TRIGGER IF NOT EXISTS trg_user_changes_delete AFTER DELETE ON users BEGIN
+    INSERT INTO user_changes (user_id, changed_at) VALUES (OLD.id, strftime('%s','now'));
+END;
+CREATE TRIGGER IF NOT EXISTS trg_user_changes_update AFTER UPDATE OF role, reg_no, full_name, course, level, is_approved, id_print_count ON users BEGIN
+    INSERT INTO user_changes (user_id, changed_at) VALUES (NEW.id, strftime('%s','now'));
+END;
+CREATE TRIGGER IF NOT EXISTS trg_user_changes_card AFTER UPDATE OF card_serial ON users BEGIN
+    INSERT INTO user_changes (user_id, changed_at) VALUES (NEW.id, strftime('%s','now'));
+END;
+-- every card ever issued; the serial is signed into the card QR. Reissuing
+-- or deleting a student revokes the old serial (see verify bundle).
+CREATE TABLE IF NOT EXISTS card_serials (
+    serial INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    issued_at TEXT NOT NULL,
+    revoked_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_card_serials_user ON card_serials(user_id);
+CREATE TRIGGER IF NOT EXISTS trg_card_serials_insert AFTER INSERT ON users WHEN NEW.card_serial IS NULL BEGIN
+    INSERT INTO card_serials (user_id, issued_at) VALUES (NEW.id, NEW.created_at);
+    UPDATE users SET card_serial=last_insert_rowid() WHERE id=NEW.id;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_card_serials_delete AFTER DELETE ON users BEGIN
+    UPDATE card_serials SET revoked_at=datetime('now') WHERE user_id=OLD.id AND revoked_at IS NULL;
+END;
+CREATE INDEX IF NOT EXISTS idx_users_list_id ON users(role, id);
+CREATE INDEX IF NOT EXISTS idx_users_list_name ON users(role, IFNULL(full_name,''), id);
+CREATE INDEX IF NOT EXISTS idx_users_list_reg_no ON users(role, IFNULL(reg_no,''), id);
+CREATE INDEX IF NOT EXISTS idx_users_list_course ON users(role, IFNULL(course,''), id);
+CREATE INDEX IF NOT EXISTS idx_users_list_level ON users(role, IFNULL(level,''), id);
+CREATE INDEX IF NOT EXISTS idx_users_list_status ON users(role, IFNULL(is_approved,0), id);
+CREATE INDEX IF NOT EXISTS idx_users_list_prints ON users(role, IFNULL(id_print_count,0), id);
+-- the upload GC asks which files of one shard are still referenced
+CREATE INDEX IF NOT EXISTS idx_users_passport_path ON users(passport_path);
+CREATE INDEX IF NOT EXISTS idx_users_signature_path ON users(signature_path);
+CREATE INDEX IF NOT EXISTS idx_users_receipt_path ON users(receipt_path);
+-- background chores shared by every worker of every process: whoever moves
+-- next_run forward runs the chore, the others skip it (see claim_chore)
+CREATE TABLE IF NOT EXISTS maintenance (
+    task TEXT PRIMARY KEY,
+    next_run TEXT NOT NULL
+) WITHOUT ROWID;
 """
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+# Full-text index for admin search. External-content FTS5 table over users,
+# kept in sync by triggers; only created when SQLite has FTS5 compiled in.
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+    full_name, reg_no, course, email,
+    content='users', content_rowid='id', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS trg_users_fts_insert AFTER INSERT ON users BEGIN
+    INSERT INTO users_fts(rowid, full_name, reg_no, course, email) VALUES (NEW.id, NEW.full_name, NEW.reg_no, NEW.course, NEW.email);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_users_fts_delete AFTER DELETE ON users BEGIN
+    INSERT INTO users_fts(users_fts, rowid, full_name, reg_no, course, email) VALUES ('delete', OLD.id, OLD.full_name, OLD.reg_no, OLD.course, OLD.email);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_users_fts_update AFTER UPDATE OF full_name, reg_no, course, email ON users BEGIN
+    INSERT INTO users_fts(users_fts, rowid, full_name, reg_no, course, email) VALUES ('delete', OLD.id, OLD.full_name, OLD.reg_no, OLD.course, OLD.email);
+    INSERT INTO users_fts(rowid, full_name, reg_no, course, email) VALUES (NEW.id, NEW.full_name, NEW.reg_no, NEW.course, NEW.email);
+END;
+"""
+
+@functools.lru_cache(maxsize=None)
+def has_fts5() -> bool:
+    """Whether this SQLite build has FTS5; probed once, on first search or migration."""
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE t USING fts5(x)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+# Same numbers as student_stats, computed from scratch in one scan (for checks/repair).
+STATS_AGGREGATE_SQL = """
+    SELECT COUNT(*) AS total, COALESCE(SUM(is_approved=1),0) AS approved, COALESCE(SUM(is_approved=0),0) AS pending,
+           COALESCE(SUM(id_print_count),0) AS prints
+    FROM users WHERE role='student'
+"""
+
+# SQLite tuning. WAL lets readers run alongside the single writer, NORMAL
+# sync is durable across app crashes under WAL, and the busy timeout makes
+# writers queue up instead of failing with "database is locked".
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "10000"))
+DB_PRAGMAS = (
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=134217728",
+)
+
+# Columns added after the first release: (table, column, declaration).
+# New databases get them from SCHEMA; older ones are altered in init_db().
+SCHEMA_COLUMNS = (
+    ("users", "card_serial", "INTEGER"),
+    ("print_log", "operator_id", "INTEGER"),
+    ("render_jobs", "worker", "TEXT"),
+    ("render_jobs", "heartbeat_at", "TEXT"),
+    ("render_jobs", "prints_recorded", "INTEGER NOT NULL DEFAULT 0"),
+)
+CARD_SERIAL_BACKFILL = """
+INSERT INTO card_serials (user_id, issued_at) SELECT id, created_at FROM users WHERE card_serial IS NULL ORDER BY id;
+UPDATE users SET card_serial=(SELECT MAX(serial) FROM card_serials c WHERE c.user_id=users.id) WHERE card_serial IS NULL;
+"""
+
+# Print analytics read only these rollups, so a range query costs the same
+# however long print_log grows: print_rollup has one row per UTC day, course
+# and operator (0 = self-service / CLI), print_hourly one per day and hour.
+# A print is a reprint when that student already had one. Created after
+# SCHEMA_COLUMNS so that older print_logs have operator_id.
+PRINT_ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS print_rollup (
+    day TEXT NOT NULL,
+    course TEXT NOT NULL,
+    operator_id INTEGER NOT NULL,
+    prints INTEGER NOT NULL,
+    reprints INTEGER NOT NULL,
+    PRIMARY KEY (day, course, operator_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS print_hourly (
+    day TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    prints INTEGER NOT NULL,
+    PRIMARY KEY (day, hour)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS trg_print_rollup AFTER INSERT ON print_log BEGIN
+    INSERT INTO print_rollup (day, course, operator_id, prints, reprints)
+    VALUES (substr(NEW.printed_at, 1, 10), IFNULL((SELECT course FROM users WHERE id=NEW.user_id), ''), IFNULL(NEW.operator_id, 0), 1,
+            EXISTS(SELECT 1 FROM print_log WHERE user_id=NEW.user_id AND id<NEW.id))
+    ON CONFLICT(day, course, operator_id) DO UPDATE SET prints=prints+1, reprints=reprints+excluded.reprints;
+    INSERT INTO print_hourly (day, hour, prints) VALUES (substr(NEW.printed_at, 1, 10), CAST(substr(NEW.printed_at, 12, 2) AS INTEGER), 1)
+    ON CONFLICT(day, hour) DO UPDATE SET prints=prints+1;
+END;
+"""
+PRINT_ROLLUP_BACKFILL = """
+INSERT INTO print_rollup (day, course, operator_id, prints, reprints)
+SELECT substr(p.printed_at, 1, 10), IFNULL(u.course, ''), IFNULL(p.operator_id, 0), COUNT(*), SUM(p.id > f.first_id)
+FROM print_log p
+JOIN (SELECT user_id, MIN(id) AS first_id FROM print_log GROUP BY user_id) f ON f.user_id = p.user_id
+LEFT JOIN users u ON u.id = p.user_id
+GROUP BY 1, 2, 3;
+INSERT INTO print_hourly (day, hour, prints)
+SELECT substr(printed_at, 1, 10), CAST(substr(printed_at, 12, 2) AS INTEGER), COUNT(*) FROM print_log GROUP BY 1, 2;
+"""
+
+_db_local = threading.local()
+
+def connect_db() -> sqlite3.Connection:
+    """
+    Open a new tuned connection. Most code should use get_db() instead. The
+    first connection of a process checks the schema first (ensure_schema).
+    """
+    ensure_schema()
+    return _open_db()
+
+def _open_db() -> sqlite3.Connection:
+    with stage("db.connect"):
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        conn.create_function("file_token", 1, file_token, deterministic=True)
     return conn
 
-def init_db():
-    conn = get_db()
+def get_db() -> sqlite3.Connection:
+    """
+    Shared connection for the current request, or for the current thread when
+    called outside a request (job workers, CLI helpers). Request connections
+    are closed in close_db(); do not close the returned connection yourself.
+    """
+    if has_app_context():
+        if 'db' not in g:
+            g.db = connect_db()
+        return g.db
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = _db_local.conn = connect_db()
+    return conn
+
+@app.teardown_appcontext
+def close_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.close()
+
+def ensure_column(conn, table: str, column: str, decl: str):
+    if column not in {r['name'] for r in conn.execute(f"PRAGMA table_info({table})")}:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+# Stored in PRAGMA user_version once init_db() has brought a database up to
+# date; bump it with every change to the schema scripts or SCHEMA_COLUMNS.
+SCHEMA_VERSION = 3
+
+def init_db(force: bool = False) -> bool:
+    """
+    Create or migrate the schema; returns False when the database was already
+    at SCHEMA_VERSION, which costs a single PRAGMA read.
+    """
+    conn = _open_db()
+    if not force and conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        conn.close()
+        return False
+    conn.execute("PRAGMA journal_mode=WAL")  # persistent; stored in the db file
     with conn:
         conn.executescript(SCHEMA)
+    with conn:
+        for table, column, decl in SCHEMA_COLUMNS:
+            ensure_column(conn, table, column, decl)
+        if conn.execute("SELECT 1 FROM users WHERE card_serial IS NULL LIMIT 1").fetchone():
+            conn.executescript(CARD_SERIAL_BACKFILL)
+    fresh = conn.execute("SELECT 1 FROM sqlite_master WHERE name='print_rollup'").fetchone() is None
+    with conn:
+        conn.executescript(PRINT_ROLLUP_SCHEMA)
+        if fresh:
+            conn.executescript(PRINT_ROLLUP_BACKFILL)
+    if has_fts5():
+        fresh = conn.execute("SELECT 1 FROM sqlite_master WHERE name='users_fts'").fetchone() is None
+        with conn:
+            conn.executescript(FTS_SCHEMA)
+            if fresh:
+                conn.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+    conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
     conn.close()
+    return True
 
-init_db()
+# Migrating is a deploy step (`flask --app app migrate`). Without it the first
+# connection a process opens migrates the database, so a fresh checkout still
+# runs as is; AUTO_MIGRATE=0 makes that first connection fail instead.
+AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "1") != "0"
+_schema_checked = False
+_schema_lock = threading.Lock()
+
+def ensure_schema():
+    global _schema_checked
+    if _schema_checked:
+        return
+    with _schema_lock:
+        if _schema_checked:
+            return
+        if AUTO_MIGRATE:
+            init_db()
+        else:
+            conn = _open_db()
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            conn.close()
+            if version < SCHEMA_VERSION:
+                raise RuntimeError(f"Database schema is at version {version}, the app needs {SCHEMA_VERSION}: "
+                                   "run `flask --app app migrate`")
+        _schema_checked = True
+
+def check_password(pw_hash: str, password: str) -> bool:
+    with stage("auth.check_password"):
+        return check_password_hash(pw_hash, password)
+
+def hash_password(password: str) -> str:
+    with stage("auth.hash_password"):
+        return generate_password_hash(password)
 
 def login_required(role: str | None = None):
     def wrapper(fn):
@@ -95,14 +465,122 @@ def login_required(role: str | None = None):
         return inner
     return wrapper
 
+@timed_stage("db.load_user")
 def load_user(user_id: int):
-    conn = get_db()
-    cur = conn.execute("SELECT * FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return get_db().execute("SELECT * FROM users WHERE id=?", (user_id,)).fetchone()
+
+@timed_stage("db.load_stats")
+def load_stats(conn) -> dict:
+    """Dashboard tiles, read from the trigger-maintained student_stats row."""
+    row = conn.execute("SELECT total, approved, pending, prints FROM student_stats WHERE id=1").fetchone()
+    return dict(row if row else conn.execute(STATS_AGGREGATE_SQL).fetchone())
+
+# Admin student list: keyset pagination over (sort key, id). Each sort key is
+# an expression with a matching idx_users_list_* index, so every page is an
+# index range scan no matter how deep into the list it is.
+ADMIN_PAGE_SIZE = int(os.environ.get("ADMIN_PAGE_SIZE", "50"))
+STUDENT_SORTS = {
+    'id': "id",
+    'name': "IFNULL(full_name,'')",
+    'reg_no': "IFNULL(reg_no,'')",
+    'course': "IFNULL(course,'')",
+    'level': "IFNULL(level,'')",
+    'status': "IFNULL(is_approved,0)",
+    'prints': "IFNULL(id_print_count,0)",
+}
+# the receipt link only needs the cache token, so the path itself stays in SQLite
+STUDENT_LIST_COLUMNS = ("id, full_name, reg_no, course, level, is_approved, id_print_count, "
+                        "IFNULL(receipt_path,'')<>'' AS has_receipt, file_token(receipt_path) AS receipt_token")
+
+def encode_cursor(row) -> str:
+    return base64.urlsafe_b64encode(json.dumps([row['sort_key'], row['id']]).encode()).decode().rstrip('=')
+
+def decode_cursor(token: str | None):
+    if not token:
+        return None
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return [value, int(row_id)]
+    except Exception:
+        return None
+
+@timed_stage("db.list_students_page")
+def list_students_page(conn, sort: str = 'id', direction: str = 'desc', after: str | None = None,
+                       before: str | None = None, where: str = '', args: tuple = (), page_size: int = ADMIN_PAGE_SIZE,
+                       drive_by_filter: bool = False) -> dict:
+    """
+    One page of students for the admin list. `after` / `before` are cursors
+    from a previous page; `where`/`args` add an extra filter (search).
+    With drive_by_filter the sort indexes are skipped so SQLite looks up the
+    filter's ids directly and sorts them, which is far cheaper than walking a
+    sort index for a selective search.
+    """
+    key = STUDENT_SORTS.get(sort, 'id')
+    asc = direction == 'asc'
+    cursor = decode_cursor(before) if before else decode_cursor(after)
+    backwards = bool(before) and cursor is not None
+    forward_asc = asc != backwards
+    clauses = ["role='student'"]
+    params = list(args)
+    if where:
+        clauses.append(f"({where})")
+    if cursor is not None:
+        # the redundant single-column bound is what lets SQLite seek the index
+        clauses.append(f"{key} {'>=' if forward_asc else '<='} ? AND ({key}, id) {'>' if forward_asc else '<'} (?, ?)")
+        params += [cursor[0]] + cursor
+    order = 'ASC' if forward_asc else 'DESC'
+    rows = conn.execute(
+        f"SELECT {STUDENT_LIST_COLUMNS}, {key} AS sort_key FROM users{' NOT INDEXED' if drive_by_filter else ''} WHERE {' AND '.join(clauses)} "
+        f"ORDER BY {key} {order}, id {order} LIMIT ?", params + [page_size + 1]).fetchall()
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+    return {
+        'rows': rows,
+        'next': encode_cursor(rows[-1]) if rows and (more or backwards) else None,
+        'prev': encode_cursor(rows[0]) if rows and cursor is not None and (more or not backwards) else None,
+    }
 
+def fts_query(q: str) -> str:
+    """Turn free text into an FTS5 query: every word must match as a prefix."""
+    return " ".join(f'"{tok}"*' for tok in re.findall(r"\w+", q))
+
+def student_search_filter(q: str) -> tuple[str, tuple]:
+    """
+    WHERE fragment (for list_students_page) matching q as an exact reg no
+    (unique index) or as word prefixes in name / reg no / course / email.
+    """
+    match = fts_query(q)
+    if has_fts5() and match:
+        return ("id IN (SELECT id FROM users WHERE reg_no = ? UNION ALL SELECT rowid FROM users_fts WHERE users_fts MATCH ?)",
+                (q.upper(), match))
+    return "reg_no = ? OR full_name LIKE ? OR reg_no LIKE ?", (q.upper(), f"%{q}%", f"%{q}%")
+
+@timed_stage("db.search_students")
+def search_students(conn, q: str, limit: int = 10) -> list[sqlite3.Row]:
+    """Best matches for the typeahead: exact reg no first, then by FTS rank."""
+    cols = "u.id, u.full_name, u.reg_no, u.course, u.level, u.is_approved"
+    rows = list(conn.execute(f"SELECT {cols} FROM users u WHERE u.role='student' AND u.reg_no=?", (q.upper(),)))
+    match = fts_query(q)
+    if has_fts5() and match:
+        rows += conn.execute(f"""
+            SELECT {cols} FROM users_fts f JOIN users u ON u.id = f.rowid
+            WHERE users_fts MATCH ? AND u.role='student' ORDER BY f.rank LIMIT ?
+        """, (match, limit + 1))
+    elif q:
+        rows += conn.execute(f"SELECT {cols} FROM users u WHERE u.role='student' AND (u.full_name LIKE ? OR u.reg_no LIKE ?) LIMIT ?",
+                             (f"%{q}%", f"%{q}%", limit + 1))
+    seen, out = set(), []
+    for r in rows:
+        if r['id'] not in seen:
+            seen.add(r['id']); out.append(r)
+    return out[:limit]
+
+@functools.lru_cache(maxsize=None)
 def load_font(size: int):
+    """FreeType font at size px, loaded on first use and then shared."""
+    from PIL import ImageFont
     candidates = [
         "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
         "/Library/Fonts/Arial.ttf",
@@ -116,148 +594,1653 @@ def load_font(size: int):
                 pass
     return ImageFont.load_default()
 
-FONT_H1 = load_font(38)
-FONT_H2 = load_font(22)
-FONT_MD = load_font(22)
-FONT_SM = load_font(18)
-FONT_XS = load_font(16)
+CARD_FONT_SIZES = {'h1': 38, 'h2': 22, 'md': 22, 'sm': 18, 'xs': 16}
 
-def compose_id_card(student: sqlite3.Row) -> Image.Image:
-    """
-    Compose and return a PIL.Image (RGB) of the ID card at CARD_SIZE (print quality).
-    Uses a QR code at bottom-right containing multi-line student data.
-    """
+def card_font(name: str):
+    return load_font(CARD_FONT_SIZES[name])
+
+# Card layout. Everything that does not depend on the student (header, logo,
+# titles, field labels, photo box) lives in the card template below.
+HEADER_H = 118
+PHOTO_W, PHOTO_H = 300, 360
+PHOTO_X, PHOTO_Y = MARGIN, HEADER_H + MARGIN
+DETAILS_X = PHOTO_X + PHOTO_W + 28
+ROW_GAP = 34
+CARD_ROWS = [
+    ("Full Name", "full_name"),
+    ("Sex", "sex"),
+    ("Date of Birth", "dob"),
+    ("Blood Group", "blood_group"),
+    ("Course", "course"),
+    ("Reg No.", "reg_no"),
+    ("Level", "level"),
+]
+SIGN_Y = HEADER_H + MARGIN + ROW_GAP * len(CARD_ROWS)
+CARD_BLUE = (6, 61, 138, 255)
+CARD_GRAY = (246, 247, 251, 255)
+CARD_DARK = (20, 20, 20, 255)
+CARD_LABEL = (90, 90, 90)
+
+# The layout above is in print pixels. Previews are drawn at PREVIEW_SCALE
+# rather than downsampled from a print render: the template is downsampled
+# once per process, photo and signature come as pre-sized derivatives and
+# only the student's text and QR code are filtered down per card.
+PREVIEW_SCALE = 0.32
+
+def px(v: float, scale: float) -> int:
+    """A print-pixel length or position at scale."""
+    return round(v * scale)
+
+def card_size(scale: float = 1.0) -> tuple[int, int]:
+    return px(CARD_SIZE[0], scale), px(CARD_SIZE[1], scale)
+
+PREVIEW_SIZE = card_size(PREVIEW_SCALE)  # (324, 204)
+
+def build_card_template(scale: float = 1.0) -> Image.Image:
+    """Draw the static (student-independent) layer of the card as an RGBA image."""
+    from PIL import Image, ImageDraw
     card = Image.new("RGBA", CARD_SIZE, "white")
     draw = ImageDraw.Draw(card)
 
-    header_h = 118
-    blue = (6, 61, 138, 255)
-    gray = (246, 247, 251, 255)
-    dark = (20, 20, 20, 255)
-
     # Header
-    draw.rectangle((0, 0, CARD_SIZE[0], header_h), fill=blue)
+    draw.rectangle((0, 0, CARD_SIZE[0], HEADER_H), fill=CARD_BLUE)
     if os.path.exists(SCHOOL_LOGO):
         try:
             logo = Image.open(SCHOOL_LOGO).convert("RGBA").resize((96, 96), Image.LANCZOS)
-            card.paste(logo, (MARGIN, int((header_h - 96) / 2)), logo)
+            card.paste(logo, (MARGIN, int((HEADER_H - 96) / 2)), logo)
         except Exception:
             pass
 
     # Titles
-    draw.text((MARGIN + 110, 18), SCHOOL_NAME, font=FONT_H1, fill="white")
-    draw.text((MARGIN + 110, 58), SCHOOL_ADDRESS, font=FONT_SM, fill="white")
-    draw.text((MARGIN + 110, 86), "STUDENT IDENTITY CARD", font=FONT_SM, fill="white")
+    draw.text((MARGIN + 110, 18), SCHOOL_NAME, font=card_font('h1'), fill="white")
+    draw.text((MARGIN + 110, 58), SCHOOL_ADDRESS, font=card_font('sm'), fill="white")
+    draw.text((MARGIN + 110, 86), "STUDENT IDENTITY CARD", font=card_font('sm'), fill="white")
 
     # Photo area
-    photo_w, photo_h = 300, 360
-    px, py = MARGIN, header_h + MARGIN
-    draw.rectangle((px, py, px + photo_w, py + photo_h), fill=gray)
-    if student["passport_path"] and os.path.exists(student["passport_path"]):
-        try:
-            ph = Image.open(student["passport_path"]).convert("RGBA")
-            ph = ph.resize((photo_w - 16, photo_h - 16), Image.LANCZOS)
-            card.paste(ph, (px + 8, py + 8), ph)
-        except Exception:
-            pass
+    draw.rectangle((PHOTO_X, PHOTO_Y, PHOTO_X + PHOTO_W, PHOTO_Y + PHOTO_H), fill=CARD_GRAY)
+
+    # Field labels
+    y = HEADER_H + MARGIN
+    for lbl, _ in CARD_ROWS:
+        draw.text((DETAILS_X, y), lbl, font=card_font('h2'), fill=CARD_LABEL)
+        y += ROW_GAP
+    draw.text((DETAILS_X, SIGN_Y), "Sign", font=card_font('h2'), fill=CARD_LABEL)
+    draw.text((DETAILS_X + 190, SIGN_Y), ":  ", font=card_font('md'), fill=CARD_DARK)
+    # built once per process, so smaller scales can afford to be exact downsamples
+    return card if scale == 1.0 else card.resize(card_size(scale), Image.LANCZOS)
+
+_card_templates: dict[float, tuple[str, Image.Image]] = {}
+_card_template_lock = threading.Lock()
+
+def get_card_template(scale: float = 1.0) -> Image.Image:
+    """Return the compiled card template at scale, rebuilding it when the logo file changes."""
+    ident = _file_identity(SCHOOL_LOGO)
+    cached = _card_templates.get(scale)
+    if cached is not None and cached[0] == ident:
+        return cached[1]
+    with _card_template_lock:
+        cached = _card_templates.get(scale)
+        if cached is None or cached[0] != ident:
+            cached = _card_templates[scale] = (ident, build_card_template(scale))
+        return cached[1]
+
+def paste_scaled(card: Image.Image, im: Image.Image, xy: tuple[int, int], fill=None):
+    """
+    Paste im, given in print pixels at print position xy, onto a smaller card:
+    LANCZOS-filtered and placed to the sub-pixel, as downsampling a print
+    render to card.size would. With fill, im is an "L" coverage mask painted in fill.
+    """
+    from PIL import Image, ImageOps
+    x, y = xy
+    sx, sy = card.width / CARD_SIZE[0], card.height / CARD_SIZE[1]  # per axis, as resize() maps them
+    x0, y0 = math.floor(x * sx), math.floor(y * sy)
+    x1 = min(card.width, math.ceil((x + im.width) * sx))
+    y1 = min(card.height, math.ceil((y + im.height) * sy))
+    pad = math.ceil(4 / min(sx, sy))  # covers the filter support past the pixels the box rounds out to
+    src = ImageOps.expand(im, pad, fill=0 if fill is not None else "white")
+    box = (x0 / sx - x + pad, y0 / sy - y + pad, x1 / sx - x + pad, y1 / sy - y + pad)
+    out = src.resize((x1 - x0, y1 - y0), Image.LANCZOS, box=box)
+    if fill is None:
+        card.paste(out, (x0, y0))
+    else:
+        card.paste(fill, (x0, y0, x1, y1), out)
+
+def draw_card_text(card: Image.Image, draw: ImageDraw.ImageDraw, xy: tuple[int, int], text: str, font_name: str, fill, scale: float):
+    """draw.text at print position xy. Below print scale the glyphs are drawn at print size and
+    filtered down; hinted 7px glyphs would not look like the printed card."""
+    from PIL import Image, ImageDraw
+    font = card_font(font_name)
+    if scale == 1.0:
+        draw.text(xy, text, font=font, fill=fill)
+        return
+    _, _, right, bottom = font.getbbox(text)
+    if right <= 0 or bottom <= 0:
+        return
+    mask = Image.new("L", (right, bottom), 0)
+    ImageDraw.Draw(mask).text((0, 0), text, font=font, fill=255)
+    paste_scaled(card, mask, xy, fill)
+
+# ---------------- Card QR code ----------------
+# By default the QR holds a signed compact code (see cardcode.py): reg no,
+# card serial and expiry, verifiable offline with the exported bundle.
+# CARD_QR_FORMAT=text keeps the old readable multi-line text.
+
+CARD_QR_FORMAT = os.environ.get("CARD_QR_FORMAT", "signed")
+CARD_VALID_DAYS = int(os.environ.get("CARD_VALID_DAYS", str(4 * 365)))
+CARD_SIGNING_KEY_PATH = os.path.join("data", "card_signing.key")
+
+def write_card_signing_key(path: str, secret: bytes, alg: str, replace: bool = False):
+    data = json.dumps({"alg": alg, "key": base64.b64encode(secret).decode()}).encode()
+    if not replace:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)  # FileExistsError if another process won
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def load_card_signer() -> CardSigner:
+    """
+    Signing key from CARD_SIGNING_KEY (base64, 32 bytes; needs CARD_SIGNING_ALG)
+    or data/card_signing.key, which is created on first start and records its
+    algorithm, so printed cards keep verifying whatever packages get installed.
+    CARD_SIGNING_ALG (ed25519 or hmac) picks the algorithm of a new key file and
+    must match an existing one; left unset, a new key is Ed25519, or HMAC with
+    a warning when cryptography is not installed.
+    """
+    alg = os.environ.get("CARD_SIGNING_ALG") or None
+    if alg is not None and alg not in SIGNER_ALGS:
+        raise RuntimeError(f"CARD_SIGNING_ALG must be one of {', '.join(SIGNER_ALGS)}")
+    if os.environ.get("CARD_SIGNING_KEY"):
+        if alg is None:
+            raise RuntimeError("CARD_SIGNING_KEY needs CARD_SIGNING_ALG (ed25519 or hmac) set alongside it")
+        return CardSigner(base64.b64decode(os.environ["CARD_SIGNING_KEY"]), alg)
+    new_alg = alg or ("ed25519" if HAS_ED25519 else "hmac")
+    try:
+        write_card_signing_key(CARD_SIGNING_KEY_PATH, os.urandom(32), new_alg)
+    except FileExistsError:
+        pass
+    else:
+        if new_alg == "hmac" and alg is None:
+            app.logger.warning("The 'cryptography' package is not installed, so the new card signing key in %s "
+                               "is an HMAC key. Its verify bundle can mint cards and is only exported by the CLI.",
+                               CARD_SIGNING_KEY_PATH)
+    with open(CARD_SIGNING_KEY_PATH, 'rb') as f:
+        raw = f.read()
+    if len(raw) == 32:
+        # raw key from before the algorithm was recorded: it signed with Ed25519
+        # exactly when cryptography was installed, so pin that choice now
+        stored = alg or ("ed25519" if HAS_ED25519 else "hmac")
+        write_card_signing_key(CARD_SIGNING_KEY_PATH, raw, stored, replace=True)
+        return CardSigner(raw, stored)
+    key = json.loads(raw)
+    if alg is not None and alg != key["alg"]:
+        raise RuntimeError(f"{CARD_SIGNING_KEY_PATH} is an {key['alg']} key but CARD_SIGNING_ALG={alg}; "
+                           "printed cards would stop verifying (move the key aside to start a new one)")
+    if key["alg"] == "ed25519" and not HAS_ED25519:
+        raise RuntimeError(f"{CARD_SIGNING_KEY_PATH} is an Ed25519 key: install the 'cryptography' package "
+                           "(pip install -r requirements.txt) to sign and verify cards")
+    return CardSigner(base64.b64decode(key["key"]), key["alg"])
+
+_card_key_pair: tuple[CardSigner, CardVerifier] | None = None
+_card_signer_lock = threading.Lock()
+
+def _card_keys() -> tuple[CardSigner, CardVerifier]:
+    global _card_key_pair
+    if _card_key_pair is None:
+        with _card_signer_lock:
+            if _card_key_pair is None:
+                signer = load_card_signer()
+                # the verifier only checks signatures; revocation comes from the DB
+                _card_key_pair = (signer, CardVerifier(signer.bundle()))
+    return _card_key_pair
+
+def get_card_signer() -> CardSigner:
+    return _card_keys()[0]
+
+def get_card_verifier() -> CardVerifier:
+    return _card_keys()[1]
+
+def card_expiry(student) -> date:
+    return date.fromisoformat(student['created_at'][:10]) + timedelta(days=CARD_VALID_DAYS)
+
+def card_qr_text(student, fmt: str | None = None) -> str:
+    if (fmt or CARD_QR_FORMAT) == 'text':
+        return (
+            f"REG:{student['reg_no'] or ''}\n"
+            f"Name: {student['full_name'] or ''}\n"
+            f"Course: {student['course'] or ''}\n"
+            f"Level: {student['level'] or ''}\n"
+            f"DOB: {student['dob'] or ''}"
+        )
+    return get_card_signer().encode(student['reg_no'] or '', student['card_serial'] or 0, card_expiry(student))
+
+def make_card_qr(text: str) -> qrcode.QRCode:
+    import qrcode  # only render paths need it; keeps it out of workers that never draw a card
+    import qrcode.constants
+    # signed codes are all QR-alphanumeric and carry their own integrity check,
+    # so level M is enough; the free-text format keeps its old H level
+    level = qrcode.constants.ERROR_CORRECT_M if text.startswith(CARD_CODE_PREFIX) else qrcode.constants.ERROR_CORRECT_H
+    qr = qrcode.QRCode(version=None, error_correction=level, box_size=6, border=2)
+    qr.add_data(text)
+    qr.make(fit=True)
+    return qr
+
+def card_qr_image(qr: qrcode.QRCode, size: int) -> Image.Image:
+    """
+    The symbol and its quiet zone as a size x size greyscale image. Built one
+    pixel per module straight from the matrix and fitted with nearest-neighbour,
+    so edges stay sharp without qrcode drawing every module as a rectangle.
+    """
+    from PIL import Image
+    n, border = qr.modules_count, qr.border
+    modules = Image.frombytes("L", (n, n), bytes(0 if dark else 255 for row in qr.modules for dark in row))
+    im = Image.new("L", (n + 2 * border, n + 2 * border), 255)
+    im.paste(modules, (border, border))
+    return im.resize((size, size), Image.NEAREST)
+
+CARD_QR_SIZE = 220  # print pixels; previews scale it down when pasting
+CARD_QR_CACHE_SIZE = int(os.environ.get("CARD_QR_CACHE_SIZE", "256"))  # about 48 KB each
+
+@functools.lru_cache(maxsize=CARD_QR_CACHE_SIZE)
+def card_qr(text: str) -> Image.Image:
+    """
+    The card's QR at print size, shared by every scale and format of the same
+    card (the text already covers reg no, serial and expiry). Callers only
+    read it, so one image serves the preview, its WebP twin and the PDF.
+    """
+    return card_qr_image(make_card_qr(text), CARD_QR_SIZE)
+
+def compose_id_card(student: sqlite3.Row, template: Image.Image | None = None, scale: float = 1.0) -> Image.Image:
+    """
+    Compose and return a PIL.Image (RGB) of the ID card at card_size(scale);
+    scale 1 is CARD_SIZE (print quality), PREVIEW_SCALE the web preview.
+    Starts from the static card template and only draws the student's photo,
+    details, signature and the card QR code (card_qr_text) at bottom-right.
+    """
+    from PIL import ImageDraw
+    asset = 'card' if scale == 1.0 else 'preview'
+    with stage("card.template"):
+        card = (template or get_card_template(scale)).copy()
+        draw = ImageDraw.Draw(card)
+    # print position -> card pixel, per axis like paste_scaled
+    at = lambda x, y: (round(x * card.width / CARD_SIZE[0]), round(y * card.height / CARD_SIZE[1]))
+
+    # Photo (pre-cropped to the photo box at upload time)
+    with stage("card.photo"):
+        ph = card_asset(student["passport_path"], 'pass', asset)
+        if ph is not None:
+            card.paste(ph, at(PHOTO_X + 8, PHOTO_Y + 8), ph)
 
     # Details
-    rx = px + photo_w + 28
-    y = header_h + MARGIN
-    row_gap = 34
-
-    def row(lbl, val):
-        nonlocal y
-        draw.text((rx, y), f"{lbl}", font=FONT_H2, fill=(90, 90, 90))
-        draw.text((rx + 190, y), f":  {val or ''}", font=FONT_MD, fill=dark)
-        y += row_gap
-
-    row("Full Name", student["full_name"])
-    row("Sex", student["sex"])
-    row("Date of Birth", student["dob"])
-    row("Blood Group", student["blood_group"])
-    row("Course", student["course"])
-    row("Reg No.", student["reg_no"])
-    row("Level", student["level"])
-
-    # Signature
-    draw.text((rx, y), "Sign", font=FONT_H2, fill=(90, 90, 90))
-    draw.text((rx + 190, y), ":  ", font=FONT_MD, fill=dark)
-    if student["signature_path"] and os.path.exists(student["signature_path"]):
-        try:
-            sig = Image.open(student["signature_path"]).convert("RGBA")
-            sig.thumbnail((280, 80), Image.LANCZOS)
-            card.paste(sig, (rx + 210, y - 6), sig)
-        except Exception:
-            pass
-    y += row_gap + 8
+    with stage("card.details"):
+        y = HEADER_H + MARGIN
+        for _, field in CARD_ROWS:
+            draw_card_text(card, draw, (DETAILS_X + 190, y), f":  {student[field] or ''}", 'md', CARD_DARK, scale)
+            y += ROW_GAP
+
+    # Signature (already fitted to CARD_SIGN_SIZE)
+    with stage("card.signature"):
+        sig = card_asset(student["signature_path"], 'sig', asset)
+        if sig is not None:
+            card.paste(sig, at(DETAILS_X + 210, SIGN_Y - 6), sig)
 
     # ---------- QR Code section ----------
-    # Prepare QR contents (multi-line, readable)
-    qr_text = (
-        f"REG:{student['reg_no'] or ''}\n"
-        f"Name: {student['full_name'] or ''}\n"
-        f"Course: {student['course'] or ''}\n"
-        f"Level: {student['level'] or ''}\n"
-        f"DOB: {student['dob'] or ''}"
-    )
-
-    qr = qrcode.QRCode(
-        version=None,  # let library choose minimal version
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=6,
-        border=2,
-    )
-    qr.add_data(qr_text)
-    qr.make(fit=True)
-    qr_img = qr.make_image(fill_color="black", back_color="white").convert("RGBA")
+    qr_size = CARD_QR_SIZE
+    with stage("card.qr"):
+        qr_img = card_qr(card_qr_text(student))
 
     # Place QR at bottom-right with a margin
-    qr_size = 220
-    try:
-        qr_img = qr_img.resize((qr_size, qr_size), Image.LANCZOS)
-    except Exception:
-        pass
     panel_x = CARD_SIZE[0] - qr_size - MARGIN
     panel_y = CARD_SIZE[1] - qr_size - MARGIN
-    card.paste(qr_img, (panel_x, panel_y))
+    if scale == 1.0:
+        card.paste(qr_img, (panel_x, panel_y))
+    else:
+        paste_scaled(card, qr_img, (panel_x, panel_y))
 
     # Human-readable label below or beside it
     label = f"REG:{student['reg_no'] or ''} | {student['full_name'] or ''}"
-    lw = draw.textlength(label, font=FONT_XS)
+    lw = draw.textlength(label, font=card_font('xs'))
     # center label horizontally under QR if space available
     lbl_x = panel_x + int((qr_size - lw) / 2)
     lbl_y = panel_y + qr_size + 6
     # ensure label is within card bounds
     if lbl_y + 20 < CARD_SIZE[1]:
-        draw.text((lbl_x, lbl_y), label, font=FONT_XS, fill=(40, 40, 40))
+        draw_card_text(card, draw, (lbl_x, lbl_y), label, 'xs', (40, 40, 40), scale)
 
     return card.convert("RGB")
 
+# ---------------- Card render cache ----------------
+# Rendered cards are cached under a hash of everything compose_id_card() reads:
+# the card fields of the row plus the identity (path, mtime, size) of the
+# passport, signature and logo files. Any edit or re-upload changes the key,
+# so stale entries are never served; they just age out of the LRU.
+
+# bump when the card layout changes so old disk entries stop matching
+CARD_RENDER_VERSION = "4"
+CARD_FIELDS = ("full_name", "sex", "dob", "blood_group", "course", "reg_no", "level")
+
+def _file_identity(path: str | None) -> str:
+    if not path:
+        return ""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ""
+    return f"{path}:{st.st_mtime_ns}:{st.st_size}"
+
+def card_cache_key(student, kind: str) -> str:
+    h = hashlib.sha256()
+    h.update(f"v{CARD_RENDER_VERSION}|{kind}".encode())
+    for field in CARD_FIELDS:
+        h.update(b"\x1f" + str(student[field] or "").encode())
+    h.update(b"\x1d" + card_qr_text(student).encode())
+    for path in (student["passport_path"], student["signature_path"], SCHOOL_LOGO):
+        h.update(b"\x1e" + _file_identity(path).encode())
+    return h.hexdigest()
+
+class CardCache:
+    """
+    Two-tier LRU for rendered card bytes: a small in-memory tier in front of
+    a size-bounded directory. Disk files are named u<user_id>-<key>.<ext> so
+    all entries of one student can be dropped without an index.
+    """
+    def __init__(self, directory: str, mem_limit: int, disk_limit: int):
+        self.directory = directory
+        self.mem_limit = mem_limit
+        self.disk_limit = disk_limit
+        self._mem: OrderedDict[str, tuple[int, bytes]] = OrderedDict()
+        self._mem_bytes = 0
+        self._lock = threading.Lock()
+        self._disk_bytes: int | None = None  # counted on the first put, not at startup
+
+    def _disk_path(self, user_id: int, key: str, ext: str) -> str:
+        return os.path.join(self.directory, f"u{user_id}-{key}.{ext}")
+
+    def get(self, user_id: int, key: str, ext: str) -> bytes | None:
+        with self._lock:
+            hit = self._mem.get(key)
+            if hit is not None:
+                self._mem.move_to_end(key)
+                return hit[1]
+        path = self._disk_path(user_id, key, ext)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # mtime doubles as the disk LRU clock
+        except OSError:
+            return None
+        self._remember(user_id, key, data)
+        return data
+
+    def put(self, user_id: int, key: str, ext: str, data: bytes):
+        self._remember(user_id, key, data)
+        path = self._disk_path(user_id, key, ext)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(data)
+        if self._disk_bytes is None:
+            total = sum(e.stat().st_size for e in os.scandir(self.directory) if e.is_file())
+            with self._lock:
+                self._disk_bytes = total
+        if self._disk_bytes > self.disk_limit:
+            self._prune_disk()
+
+    def invalidate_user(self, user_id: int):
+        self.invalidate_users((user_id,))
+
+    def invalidate_users(self, user_ids):
+        """Drop every entry of these students in one pass over the cache directory."""
+        ids = {int(u) for u in user_ids}
+        if not ids:
+            return
+        prefixes = {f"u{u}-" for u in ids}
+        with self._lock:
+            for key in [k for k, (uid, _) in self._mem.items() if uid in ids]:
+                self._mem_bytes -= len(self._mem.pop(key)[1])
+        for e in os.scandir(self.directory):
+            if e.name[:e.name.find('-') + 1] in prefixes:
+                try:
+                    size = e.stat().st_size
+                    os.remove(e.path)
+                except OSError:
+                    continue
+                with self._lock:
+                    if self._disk_bytes is not None:
+                        self._disk_bytes -= size
+
+    def _remember(self, user_id: int, key: str, data: bytes):
+        if len(data) > self.mem_limit:
+            return
+        with self._lock:
+            old = self._mem.pop(key, None)
+            if old is not None:
+                self._mem_bytes -= len(old[1])
+            self._mem[key] = (user_id, data)
+            self._mem_bytes += len(data)
+            while self._mem_bytes > self.mem_limit:
+                _, (_, evicted) = self._mem.popitem(last=False)
+                self._mem_bytes -= len(evicted)
+
+    def _prune_disk(self):
+        entries = []
+        for e in os.scandir(self.directory):
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, e.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        # trim to 90% so a full cache doesn't rescan on every put
+        target = int(self.disk_limit * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+card_cache = CardCache(
+    CACHE_DIR,
+    mem_limit=int(os.environ.get("CARD_CACHE_MEM_MB", "32")) * 1024 * 1024,
+    disk_limit=int(os.environ.get("CARD_CACHE_DISK_MB", "512")) * 1024 * 1024,
+)
+
+CARD_FORMATS = {
+    # kind: (extension, mimetype, scale, save options)
+    # zlib level 1: optimize=True took ~30 ms per preview for no smaller file
+    "preview": ("png", "image/png", PREVIEW_SCALE, {'format': 'PNG', 'compress_level': 1}),
+    "preview_webp": ("webp", "image/webp", PREVIEW_SCALE, {'format': 'WEBP', 'quality': 90, 'method': 4}),
+    "pdf": ("pdf", "application/pdf", 1.0, {'format': 'PDF'}),
+}
+
+def encode_card(student, kind: str) -> bytes:
+    _, _, scale, options = CARD_FORMATS[kind]
+    with stage("card.compose"):
+        img = compose_id_card(student, scale=scale)  # previews are drawn at PREVIEW_SIZE, not downsampled
+    buf = io.BytesIO()
+    with stage(f"card.encode_{kind}"):
+        img.save(buf, **options)
+    return buf.getvalue()
+
+def render_card_bytes(student, kind: str, key: str | None = None) -> tuple[bytes, str]:
+    """Return (encoded card, cache key), rendering only on a cache miss."""
+    ext = CARD_FORMATS[kind][0]
+    key = key or card_cache_key(student, kind)
+    data = card_cache.get(student["id"], key, ext)
+    if data is None:
+        data = encode_card(student, kind)
+        card_cache.put(student["id"], key, ext, data)
+    return data, key
+
+def card_response(student, kind: str, download_name: str | None = None):
+    """
+    Serve a rendered card with a strong ETag. A matching If-None-Match is
+    answered with 304 before the cache (or renderer) is touched at all.
+    """
+    mimetype = CARD_FORMATS[kind][1]
+    key = card_cache_key(student, kind)
+    if download_name is None and key in request.if_none_match:
+        resp = make_response("", 304)
+    else:
+        data, _ = render_card_bytes(student, kind, key)
+        resp = send_file(io.BytesIO(data), mimetype=mimetype, as_attachment=download_name is not None, download_name=download_name)
+    resp.set_etag(key)
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+# ---------------- Batch printing ----------------
+
+# Process-pool size for batch rendering (default: one per core)
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "0")) or os.cpu_count() or 1
+
+def render_card_jpeg(student: dict) -> tuple[int, bytes, int, int]:
+    """Process-pool worker: render one card to print-quality JPEG."""
+    img = compose_id_card(student)
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=95, subsampling=0)
+    return student["id"], buf.getvalue(), img.width, img.height
+
+def iter_rendered_cards(students: list[dict], render=render_card_jpeg, workers: int | None = None):
+    """
+    Yield render(student) for each student, in order, computed on a process
+    pool. At most a few tasks per worker are in flight so finished cards are
+    handed to the writer instead of piling up in memory.
+    """
+    workers = workers or BATCH_WORKERS
+    if workers <= 1 or len(students) <= 1:
+        for s in students:
+            yield render(s)
+        return
+    window = workers * 4
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        it = iter(students)
+        for s in it:
+            pending.append(pool.submit(render, s))
+            if len(pending) >= window:
+                break
+        while pending:
+            yield pending.popleft().result()
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append(pool.submit(render, nxt))
+
+def select_print_batch(conn, course: str = '', level: str = '', approved_only: bool = True, unprinted_only: bool = False) -> list[dict]:
+    sql = "SELECT * FROM users WHERE role='student'"
+    args = []
+    if course:
+        sql += " AND course=?"; args.append(course)
+    if level:
+        sql += " AND level=?"; args.append(level)
+    if approved_only:
+        sql += " AND is_approved=1"
+    if unprinted_only:
+        sql += " AND id_print_count=0"
+    sql += " ORDER BY course, level, full_name, id"
+    return [dict(r) for r in conn.execute(sql, args)]
+
+def iter_print_batch(students: list[dict], layout: str = 'single', workers: int | None = None,
+                     printed: list[int] | None = None):
+    """
+    Yield the bytes of one PDF of the students' cards, each page as soon as
+    it is written. Ids are appended to printed as their cards are added.
+    """
+    sink = ZipSink()
+    writer = PdfSheetWriter(sink, layout=layout)
+    for user_id, jpeg, w, h in iter_rendered_cards(students, workers=workers):
+        with stage("pdf.add_card"):
+            writer.add_card(jpeg, w, h)
+        if printed is not None:
+            printed.append(user_id)
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
+    writer.close()
+    yield sink.drain()
+
+def write_print_batch(fp, students: list[dict], layout: str = 'single', workers: int | None = None) -> list[int]:
+    """Render students into one PDF on fp; returns the ids that were written."""
+    printed = []
+    for chunk in iter_print_batch(students, layout, workers, printed):
+        fp.write(chunk)
+    return printed
+
+def record_prints(conn, user_ids: list[int], operator_id: int | None = None):
+    """
+    Bump id_print_count and append print_log rows for all ids in one
+    transaction. operator_id is the admin who printed (None: the student or CLI).
+    """
+    now = datetime.utcnow().isoformat()
+    with conn:
+        conn.executemany("UPDATE users SET id_print_count=id_print_count+1 WHERE id=?", [(i,) for i in user_ids])
+        conn.executemany("INSERT INTO print_log (user_id, printed_at, operator_id) VALUES (?,?,?)",
+                         [(i, now, operator_id) for i in user_ids])
+
+# ---------------- Card archive ----------------
+# A ZIP with one print-resolution file per card, named by reg no, for print
+# bureaus. Cards are rendered on the batch process pool a few ahead of the
+# writer and each one is sent as soon as it is stored, so neither the cards
+# nor the archive pile up in memory.
+
+CARD_DPI = 300  # CARD_SIZE is CR80 at this resolution
+ARCHIVE_FORMATS = ('png', 'pdf')
+ARCHIVE_MANIFEST = "manifest.csv"
+ARCHIVE_MANIFEST_FIELDS = ['file', 'reg_no', 'full_name', 'course', 'level', 'sex', 'blood_group', 'card_serial', 'expires']
+
+def render_card_file(student: dict, fmt: str = 'png') -> tuple[int, bytes]:
+    """Process-pool worker: render one card as a print-resolution PNG or PDF."""
+    img = compose_id_card(student)
+    buf = io.BytesIO()
+    if fmt == 'pdf':
+        img.save(buf, format='PDF', resolution=CARD_DPI)
+    else:
+        img.save(buf, format='PNG', dpi=(CARD_DPI, CARD_DPI))
+    return student["id"], buf.getvalue()
+
+def archive_names(students: list[dict], fmt: str) -> list[str]:
+    """One file name per student: the reg no made path-safe, unique within the archive."""
+    names, seen = [], set()
+    for s in students:
+        base = re.sub(r"[^A-Za-z0-9._-]+", "-", s['reg_no'] or '').strip('-.') or f"student-{s['id']}"
+        name = f"{base}.{fmt}"
+        if name in seen:
+            name = f"{base}_{s['id']}.{fmt}"
+        seen.add(name)
+        names.append(name)
+    return names
+
+def archive_manifest(students: list[dict], names: list[str]) -> bytes:
+    buf = io.StringIO(); w = csv.writer(buf)
+    w.writerow(ARCHIVE_MANIFEST_FIELDS)
+    for s, name in zip(students, names):
+        w.writerow([name, s['reg_no'], s['full_name'], s['course'], s['level'], s['sex'], s['blood_group'],
+                    s['card_serial'], card_expiry(s).isoformat()])
+    return buf.getvalue().encode('utf-8')
+
+def iter_card_archive(students: list[dict], fmt: str = 'png', manifest: bool = False,
+                      workers: int | None = None, printed: list[int] | None = None):
+    """
+    Yield the bytes of a ZIP of rendered cards. The manifest goes first, so
+    the download starts before the first card is drawn. Ids are appended to
+    printed as their cards are written.
+    """
+    names = archive_names(students, fmt)
+
+    def entries():
+        if manifest:
+            yield ARCHIVE_MANIFEST, archive_manifest(students, names), zipfile.ZIP_DEFLATED
+        render = functools.partial(render_card_file, fmt=fmt)
+        for name, (user_id, data) in zip(names, iter_rendered_cards(students, render=render, workers=workers)):
+            # PNG and PDF are compressed already; deflating them again only costs CPU
+            yield name, data, zipfile.ZIP_STORED
+            if printed is not None:
+                printed.append(user_id)
+
+    return iter_zip(entries())
+
+# ---------------- Render jobs ----------------
+# PDFs can be rendered off the request thread: a request enqueues a row in
+# render_jobs and gets a job id back, a small pool of worker threads claims
+# queued rows and writes the result under JOB_DIR. Because the queue lives in
+# SQLite, a separate `flask job-worker` process can drain it too.
+# A running job belongs to the worker that claimed it, which refreshes
+# heartbeat_at while it works; only jobs whose heartbeat went stale (the
+# worker died) are requeued, however long a big batch takes.
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = 1.0
+JOB_TTL = timedelta(hours=int(os.environ.get("JOB_TTL_HOURS", "24")))
+JOB_HEARTBEAT_SECONDS = 10
+JOB_STALE = timedelta(seconds=JOB_HEARTBEAT_SECONDS * 6)
+
+_job_wakeup = threading.Event()
+_job_threads: list[threading.Thread] = []
+_job_threads_lock = threading.Lock()
+
+def enqueue_job(conn, kind: str, requested_by: int, user_id: int | None = None,
+                params: dict | None = None, dedup_key: str | None = None) -> sqlite3.Row:
+    """
+    Queue a render job, or return the existing one for the same dedup_key:
+    any queued/running job, or a finished card job whose file still exists.
+    """
+    if dedup_key:
+        for job in conn.execute("SELECT * FROM render_jobs WHERE dedup_key=? AND status IN ('queued','running','done') ORDER BY created_at DESC", (dedup_key,)):
+            if job['status'] != 'done' or (kind == 'card' and job['result_path'] and os.path.exists(job['result_path'])):
+                return job
+    job_id = uuid.uuid4().hex
+    with conn:
+        conn.execute("""
+            INSERT INTO render_jobs (id, kind, user_id, requested_by, params, dedup_key, status, created_at)
+            VALUES (?,?,?,?,?,?,'queued',?)
+        """, (job_id, kind, user_id, requested_by, json.dumps(params) if params else None, dedup_key, datetime.utcnow().isoformat()))
+    start_job_workers()
+    _job_wakeup.set()
+    return conn.execute("SELECT * FROM render_jobs WHERE id=?", (job_id,)).fetchone()
+
+def job_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+def claim_job(conn, worker: str) -> sqlite3.Row | None:
+    """Atomically move the oldest queued job to running, owned by worker; safe across processes."""
+    while True:
+        row = conn.execute("SELECT id FROM render_jobs WHERE status='queued' ORDER BY created_at LIMIT 1").fetchone()
+        if row is None:
+            return None
+        now = datetime.utcnow().isoformat()
+        with conn:
+            cur = conn.execute("UPDATE render_jobs SET status='running', started_at=?, heartbeat_at=?, worker=? WHERE id=? AND status='queued'",
+                               (now, now, worker, row['id']))
+        if cur.rowcount == 1:
+            return conn.execute("SELECT * FROM render_jobs WHERE id=?", (row['id'],)).fetchone()
+
+def run_job(conn, job: sqlite3.Row) -> str:
+    out_path = os.path.join(JOB_DIR, f"{job['id']}.pdf")
+    tmp = f"{out_path}.{uuid.uuid4().hex}.tmp"
+    if job['kind'] == 'card':
+        u = conn.execute("SELECT * FROM users WHERE id=?", (job['user_id'],)).fetchone()
+        if not u:
+            raise ValueError("Student not found.")
+        data, _ = render_card_bytes(u, 'pdf')
+        with open(tmp, 'wb') as f:
+            f.write(data)
+    else:
+        p = json.loads(job['params'] or '{}')
+        students = select_print_batch(conn, p.get('course', ''), p.get('level', ''), approved_only=True, unprinted_only=bool(p.get('unprinted')))
+        if not students:
+            raise ValueError("No approved students match that filter.")
+        with open(tmp, 'wb') as f:
+            printed = write_print_batch(f, students, layout=p.get('layout', 'single'))
+        # a job that is rendered again (its first worker died) must not count its prints twice
+        with conn:
+            if conn.execute("UPDATE render_jobs SET prints_recorded=1 WHERE id=? AND prints_recorded=0", (job['id'],)).rowcount:
+                record_prints(conn, printed, job['requested_by'])
+    os.replace(tmp, out_path)
+    return out_path
+
+class JobHeartbeat:
+    """Refresh a running job's heartbeat_at from a side thread until the block ends."""
+
+    def __init__(self, job_id: str, worker: str):
+        self.job_id, self.worker = job_id, worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"{worker}-heartbeat", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def _run(self):
+        conn = connect_db()
+        try:
+            while not self._stop.wait(JOB_HEARTBEAT_SECONDS):
+                with conn:
+                    conn.execute("UPDATE render_jobs SET heartbeat_at=? WHERE id=? AND worker=? AND status='running'",
+                                 (datetime.utcnow().isoformat(), self.job_id, self.worker))
+        finally:
+            conn.close()
+
+def claim_chore(conn, task: str, every: timedelta) -> bool:
+    """True for exactly one caller per `every` across threads and processes, which then runs the task."""
+    now = datetime.utcnow()
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO maintenance (task, next_run) VALUES (?, '')", (task,))
+        cur = conn.execute("UPDATE maintenance SET next_run=? WHERE task=? AND next_run<=?",
+                           ((now + every).isoformat(), task, now.isoformat()))
+    return cur.rowcount == 1
+
+def prune_jobs(conn):
+    """Requeue running jobs whose worker stopped sending heartbeats and drop expired results."""
+    now = datetime.utcnow()
+    with conn:
+        conn.execute("UPDATE render_jobs SET status='queued', started_at=NULL, heartbeat_at=NULL, worker=NULL "
+                     "WHERE status='running' AND IFNULL(heartbeat_at, started_at)<?", ((now - JOB_STALE).isoformat(),))
+    expired = conn.execute("SELECT id, result_path FROM render_jobs WHERE status IN ('done','failed') AND finished_at<?",
+                           ((now - JOB_TTL).isoformat(),)).fetchall()
+    for job in expired:
+        if job['result_path']:
+            try:
+                os.remove(job['result_path'])
+            except OSError:
+                pass
+    with conn:
+        conn.executemany("DELETE FROM render_jobs WHERE id=?", [(j['id'],) for j in expired])
+
+def job_worker_loop(stop: threading.Event | None = None):
+    last_prune = 0.0
+    conn = get_db()
+    worker = job_worker_id()
+    while not (stop and stop.is_set()):
+        job = claim_job(conn, worker)
+        if job is None:
+            if time.monotonic() - last_prune > 60:
+                prune_jobs(conn); last_prune = time.monotonic()
+                if claim_chore(conn, 'blob_gc', BLOB_GC_INTERVAL):  # one sweep per interval across all workers
+                    gc_blobs(conn)
+            _job_wakeup.wait(JOB_POLL_SECONDS); _job_wakeup.clear()
+            continue
+        # finishing is owner-checked: a job requeued from under a stalled worker belongs to its new owner
+        try:
+            with JobHeartbeat(job['id'], worker):
+                path = run_job(conn, job)
+        except Exception as e:
+            with conn:
+                conn.execute("UPDATE render_jobs SET status='failed', error=?, finished_at=? WHERE id=? AND worker=?",
+                             (str(e) or e.__class__.__name__, datetime.utcnow().isoformat(), job['id'], worker))
+        else:
+            with conn:
+                conn.execute("UPDATE render_jobs SET status='done', result_path=?, finished_at=? WHERE id=? AND worker=?",
+                             (path, datetime.utcnow().isoformat(), job['id'], worker))
+
+def start_job_workers():
+    if len(_job_threads) >= JOB_WORKERS:
+        return
+    with _job_threads_lock:
+        while len(_job_threads) < JOB_WORKERS:
+            t = threading.Thread(target=job_worker_loop, name=f"render-job-{len(_job_threads)}", daemon=True)
+            t.start()
+            _job_threads.append(t)
+
+def job_status(conn, job: sqlite3.Row) -> dict:
+    out = {
+        'id': job['id'], 'kind': job['kind'], 'status': job['status'], 'error': job['error'],
+        'status_url': url_for('render_job_status', job_id=job['id']),
+    }
+    if job['status'] == 'queued':
+        out['position'] = conn.execute("SELECT COUNT(*) AS c FROM render_jobs WHERE status='queued' AND created_at<?",
+                                       (job['created_at'],)).fetchone()['c'] + 1
+    if job['status'] == 'done':
+        out['download_url'] = url_for('render_job_download', job_id=job['id'])
+    return out
+
+def load_job_for_viewer(job_id: str):
+    conn = get_db()
+    job = conn.execute("SELECT * FROM render_jobs WHERE id=?", (job_id,)).fetchone()
+    if not job:
+        abort(404)
+    if session.get('role') != 'admin' and session['user_id'] not in (job['requested_by'], job['user_id']):
+        abort(403)
+    return conn, job
+
+# ---------------- Upload ingest ----------------
+# Every upload is decoded once, EXIF-rotated and turned into small derivatives
+# stored next to the original (pass_<id>.card.png, pass_<id>.web.jpg, ...).
+# The card renderer and the file routes only ever open the derivatives.
+
+CARD_PHOTO_SIZE = (PHOTO_W - 16, PHOTO_H - 16)
+CARD_SIGN_SIZE = (280, 80)
+
+def _flatten(im: Image.Image) -> Image.Image:
+    from PIL import Image
+    if im.mode in ("RGBA", "LA", "P"):
+        im = im.convert("RGBA")
+        bg = Image.new("RGBA", im.size, "white")
+        return Image.alpha_composite(bg, im).convert("RGB")
+    return im.convert("RGB")
+
+def _card_photo(scale: float = 1.0):
+    size = (px(CARD_PHOTO_SIZE[0], scale), px(CARD_PHOTO_SIZE[1], scale))
+    def build(im: Image.Image) -> Image.Image:
+        from PIL import Image, ImageOps
+        return ImageOps.fit(im.convert("RGBA"), size, Image.LANCZOS)
+    return build
+
+def _card_signature(scale: float = 1.0):
+    def build(im: Image.Image) -> Image.Image:
+        from PIL import Image
+        im = im.convert("RGBA")
+        im.thumbnail(CARD_SIGN_SIZE, Image.LANCZOS)
+        # scaled from the card-size fit so both keep exactly the same proportions
+        return im if scale == 1.0 else im.resize((px(im.width, scale), px(im.height, scale)), Image.LANCZOS)
+    return build
+
+def _thumbnail(max_size: tuple[int, int]):
+    def build(im: Image.Image) -> Image.Image:
+        from PIL import Image
+        im = _flatten(im)
+        im.thumbnail(max_size, Image.LANCZOS)
+        return im
+    return build
+
+# WebP copies of the web derivatives, served to browsers that accept them.
+# Whether this Pillow build can write WebP is asked on first use, not at import.
+WEBP_VARIANTS = os.environ.get("WEBP_VARIANTS", "1") != "0"
+
+@functools.lru_cache(maxsize=None)
+def webp_enabled() -> bool:
+    from PIL import features
+    return WEBP_VARIANTS and features.check("webp")
+
+IMAGE_DERIVATIVES = {
+    # upload prefix: (JPEG draft size, {derivative: (extension, builder)})
+    'pass': ((880, 880), {'card': ('png', _card_photo()), 'preview': ('png', _card_photo(PREVIEW_SCALE)),
+                          'web': ('jpg', _thumbnail((440, 540)))}),
+    'sig': ((560, 560), {'card': ('png', _card_signature()), 'preview': ('png', _card_signature(PREVIEW_SCALE))}),
+    'receipt': ((1600, 1600), {'web': ('jpg', _thumbnail((1600, 1600)))}),
+}
+if WEBP_VARIANTS:
+    IMAGE_DERIVATIVES['pass'][1]['webp'] = ('webp', _thumbnail((440, 540)))
+    IMAGE_DERIVATIVES['receipt'][1]['webp'] = ('webp', _thumbnail((1600, 1600)))
+DERIVATIVE_SAVE_OPTIONS = {
+    'png': {'format': 'PNG'},
+    'jpg': {'format': 'JPEG', 'quality': 85, 'optimize': True},
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+}
+
+def derivative_path(path: str, name: str, ext: str) -> str:
+    return f"{os.path.splitext(path)[0]}.{name}.{ext}"
+
+def ingest_image(path: str, prefix: str) -> dict[str, str]:
+    """
+    Decode an upload once and write its derivatives. JPEGs are decoded at a
+    reduced scale (draft) since no derivative needs the full resolution.
+    Raises ValueError if the file is not a readable image.
+    """
+    from PIL import Image, ImageOps
+    draft_size, specs = IMAGE_DERIVATIVES[prefix]
+    try:
+        with stage("upload.decode"), Image.open(path) as im:
+            im.draft("RGB", draft_size)
+            im = ImageOps.exif_transpose(im)
+            im.load()
+    except Exception:
+        raise ValueError("Could not read image. Use a PNG or JPG photo.")
+    out = {}
+    for name, (ext, build) in specs.items():
+        if ext == 'webp' and not webp_enabled():
+            continue
+        dpath = derivative_path(path, name, ext)
+        tmp = f"{dpath}.{uuid.uuid4().hex}.tmp"
+        with stage(f"upload.derive_{prefix}_{name}"):
+            build(im).save(tmp, **DERIVATIVE_SAVE_OPTIONS[ext])
+        os.replace(tmp, dpath)
+        out[name] = dpath
+    return out
+
+def derived_file(path: str | None, prefix: str, name: str) -> str | None:
+    """Path of a derivative, creating it on first use for uploads that predate ingest."""
+    if not path or not os.path.exists(path):
+        return None
+    ext = IMAGE_DERIVATIVES[prefix][1][name][0]
+    dpath = derivative_path(path, name, ext)
+    if not os.path.exists(dpath):
+        try:
+            ingest_image(path, prefix)
+        except Exception:
+            return None
+    return dpath
+
+def card_asset(path: str | None, prefix: str, name: str = 'card') -> Image.Image | None:
+    """A photo or signature derivative sized for the card ('card') or the preview ('preview')."""
+    from PIL import Image
+    dpath = derived_file(path, prefix, name)
+    if not dpath:
+        return None
+    try:
+        return Image.open(dpath).convert("RGBA")
+    except Exception:
+        return None
+
+# ---------------- Upload streaming ----------------
+# Uploads are checked while they are copied into the blob store: the first
+# bytes must be a PNG or JPEG signature, the pixel size is read from the
+# header as soon as it has arrived and every kind of upload has a byte limit,
+# so a bad or oversized file is rejected before it is written out in full.
+# The camera and signature widgets post binary file parts; data URLs (older
+# pages, browsers without DataTransfer) are decoded a slice at a time.
+
+UPLOAD_LIMITS = {
+    'pass': int(float(os.environ.get("PASSPORT_MAX_MB", "8")) * 1024 * 1024),
+    'sig': int(float(os.environ.get("SIGNATURE_MAX_MB", "2")) * 1024 * 1024),
+    'receipt': int(float(os.environ.get("RECEIPT_MAX_MB", "10")) * 1024 * 1024),
+}
+MAX_IMAGE_PIXELS = int(float(os.environ.get("MAX_IMAGE_MEGAPIXELS", "50")) * 1_000_000)
+UPLOAD_CHUNK = 256 * 1024
+UPLOAD_HEADER_MAX = 256 * 1024  # JPEG EXIF blocks can push the frame header this far in
+PNG_SIGNATURE, JPEG_SIGNATURE = b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff"
+JPEG_SOF_MARKERS = frozenset((0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF))
+
+def image_header_info(head: bytes) -> tuple[str, int, int] | None:
+    """
+    (ext, width, height) from the first bytes of a PNG or JPEG, or None if
+    more bytes are needed. Raises ValueError for anything else.
+    """
+    if head.startswith(PNG_SIGNATURE):
+        if len(head) < 24:
+            return None
+        if head[12:16] != b"IHDR":
+            raise ValueError("Could not read image. Use a PNG or JPG photo.")
+        width, height = struct.unpack(">II", head[16:24])
+        return '.png', width, height
+    if head.startswith(JPEG_SIGNATURE):
+        i = 2
+        while i + 4 <= len(head):
+            if head[i] != 0xFF:
+                raise ValueError("Could not read image. Use a PNG or JPG photo.")
+            marker = head[i + 1]
+            if marker == 0xFF:  # fill byte
+                i += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # markers without a length
+                i += 2
+                continue
+            if marker in JPEG_SOF_MARKERS:
+                if i + 9 > len(head):
+                    return None
+                height, width = struct.unpack(">HH", head[i + 5:i + 9])
+                return '.jpg', width, height
+            i += 2 + struct.unpack(">H", head[i + 2:i + 4])[0]
+        return None
+    if len(head) < len(PNG_SIGNATURE) and (PNG_SIGNATURE.startswith(head) or JPEG_SIGNATURE.startswith(head)):
+        return None
+    raise ValueError("Only PNG/JPG allowed")
+
+class CheckedImageStream:
+    """
+    Wraps a readable upload and raises ValueError as soon as it is not a
+    PNG/JPEG, exceeds limit bytes or MAX_IMAGE_PIXELS. ext is set once the
+    header has been seen.
+    """
+
+    def __init__(self, fp, limit: int | None):
+        self.fp, self.limit = fp, limit
+        self.size = 0
+        self.ext: str | None = None
+        self._head = b""
+
+    def read(self, n: int = UPLOAD_CHUNK) -> bytes:
+        chunk = self.fp.read(n)
+        self.size += len(chunk)
+        if self.limit and self.size > self.limit:
+            raise ValueError(f"Image too large (max {self.limit // (1024 * 1024)} MB).")
+        if self.ext is None:
+            if chunk:
+                self._head += chunk
+                info = image_header_info(self._head)
+            else:
+                info = None
+            if info:
+                self.ext, width, height = info
+                if not width or not height or width * height > MAX_IMAGE_PIXELS:
+                    raise ValueError(f"Image dimensions {width}x{height} are not allowed.")
+                self._head = b""
+            elif not chunk or len(self._head) > UPLOAD_HEADER_MAX:
+                raise ValueError("Could not read image. Use a PNG or JPG photo.")
+        return chunk
+
+class Base64Reader:
+    """File-like view of base64 text that decodes a slice per read() instead of all at once."""
+
+    def __init__(self, text: str, start: int = 0):
+        self.text, self.pos = text, start
+
+    def read(self, n: int = UPLOAD_CHUNK) -> bytes:
+        chars = max(4, n // 3 * 4)
+        piece = self.text[self.pos:self.pos + chars]
+        self.pos += len(piece)
+        try:
+            return base64.b64decode(piece, validate=True)
+        except (binascii.Error, ValueError):
+            raise ValueError("Invalid image data") from None
+
+DATA_URL_HEADER = re.compile(r"data:image/(png|jpeg|jpg);base64")
+
+def data_url_reader(data_url: str, limit: int | None) -> Base64Reader:
+    head, sep, _ = data_url[:40].partition(',')
+    if not sep or not DATA_URL_HEADER.fullmatch(head):
+        raise ValueError("Invalid image data")
+    if limit and (len(data_url) - len(head) - 1) // 4 * 3 > limit + 2:
+        raise ValueError(f"Image too large (max {limit // (1024 * 1024)} MB).")
+    return Base64Reader(data_url, len(head) + 1)
+
+# ---------------- Blob store ----------------
+# Uploads are stored by content: <dir>/<h[:2]>/<h[2:4]>/<prefix>_<h><ext> with
+# h = sha256 of the bytes, so identical images are kept once and no directory
+# grows without bound. Nothing deletes blobs eagerly (another student may
+# share one); gc_blobs() sweeps a few shard directories per run and removes
+# originals no users row points at, together with their derivatives.
+
+BLOB_HASH_CHARS = 32
+BLOB_DIRS = (UPLOAD_DIR, SIGN_DIR, RECEIPT_DIR)
+BLOB_GC_GRACE_SECONDS = int(os.environ.get("BLOB_GC_GRACE_SECONDS", "3600"))
+BLOB_GC_SHARDS_PER_RUN = int(os.environ.get("BLOB_GC_SHARDS_PER_RUN", "8"))
+BLOB_GC_STATE = os.path.join("cache", "blob_gc.json")
+BLOB_GC_INTERVAL = timedelta(seconds=int(os.environ.get("BLOB_GC_INTERVAL_SECONDS", "60")))
+_blob_gc_lock = threading.Lock()
+
+def store_blob(prefix: str, fp, out_dir: str) -> tuple[str, bool]:
+    """
+    Store an image stream by content hash; returns (path, created). The
+    extension comes from the file signature, and the stream is checked
+    against UPLOAD_LIMITS[prefix] as it is copied (ValueError on failure).
+    Re-storing a blob refreshes its mtime.
+    """
+    src = CheckedImageStream(fp, UPLOAD_LIMITS.get(prefix))
+    h = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    try:
+        with stage("upload.write"), os.fdopen(fd, 'wb') as f:
+            while chunk := src.read(UPLOAD_CHUNK):
+                h.update(chunk)
+                f.write(chunk)
+        digest = h.hexdigest()[:BLOB_HASH_CHARS]
+        shard = os.path.join(out_dir, digest[:2], digest[2:4])
+        path = os.path.join(shard, f"{prefix}_{digest}{src.ext}")
+        if os.path.exists(path):
+            os.utime(path)  # keeps the GC grace period from expiring under a new reference
+            os.remove(tmp)
+            return path, False
+        os.makedirs(shard, exist_ok=True)
+        os.replace(tmp, path)
+        return path, True
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def save_image_stream(prefix: str, fp, out_dir: str) -> str:
+    """Store an image stream in the blob store and make sure its derivatives exist."""
+    path, created = store_blob(prefix, fp, out_dir)
+    if not created and all(os.path.exists(derivative_path(path, n, e)) for n, (e, _) in IMAGE_DERIVATIVES[prefix][1].items()):
+        return path
+    try:
+        ingest_image(path, prefix)
+    except ValueError:
+        if created:
+            os.remove(path)
+        raise
+    return path
+
+def referenced_files(conn, paths) -> set[str]:
+    """
+    Which of paths (normalised) a users row points at, looked up through the
+    idx_users_*_path indexes so the cost follows len(paths), not the table.
+    Both separators are asked for: rows written on Windows hold backslashes.
+    """
+    want = {os.path.normpath(p.replace('\\', '/')) for p in paths if p}
+    variants = sorted({v for p in want for v in (p.replace('\\', '/'), p.replace('/', '\\'))})
+    refs = set()
+    for i in range(0, len(variants), 300):
+        chunk = variants[i:i + 300]
+        marks = ','.join('?' * len(chunk))
+        for (p,) in conn.execute(f"""
+            SELECT passport_path FROM users WHERE passport_path IN ({marks})
+            UNION SELECT signature_path FROM users WHERE signature_path IN ({marks})
+            UNION SELECT receipt_path FROM users WHERE receipt_path IN ({marks})
+        """, chunk * 3):
+            refs.add(os.path.normpath(p.replace('\\', '/')))
+    return refs
+
+def blob_shards() -> list[str]:
+    """Every directory the GC walks: each store's top level (older uuid-named uploads) and its shards."""
+    shards = []
+    for d in BLOB_DIRS:
+        shards.append(d)
+        for a in sorted(os.listdir(d)):
+            if len(a) == 2 and os.path.isdir(os.path.join(d, a)):
+                shards.extend(os.path.join(d, a, b) for b in sorted(os.listdir(os.path.join(d, a))) if len(b) == 2)
+    return shards
+
+def gc_blobs(conn, max_shards: int | None = BLOB_GC_SHARDS_PER_RUN, grace: int = BLOB_GC_GRACE_SECONDS,
+             dry_run: bool = False) -> dict:
+    """
+    Sweep the next max_shards shard directories (None = all) and delete
+    unreferenced originals, orphaned derivatives and stale temp files older
+    than grace seconds. Progress is kept in BLOB_GC_STATE between runs.
+    """
+    if not _blob_gc_lock.acquire(blocking=False):
+        return {'skipped': True}
+    try:
+        try:
+            with open(BLOB_GC_STATE) as f:
+                cursor = json.load(f).get('cursor', '')
+        except (OSError, ValueError):
+            cursor = ''
+        shards = blob_shards()
+        start = next((i + 1 for i, sh in enumerate(shards) if sh == cursor), 0)
+        todo = shards[start:] + shards[:start]
+        if max_shards is not None:
+            todo = todo[:max_shards]
+        cutoff = time.time() - grace
+        report = {'shards': len(todo), 'scanned': 0, 'removed': 0, 'freed_bytes': 0}
+        for shard in todo:
+            entries = [(e, e.stat()) for e in os.scandir(shard) if e.is_file()]
+            originals = [(e, st) for e, st in entries if e.name.count('.') == 1 and not e.name.endswith('.tmp')]
+            refs = referenced_files(conn, [e.path for e, st in originals if st.st_mtime <= cutoff])
+            # stem -> whether that original may go (unreferenced and past the grace period)
+            originals = {e.name.split('.')[0]: st.st_mtime <= cutoff and os.path.normpath(e.path) not in refs
+                         for e, st in originals}
+            for e, st in entries:
+                report['scanned'] += 1
+                if st.st_mtime > cutoff:
+                    continue
+                if e.name.endswith('.tmp'):
+                    dead = True
+                else:  # an original, or a derivative <stem>.<name>.<ext> that goes with it
+                    dead = originals.get(e.name.split('.')[0], True)
+                if dead:
+                    report['removed'] += 1
+                    report['freed_bytes'] += st.st_size
+                    if not dry_run:
+                        try:
+                            os.remove(e.path)
+                        except OSError:
+                            pass
+        if todo and not dry_run:
+            with open(BLOB_GC_STATE, 'w') as f:
+                json.dump({'cursor': todo[-1]}, f)
+        return report
+    finally:
+        _blob_gc_lock.release()
+
+def release_blobs(conn, paths, grace: int = BLOB_GC_GRACE_SECONDS) -> int:
+    """
+    Delete uploads (with their derivatives) that no users row points at any
+    more, e.g. right after students were deleted; call it once that
+    transaction has committed. Files touched within grace seconds are left to
+    gc_blobs, since an upload in flight may be about to reference them.
+    """
+    paths = {os.path.normpath(p.replace('\\', '/')) for p in paths if p}
+    refs = referenced_files(conn, paths)
+    cutoff = time.time() - grace
+    removed = 0
+    for path in paths:
+        try:
+            if path in refs or os.stat(path).st_mtime > cutoff:
+                continue
+        except OSError:
+            continue
+        specs = IMAGE_DERIVATIVES.get(os.path.basename(path).split('_', 1)[0], (None, {}))[1]
+        for f in [path, *(derivative_path(path, name, ext) for name, (ext, _) in specs.items())]:
+            try:
+                os.remove(f)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
 def save_upload_or_data(prefix: str, file_storage, data_url: str, out_dir: str) -> str | None:
     """
     Save either an uploaded file (file_storage) or a base64 data_url (string).
     Returns the saved file path or None.
     """
-    path = None
     if file_storage and getattr(file_storage, 'filename', ''):
-        ext = os.path.splitext(file_storage.filename)[1].lower()
-        if ext not in [".png", ".jpg", ".jpeg"]:
-            raise ValueError("Only PNG/JPG allowed")
-        fname = f"{prefix}_{uuid.uuid4().hex}{ext}"
-        path = os.path.join(out_dir, fname)
-        file_storage.save(path)
+        return save_image_stream(prefix, file_storage.stream, out_dir)
     elif data_url:
-        m = re.match(r"^data:image/(png|jpeg|jpg);base64,(.+)$", data_url)
-        if not m:
-            raise ValueError("Invalid image data")
-        ext = ".png" if m.group(1) == "png" else ".jpg"
-        raw = base64.b64decode(m.group(2))
-        fname = f"{prefix}_{uuid.uuid4().hex}{ext}"
-        path = os.path.join(out_dir, fname)
-        with open(path, 'wb') as f:
-            f.write(raw)
-    return path
+        return save_image_stream(prefix, data_url_reader(data_url, UPLOAD_LIMITS.get(prefix)), out_dir)
+    return None
+
+# ---------------- User file serving ----------------
+# Uploads are stored under uuid names and never rewritten in place, so a URL
+# carrying ?v=<file_token(path)> can be cached by the browser for good; a new
+# upload gets a new path and therefore a new token. Without a matching token
+# responses are revalidated with a strong ETag (304 when unchanged).
+
+FILE_MAX_AGE = 365 * 24 * 3600
+
+def file_token(path: str | None) -> str:
+    return hashlib.sha1(os.path.basename(path).encode()).hexdigest()[:12] if path else ''
+
+app.jinja_env.globals['file_token'] = file_token
+
+def logo_token() -> str:
+    # the logo keeps its path when replaced, so its token follows the file itself
+    return hashlib.sha1(_file_identity(SCHOOL_LOGO).encode()).hexdigest()[:12]
+
+app.jinja_env.globals['logo_token'] = logo_token
+
+def file_etag(path: str, st: os.stat_result) -> str:
+    return hashlib.sha1(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:20]
+
+def send_cached_file(path: str, token: str, public: bool = False, vary_accept: bool = False):
+    """
+    send_file with a strong ETag, Last-Modified and Range support. A matching
+    If-None-Match is answered before the file is opened. ?v=<token> responses
+    are marked immutable.
+    """
+    st = os.stat(path)
+    etag = file_etag(path, st)
+    if etag in request.if_none_match:
+        resp = make_response("", 304)
+        resp.set_etag(etag)
+    else:
+        resp = send_file(path, etag=etag, last_modified=st.st_mtime, conditional=True)
+    if token and request.args.get('v') == token:
+        resp.cache_control.max_age = FILE_MAX_AGE
+        resp.cache_control.immutable = True
+        resp.cache_control.no_cache = None
+    else:
+        resp.cache_control.no_cache = True
+    if public:
+        resp.cache_control.public = True
+    else:
+        resp.cache_control.private = True
+    if vary_accept:
+        resp.vary.add('Accept')
+    return resp
+
+def send_upload(path: str, prefix: str):
+    """An upload's web derivative (WebP when the browser takes it), or the original with ?size=full."""
+    token = file_token(path)
+    if request.args.get('size') == 'full':
+        return send_cached_file(path, token)
+    if webp_enabled() and 'image/webp' in request.headers.get('Accept', ''):
+        webp = derived_file(path, prefix, 'webp')
+        if webp:
+            return send_cached_file(webp, token, vary_accept=True)
+    return send_cached_file(derived_file(path, prefix, 'web') or path, token, vary_accept=webp_enabled())
+
+def user_file_path(user_id: int, column: str) -> str | None:
+    row = get_db().execute(f"SELECT {column} FROM users WHERE id=?", (user_id,)).fetchone()
+    path = row[0] if row else None
+    return path if path and os.path.exists(path) else None
+
+# ---------------- Card verification ----------------
+# Gate scanners check cards against an in-memory reg_no -> status map instead
+# of querying SQLite per scan. The map is loaded once and then brought up to
+# date from user_changes (filled by triggers) at most every
+# VERIFY_REFRESH_SECONDS, so a scan costs a dict lookup.
+
+VERIFY_REFRESH_SECONDS = float(os.environ.get("VERIFY_REFRESH_SECONDS", "2"))
+VERIFY_API_TOKEN = os.environ.get("VERIFY_API_TOKEN", "")
+VERIFY_BATCH_MAX = 5000
+USER_CHANGES_KEEP_SECONDS = 3600
+VERIFY_COLUMNS = "id, reg_no, full_name, course, level, is_approved, id_print_count, card_serial"
+
+class VerifyIndex:
+    def __init__(self, refresh_seconds: float = VERIFY_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._by_reg: dict[str, dict] = {}
+        self._reg_of: dict[int, str] = {}
+        self._seq = -1  # last user_changes.seq applied; -1 = never loaded
+        self._checked = 0.0
+        self._pruned = 0.0
+        self._lock = threading.Lock()
+
+    def lookup(self, reg_no: str) -> dict | None:
+        self.refresh()
+        return self._by_reg.get(reg_no.strip().upper())
+
+    def refresh(self, force: bool = False):
+        """Apply pending changes. Other threads keep serving the old map meanwhile."""
+        if not force and self._seq >= 0 and time.monotonic() - self._checked < self.refresh_seconds:
+            return
+        if not self._lock.acquire(blocking=self._seq < 0 or force):
+            return
+        try:
+            conn = connect_db()
+            try:
+                conn.execute("BEGIN")  # one snapshot for the change scan and the reload
+                self._apply(conn)
+                conn.commit()
+                if time.monotonic() - self._pruned > 600:
+                    with conn:
+                        conn.execute("DELETE FROM user_changes WHERE changed_at<?", (int(time.time()) - USER_CHANGES_KEEP_SECONDS,))
+                    self._pruned = time.monotonic()
+            finally:
+                conn.close()
+            self._checked = time.monotonic()
+        finally:
+            self._lock.release()
+
+    def _apply(self, conn):
+        top = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='user_changes'").fetchone()
+        top = top[0] if top else 0
+        if top == self._seq:
+            return
+        oldest = conn.execute("SELECT MIN(seq) FROM user_changes").fetchone()[0]
+        if self._seq < 0 or oldest is None or oldest > self._seq + 1:
+            # first load, or changes we never saw were pruned: start over
+            by_reg, reg_of = {}, {}
+            for row in conn.execute(f"SELECT {VERIFY_COLUMNS} FROM users WHERE role='student' AND reg_no IS NOT NULL"):
+                by_reg[row['reg_no'].upper()] = self._entry(row)
+                reg_of[row['id']] = row['reg_no'].upper()
+            self._by_reg, self._reg_of = by_reg, reg_of
+        else:
+            ids = [r[0] for r in conn.execute("SELECT DISTINCT user_id FROM user_changes WHERE seq>? AND seq<=?", (self._seq, top))]
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = {r['id']: r for r in conn.execute(
+                    f"SELECT {VERIFY_COLUMNS} FROM users WHERE role='student' AND id IN ({','.join('?' * len(chunk))})", chunk)}
+                for uid in chunk:
+                    old = self._reg_of.pop(uid, None)
+                    if old is not None and self._by_reg.get(old, {}).get('id') == uid:
+                        del self._by_reg[old]
+                    row = rows.get(uid)
+                    if row is not None and row['reg_no']:
+                        self._by_reg[row['reg_no'].upper()] = self._entry(row)
+                        self._reg_of[uid] = row['reg_no'].upper()
+        self._seq = top
+
+    @staticmethod
+    def _entry(row) -> dict:
+        return {'id': row['id'], 'reg_no': row['reg_no'], 'full_name': row['full_name'], 'course': row['course'],
+                'level': row['level'], 'approved': bool(row['is_approved']), 'print_count': row['id_print_count'] or 0,
+                'card_serial': row['card_serial']}
+
+verify_index = VerifyIndex()
+
+def scanned_reg_no(code: str) -> str:
+    """Reg no from a scanned card QR ("REG:...\nName: ...") or a typed/barcode reg no."""
+    code = (code or '').strip()
+    m = re.search(r"REG:\s*([^\n|]*)", code)
+    return (m.group(1) if m else code).strip().upper()
+
+def student_card_reason(entry: dict) -> str | None:
+    """Why a known student's card does not let them in, or None; the same rule for every kind of scan."""
+    if not entry['approved']:
+        return 'not approved'
+    if entry['print_count'] <= 0:
+        return 'not printed'  # e.g. a code taken from the web preview
+    return None
+
+def verify_scan(code: str) -> dict:
+    if (code or '').lstrip().startswith(CARD_CODE_PREFIX):
+        return verify_signed_scan(code.lstrip())
+    reg_no = scanned_reg_no(code)
+    entry = verify_index.lookup(reg_no) if reg_no else None
+    if entry is None:
+        return {'reg_no': reg_no, 'exists': False, 'approved': False, 'print_count': 0, 'valid': False}
+    out = {**{k: v for k, v in entry.items() if k != 'id'}, 'exists': True}
+    reason = student_card_reason(entry)
+    out['valid'] = reason is None
+    if reason:
+        out['reason'] = reason
+    return out
+
+def verify_signed_scan(code: str) -> dict:
+    """A signed card code: signature and expiry first, then the live record (revocation = serial superseded)."""
+    checked = get_card_verifier().verify(code)
+    reg_no = checked.get('reg_no', '')
+    if 'serial' not in checked:
+        return {'reg_no': reg_no, 'exists': False, 'approved': False, 'print_count': 0, 'valid': False, 'reason': checked['reason']}
+    entry = verify_index.lookup(reg_no)
+    out = {'reg_no': reg_no, 'serial': checked['serial'], 'expires': checked['expires'], 'exists': entry is not None,
+           'approved': False, 'print_count': 0}
+    if entry is not None:
+        out.update({k: v for k, v in entry.items() if k != 'id'})
+    reason = checked.get('reason')
+    if reason is None:
+        if entry is None:
+            reason = 'unknown student'
+        elif entry['card_serial'] != checked['serial']:
+            reason = 'revoked'
+        else:
+            reason = student_card_reason(entry)
+    out['valid'] = reason is None
+    if reason:
+        out['reason'] = reason
+    return out
+
+def build_verify_bundle(conn) -> dict:
+    revoked = [r[0] for r in conn.execute("SELECT serial FROM card_serials WHERE revoked_at IS NOT NULL")]
+    return get_card_signer().bundle(revoked, datetime.utcnow().isoformat(timespec='seconds') + 'Z')
+
+def verify_allowed() -> bool:
+    if session.get("role") == "admin":
+        return True
+    if not VERIFY_API_TOKEN:
+        return False
+    auth = request.headers.get("Authorization", "")
+    token = auth[7:] if auth.startswith("Bearer ") else request.headers.get("X-Verify-Token", "")
+    return hmac.compare_digest(token.encode(), VERIFY_API_TOKEN.encode())
+
+# ---------------- Roster import ----------------
+# Bulk student creation from a CSV roster. Rows are validated as they stream
+# in, passwords are hashed on a process pool, and each batch is inserted with
+# one executemany in one transaction. Conflicts are reported per row.
+
+IMPORT_BATCH = 1000
+# werkzeug hash method for imported passwords, e.g. "pbkdf2:sha256:100000".
+# Empty keeps werkzeug's default (scrypt), which costs ~150ms per row and core.
+IMPORT_HASH_METHOD = os.environ.get("IMPORT_HASH_METHOD") or None
+# Rows the web form takes in one request: hashing is the slow part, and a
+# request must finish well inside the proxy timeout. Larger rosters go
+# through `flask import-roster`.
+IMPORT_WEB_MAX_ROWS = int(os.environ.get("IMPORT_WEB_MAX_ROWS", "500"))
+ROSTER_FIELDS = ['full_name', 'sex', 'dob', 'blood_group', 'course', 'reg_no', 'level', 'email', 'password']
+ROSTER_ALIASES = {
+    'name': 'full_name', 'fullname': 'full_name', 'regno': 'reg_no', 'registration_number': 'reg_no',
+    'matric_no': 'reg_no', 'date_of_birth': 'dob', 'gender': 'sex', 'bloodgroup': 'blood_group',
+}
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+def _hash_password(args: tuple[str, str | None]) -> str:
+    password, method = args
+    return generate_password_hash(password, method=method) if method else generate_password_hash(password)
+
+def _photo_key(name: str) -> str:
+    """Match key for reg nos and photo file names: 'AOP/CS/001' ~ 'aop-cs-001.jpg'."""
+    return re.sub(r"[^A-Z0-9]", "", name.upper())
+
+def _roster_header(fields: list[str]) -> list[str]:
+    out = []
+    for f in fields:
+        key = re.sub(r"[^a-z0-9]+", "_", (f or '').strip().lower()).strip('_')
+        out.append(ROSTER_ALIASES.get(key, key))
+    return out
+
+def _validate_roster_row(raw: dict, default_password: str) -> tuple[dict | None, str | None]:
+    row = {k: (raw.get(k) or '').strip() for k in ROSTER_FIELDS}
+    row['reg_no'] = row['reg_no'].upper()
+    row['email'] = row['email'].lower()
+    row['password'] = row['password'] or default_password
+    if not row['full_name']:
+        return None, "Missing full name"
+    if not row['reg_no']:
+        return None, "Missing reg no"
+    if not EMAIL_RE.match(row['email']):
+        return None, "Missing or invalid email"
+    if not row['password']:
+        return None, "No password and no default password given"
+    return row, None
+
+def _import_batch(conn, batch: list[tuple[int, dict]], pool, hash_method: str | None, photos, report: dict):
+    # conflicts with existing accounts, looked up through the unique indexes
+    regs = [r['reg_no'] for _, r in batch]
+    emails = [r['email'] for _, r in batch]
+    taken_regs, taken_emails = set(), set()
+    for i in range(0, len(batch), 400):
+        marks = ','.join('?' * len(regs[i:i + 400]))
+        taken_regs.update(r[0] for r in conn.execute(f"SELECT reg_no FROM users WHERE reg_no IN ({marks})", regs[i:i + 400]))
+        taken_emails.update(r[0] for r in conn.execute(f"SELECT email FROM users WHERE email IN ({marks})", emails[i:i + 400]))
+    ok = []
+    for line, r in batch:
+        if r['reg_no'] in taken_regs:
+            report['errors'].append((line, r['reg_no'], "Reg No already exists"))
+        elif r['email'] in taken_emails:
+            report['errors'].append((line, r['reg_no'], "Email already exists"))
+        else:
+            ok.append((line, r))
+    if not ok:
+        return
+    passwords = [(r['password'], hash_method) for _, r in ok]
+    hashes = list(pool.map(_hash_password, passwords, chunksize=16)) if pool else [_hash_password(p) for p in passwords]
+    passport_paths = [photos.pop(_photo_key(r['reg_no']), None) if photos else None for _, r in ok]
+    now = datetime.utcnow().isoformat()
+    values = [('student', r['full_name'], r['sex'], r['dob'], r['blood_group'], r['course'], r['reg_no'], r['level'],
+               r['email'], h, p, now) for (_, r), h, p in zip(ok, hashes, passport_paths)]
+    sql = """
+        INSERT INTO users (role, full_name, sex, dob, blood_group, course, reg_no, level, email, password_hash, passport_path, created_at)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
+    """
+    try:
+        with conn:
+            conn.executemany(sql, values)
+        report['inserted'] += len(values)
+    except sqlite3.IntegrityError:
+        # someone registered one of these meanwhile: fall back to row by row
+        for (line, r), v in zip(ok, values):
+            try:
+                with conn:
+                    conn.execute(sql, v)
+                report['inserted'] += 1
+            except sqlite3.IntegrityError:
+                report['errors'].append((line, r['reg_no'], "Email or Reg No already exists"))
+    report['photos'] += sum(1 for p in passport_paths if p)
+
+def _extract_photos(zip_fp, workers: int) -> dict[str, str]:
+    """Store every PNG/JPG in the zip as a passport upload; returns photo key -> path."""
+    found: dict[str, str] = {}
+    fresh: set[str] = set()
+    with zipfile.ZipFile(zip_fp) as zf:
+        for info in zf.infolist():
+            base, ext = os.path.splitext(os.path.basename(info.filename))
+            ext = ext.lower()
+            if info.is_dir() or ext not in (".png", ".jpg", ".jpeg") or base.startswith('.'):
+                continue
+            try:
+                with zf.open(info) as src:
+                    path, created = store_blob('pass', src, UPLOAD_DIR)
+            except ValueError:
+                continue  # not an image or too large; the student shows up without a photo
+            found[_photo_key(base)] = path
+            if created:
+                fresh.add(path)
+    paths = list(found.values())
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_ingest_or_none, paths, chunksize=8))
+    else:
+        results = [_ingest_or_none(p) for p in paths]
+    for key, path, good in zip(list(found), paths, results):
+        if not good:
+            if path in fresh and os.path.exists(path):
+                os.remove(path)
+            del found[key]
+    return found
+
+def _ingest_or_none(path: str) -> bool:
+    try:
+        ingest_image(path, 'pass')
+        return True
+    except ValueError:
+        return False
+
+def import_roster(conn, text_fp, default_password: str = '', photos_zip=None,
+                  hash_method: str | None = None, workers: int | None = None) -> dict:
+    """
+    Import students from a CSV roster (header row required). Returns a report:
+    inserted count, per-row errors as (line, reg_no, message), matched photos.
+    """
+    t0 = time.perf_counter()
+    workers = workers or BATCH_WORKERS
+    hash_method = hash_method or IMPORT_HASH_METHOD
+    report = {'inserted': 0, 'errors': [], 'photos': 0, 'rows': 0}
+    photos = _extract_photos(photos_zip, workers) if photos_zip else {}
+    reader = csv.reader(text_fp)
+    header = _roster_header(next(reader, []))
+    if 'reg_no' not in header or 'email' not in header or 'full_name' not in header:
+        raise ValueError("Roster needs at least full_name, reg_no and email columns.")
+    seen_regs, seen_emails = set(), set()
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        batch = []
+        for line, cells in enumerate(reader, start=2):
+            if not any(c.strip() for c in cells):
+                continue
+            report['rows'] += 1
+            row, err = _validate_roster_row(dict(zip(header, cells)), default_password)
+            if err:
+                report['errors'].append((line, (row or {}).get('reg_no') or dict(zip(header, cells)).get('reg_no', ''), err)); continue
+            if row['reg_no'] in seen_regs:
+                report['errors'].append((line, row['reg_no'], "Duplicate Reg No in file")); continue
+            if row['email'] in seen_emails:
+                report['errors'].append((line, row['reg_no'], "Duplicate email in file")); continue
+            seen_regs.add(row['reg_no']); seen_emails.add(row['email'])
+            batch.append((line, row))
+            if len(batch) >= IMPORT_BATCH:
+                _import_batch(conn, batch, pool, hash_method, photos, report); batch = []
+        if batch:
+            _import_batch(conn, batch, pool, hash_method, photos, report)
+    finally:
+        if pool:
+            pool.shutdown()
+        # photos nobody in the roster matched are left to gc_blobs()
+    report['seconds'] = round(time.perf_counter() - t0, 2)
+    report['rows_per_sec'] = round(report['rows'] / report['seconds'], 1) if report['seconds'] else None
+    return report
 
 # ---------------- Routes ----------------
 
@@ -270,14 +2253,13 @@ def home():
     conn = get_db()
     cur = conn.execute("SELECT COUNT(*) AS c FROM users WHERE role='admin'")
     no_admin = cur.fetchone()["c"] == 0
-    conn.close()
     return render_template("home.html", logo_exists=os.path.exists(SCHOOL_LOGO), no_admin=no_admin)
 
 @app.route('/logo')
 def school_logo():
     if not os.path.exists(SCHOOL_LOGO):
         abort(404)
-    return send_file(SCHOOL_LOGO)
+    return send_cached_file(SCHOOL_LOGO, logo_token(), public=True)
 
 @app.route('/login/student', methods=['GET','POST'])
 def login_student():
@@ -286,8 +2268,8 @@ def login_student():
         pwd = request.form.get('password','')
         conn = get_db()
         cur = conn.execute("SELECT * FROM users WHERE role='student' AND email=?", (email,))
-        row = cur.fetchone(); conn.close()
-        if row and check_password_hash(row["password_hash"], pwd):
+        row = cur.fetchone()
+        if row and check_password(row["password_hash"], pwd):
             session['user_id'] = row['id']; session['role'] = 'student'
             return redirect(url_for('student_dashboard'))
         flash('Invalid credentials')
@@ -300,8 +2282,8 @@ def login_admin():
         pwd = request.form.get('password','')
         conn = get_db()
         cur = conn.execute("SELECT * FROM users WHERE role='admin' AND email=?", (email,))
-        row = cur.fetchone(); conn.close()
-        if row and check_password_hash(row["password_hash"], pwd):
+        row = cur.fetchone()
+        if row and check_password(row["password_hash"], pwd):
             session['user_id'] = row['id']; session['role'] = 'admin'
             return redirect(url_for('admin_dashboard'))
         flash('Invalid credentials')
@@ -325,11 +2307,11 @@ def register_student():
         email = f.get('email','').strip().lower()
         password = f.get('password','')
         try:
-            signature_path = save_upload_or_data('sig', request.files.get('signature_file'), f.get('signature_data',''), SIGN_DIR)
+            signature_path = save_upload_or_data('sig', request.files.get('signature_file') or request.files.get('sig_file'), f.get('signature_data',''), SIGN_DIR)
         except Exception as e:
             flash(str(e)); return redirect(url_for('register_student'))
         try:
-            passport_path = save_upload_or_data('pass', request.files.get('passport_file'), f.get('shot_data',''), UPLOAD_DIR)
+            passport_path = save_upload_or_data('pass', request.files.get('passport_file') or request.files.get('shot_file'), f.get('shot_data',''), UPLOAD_DIR)
         except Exception as e:
             flash(str(e)); return redirect(url_for('register_student'))
         if not passport_path:
@@ -342,18 +2324,16 @@ def register_student():
                 conn.execute("""
                     INSERT INTO users (role, full_name, sex, dob, blood_group, course, reg_no, level, email, password_hash, passport_path, signature_path, created_at)
                     VALUES ('student',?,?,?,?,?,?,?,?,?,?,?,?)
-                """, (full_name, sex, dob, blood_group, course, reg_no, level, email, generate_password_hash(password), passport_path, signature_path, datetime.utcnow().isoformat()))
+                """, (full_name, sex, dob, blood_group, course, reg_no, level, email, hash_password(password), passport_path, signature_path, datetime.utcnow().isoformat()))
         except sqlite3.IntegrityError as e:
             flash('Email or Reg No already exists.'); return redirect(url_for('register_student'))
-        finally:
-            conn.close()
         flash('Account created. Please login.')
         return redirect(url_for('login_student'))
     return render_template("reg_student.html")
 
 @app.route('/register/admin', methods=['GET','POST'])
 def register_admin():
-    conn = get_db(); cur = conn.execute("SELECT COUNT(*) AS c FROM users WHERE role='admin'"); no_admin = cur.fetchone()['c']==0; conn.close()
+    conn = get_db(); cur = conn.execute("SELECT COUNT(*) AS c FROM users WHERE role='admin'"); no_admin = cur.fetchone()['c']==0
     if not no_admin and session.get('role') != 'admin':
         flash('Only admin can create another admin.'); return redirect(url_for('home'))
     if request.method == 'POST':
@@ -365,11 +2345,9 @@ def register_admin():
         try:
             with conn:
                 conn.execute("INSERT INTO users (role, full_name, email, password_hash, created_at) VALUES ('admin',?,?,?,?)",
-                             (full_name, email, generate_password_hash(password), datetime.utcnow().isoformat()))
+                             (full_name, email, hash_password(password), datetime.utcnow().isoformat()))
         except sqlite3.IntegrityError:
             flash('Admin with this email already exists.'); return redirect(url_for('register_admin'))
-        finally:
-            conn.close()
         flash('Admin created.')
         return redirect(url_for('login_admin'))
     return render_template("reg_admin.html")
@@ -381,7 +2359,7 @@ def register_student_admin():
         f = request.form
         vals = (
             'student', f.get('full_name',''), f.get('sex',''), f.get('dob',''), f.get('blood_group',''), f.get('course',''),
-            f.get('reg_no','').strip().upper(), f.get('level',''), f.get('email','').strip().lower(), generate_password_hash(f.get('password','')),
+            f.get('reg_no','').strip().upper(), f.get('level',''), f.get('email','').strip().lower(), hash_password(f.get('password','')),
             None, None, None, 0, 0, datetime.utcnow().isoformat()
         )
         conn = get_db()
@@ -393,12 +2371,114 @@ def register_student_admin():
                 """, vals)
         except sqlite3.IntegrityError:
             flash('Email or Reg No already exists.'); return redirect(url_for('register_student_admin'))
-        finally:
-            conn.close()
         flash('Student added.')
         return redirect(url_for('admin_dashboard'))
     return render_template("reg_student_admin.html")
 
+def metrics_allowed() -> bool:
+    """
+    Admins only, unless METRICS_TOKEN (bearer token) or METRICS_ALLOW_LOCAL=1
+    (loopback clients) opts a scraper in. Loopback is off by default: behind a
+    reverse proxy on the same host every request comes from 127.0.0.1.
+    """
+    if session.get("role") == "admin":
+        return True
+    auth = request.headers.get("Authorization", "")
+    if METRICS_TOKEN and auth.startswith("Bearer ") and hmac.compare_digest(auth[7:].encode(), METRICS_TOKEN.encode()):
+        return True
+    return METRICS_ALLOW_LOCAL and request.remote_addr in ("127.0.0.1", "::1")
+
+metrics.gauge("card_cache_memory_bytes", "Bytes held by the in-memory card render cache.", lambda: card_cache._mem_bytes)
+metrics.gauge("verify_index_entries", "Students in the in-memory verification index.", lambda: len(verify_index._by_reg))
+metrics.gauge("render_jobs_queued", "Render jobs waiting for a worker.",
+              lambda: get_db().execute("SELECT COUNT(*) FROM render_jobs WHERE status='queued'").fetchone()[0])
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics_allowed():
+        abort(403)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/metrics/profile')
+def metrics_profile():
+    """Folded stacks from the sampling profiler; ?reset=1 starts a new window."""
+    if not metrics_allowed():
+        abort(403)
+    if profiler is None:
+        return Response("Profiler is off; start the app with PROFILE_SAMPLE_MS=5.\n", status=404, mimetype="text/plain")
+    return Response(profiler.folded(reset=request.args.get('reset') == '1'), mimetype="text/plain")
+
+if profiler is not None and PROFILE_OUTPUT and multiprocessing.parent_process() is None:  # not in render pool workers
+    import atexit
+    atexit.register(profiler.dump, PROFILE_OUTPUT)
+
+@app.route('/verify', methods=['GET','POST'])
+def verify_card():
+    """Check one scan: ?code=<QR text or reg no>, or JSON {"code": ...}."""
+    if not verify_allowed():
+        return jsonify({'error': 'unauthorized'}), 401
+    code = request.values.get('code') or (request.get_json(silent=True) or {}).get('code', '')
+    if not code:
+        return jsonify({'error': 'code is required'}), 400
+    return jsonify(verify_scan(code))
+
+@app.route('/verify/batch', methods=['POST'])
+def verify_card_batch():
+    """
+    Offline scanners upload {"scans": [...]} where each scan is a code string
+    or an object with "code" (plus any fields such as scanned_at, echoed back).
+    """
+    if not verify_allowed():
+        return jsonify({'error': 'unauthorized'}), 401
+    scans = (request.get_json(silent=True) or {}).get('scans')
+    if not isinstance(scans, list):
+        return jsonify({'error': 'scans must be a list'}), 400
+    if len(scans) > VERIFY_BATCH_MAX:
+        return jsonify({'error': f'at most {VERIFY_BATCH_MAX} scans per batch'}), 413
+    results = []
+    for scan in scans:
+        if isinstance(scan, dict):
+            results.append({**scan, **verify_scan(str(scan.get('code', '')))})
+        else:
+            results.append({'code': scan, **verify_scan(str(scan))})
+    return jsonify({'count': len(results), 'results': results})
+
+@app.route('/verify/bundle.json')
+def verify_bundle():
+    """Offline verification bundle for gate devices (public key + revoked serials)."""
+    if not verify_allowed():
+        return jsonify({'error': 'unauthorized'}), 401
+    if get_card_signer().alg != ALG_ED25519:
+        # an HMAC bundle carries the signing key: anyone holding it can mint cards
+        return jsonify({'error': 'HMAC bundles contain the signing key; export them with `flask export-verify-bundle`'}), 403
+    resp = jsonify(build_verify_bundle(get_db()))
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+@app.route('/admin/import', methods=['GET','POST'])
+@login_required('admin')
+def admin_import_roster():
+    report = None
+    if request.method == 'POST':
+        roster = request.files.get('roster_file')
+        if not roster or not roster.filename:
+            flash('Choose a CSV roster to import.'); return redirect(url_for('admin_import_roster'))
+        photos = request.files.get('photos_zip')
+        photos_fp = photos.stream if photos and photos.filename else None
+        text = io.TextIOWrapper(roster.stream, encoding='utf-8-sig', newline='')
+        try:
+            # counted before anything is hashed or inserted, so a roster that is too big imports nothing
+            rows = sum(1 for cells in csv.reader(text) if any(c.strip() for c in cells)) - 1
+            if rows > IMPORT_WEB_MAX_ROWS:
+                flash(f'This roster has {rows} rows; the web import takes at most {IMPORT_WEB_MAX_ROWS}. '
+                      'Split it, or import it on the server with `flask --app app import-roster`.')
+                return redirect(url_for('admin_import_roster'))
+            text.seek(0)
+            report = import_roster(get_db(), text, request.form.get('default_password',''), photos_fp)
+        except (ValueError, zipfile.BadZipFile, UnicodeDecodeError) as e:
+            flash(f'Import failed: {e}'); return redirect(url_for('admin_import_roster'))
+    return render_template("admin_import.html", report=report, fields=ROSTER_FIELDS, max_rows=IMPORT_WEB_MAX_ROWS)
+
 @app.route('/student/dashboard')
 @login_required('student')
 def student_dashboard():
@@ -415,7 +2495,7 @@ def student_edit():
             conn.execute("""
                 UPDATE users SET full_name=?, sex=?, dob=?, blood_group=?, course=?, reg_no=?, level=? WHERE id=?
             """, (f.get('full_name'), f.get('sex'), f.get('dob'), f.get('blood_group'), f.get('course'), f.get('reg_no').strip().upper(), f.get('level'), session['user_id']))
-        conn.close(); flash('Profile updated.')
+        card_cache.invalidate_user(session['user_id']); flash('Profile updated.')
         return redirect(url_for('student_dashboard'))
     me = load_user(session['user_id'])
     return render_template("student_edit.html", me=me)
@@ -427,17 +2507,17 @@ def student_uploads():
         f = request.form
         passport_path = None; signature_path = None
         try:
-            passport_path = save_upload_or_data('pass', request.files.get('passport_file'), f.get('shot_data',''), UPLOAD_DIR)
-            signature_path = save_upload_or_data('sig', request.files.get('signature_file'), f.get('signature_data',''), SIGN_DIR)
+            passport_path = save_upload_or_data('pass', request.files.get('passport_file') or request.files.get('shot_file'), f.get('shot_data',''), UPLOAD_DIR)
+            signature_path = save_upload_or_data('sig', request.files.get('signature_file') or request.files.get('sig_file'), f.get('signature_data',''), SIGN_DIR)
         except Exception as e:
             flash(str(e)); return redirect(url_for('student_uploads'))
-        conn = get_db();
+        conn = get_db()
         with conn:
             if passport_path:
                 conn.execute("UPDATE users SET passport_path=? WHERE id=?", (passport_path, session['user_id']))
             if signature_path:
                 conn.execute("UPDATE users SET signature_path=? WHERE id=?", (signature_path, session['user_id']))
-        conn.close(); flash('Uploads updated.')
+        card_cache.invalidate_user(session['user_id']); flash('Uploads updated.')
         return redirect(url_for('student_dashboard'))
     me = load_user(session['user_id'])
     return render_template("student_uploads.html", me=me)
@@ -447,15 +2527,15 @@ def student_uploads():
 def student_upload_receipt():
     f = request.form
     try:
-        receipt_path = save_upload_or_data('receipt', request.files.get('receipt_file'), f.get('shot_data',''), RECEIPT_DIR)
+        receipt_path = save_upload_or_data('receipt', request.files.get('receipt_file') or request.files.get('shot_file'), f.get('shot_data',''), RECEIPT_DIR)
     except Exception as e:
         flash(str(e)); return redirect(url_for('student_dashboard'))
     if not receipt_path:
         flash('No receipt provided.'); return redirect(url_for('student_dashboard'))
-    conn = get_db();
+    conn = get_db()
     with conn:
         conn.execute("UPDATE users SET receipt_path=?, is_approved=0 WHERE id=?", (receipt_path, session['user_id']))
-    conn.close(); flash('Receipt uploaded. Please wait for admin approval.')
+    flash('Receipt uploaded. Please wait for admin approval.')
     return redirect(url_for('student_dashboard'))
 
 @app.route('/file/passport/<int:user_id>')
@@ -463,29 +2543,28 @@ def student_upload_receipt():
 def student_passport(user_id):
     viewer = session['user_id']; role = session.get('role')
     if viewer != user_id and role != 'admin': abort(403)
-    u = load_user(user_id)
-    if not u or not u['passport_path'] or not os.path.exists(u['passport_path']): abort(404)
-    return send_file(u['passport_path'])
+    path = user_file_path(user_id, 'passport_path')
+    if not path: abort(404)
+    return send_upload(path, 'pass')
 
 @app.route('/file/receipt/<int:user_id>')
 @login_required()
 def student_receipt(user_id):
     viewer = session['user_id']; role = session.get('role')
     if viewer != user_id and role != 'admin': abort(403)
-    u = load_user(user_id)
-    if not u or not u['receipt_path'] or not os.path.exists(u['receipt_path']): abort(404)
-    return send_file(u['receipt_path'])
+    path = user_file_path(user_id, 'receipt_path')
+    if not path: abort(404)
+    return send_upload(path, 'receipt')
 
 @app.route('/student/card.png')
 @login_required('student')
 def student_card_png():
     me = load_user(session['user_id'])
-    img = compose_id_card(me)  # full-size image (1012x638)
-    # create a smaller preview for web (approximate ID-card look)
-    preview_w, preview_h = 324, 204
-    preview = img.resize((preview_w, preview_h), Image.LANCZOS)
-    buf = io.BytesIO(); preview.save(buf, format='PNG', optimize=True); buf.seek(0)
-    return send_file(buf, mimetype='image/png')
+    webp = webp_enabled() and 'image/webp' in request.headers.get('Accept', '')
+    resp = card_response(me, 'preview_webp' if webp else 'preview')
+    if webp_enabled():
+        resp.vary.add('Accept')
+    return resp
 
 @app.route('/student/card.pdf')
 @login_required('student')
@@ -493,40 +2572,183 @@ def student_card_pdf():
     me = load_user(session['user_id'])
     if not me['is_approved']:
         flash('Not approved yet.'); return redirect(url_for('student_dashboard'))
-    img = compose_id_card(me)  # full-size for printing
-    buf = io.BytesIO(); img.save(buf, format='PDF'); buf.seek(0)
-    conn = get_db();
-    with conn:
-        conn.execute("UPDATE users SET id_print_count=id_print_count+1 WHERE id=?", (me['id'],))
-        conn.execute("INSERT INTO print_log (user_id, printed_at) VALUES (?,?)", (me['id'], datetime.utcnow().isoformat()))
-    conn.close()
-    return send_file(buf, mimetype='application/pdf', as_attachment=True, download_name=f"{me['reg_no']}_ID.pdf")
+    resp = card_response(me, 'pdf', download_name=f"{me['reg_no']}_ID.pdf")  # full-size for printing
+    record_prints(get_db(), [me['id']])
+    return resp
+
+@app.route('/student/card.pdf/job', methods=['POST'])
+@login_required('student')
+def student_card_pdf_job():
+    me = load_user(session['user_id'])
+    if not me['is_approved']:
+        return jsonify(error='Not approved yet.'), 403
+    conn = get_db()
+    job = enqueue_job(conn, 'card', me['id'], user_id=me['id'], dedup_key=card_cache_key(me, 'pdf'))
+    out = job_status(conn, job)
+    return jsonify(out), 202
+
+@app.route('/jobs/<job_id>')
+@login_required()
+def render_job_status(job_id):
+    conn, job = load_job_for_viewer(job_id)
+    out = job_status(conn, job)
+    return jsonify(out)
+
+@app.route('/jobs/<job_id>/download')
+@login_required()
+def render_job_download(job_id):
+    conn, job = load_job_for_viewer(job_id)
+    if job['status'] != 'done' or not job['result_path'] or not os.path.exists(job['result_path']):
+        abort(404)
+    if job['kind'] == 'card':
+        u = conn.execute("SELECT id, reg_no FROM users WHERE id=?", (job['user_id'],)).fetchone()
+        if not u:
+            abort(404)
+        record_prints(conn, [u['id']], session['user_id'] if session.get('role') == 'admin' else None)
+        name = f"{u['reg_no']}_ID.pdf"
+    else:
+        name = f"ID_batch_{job['created_at'][:19].replace('-', '').replace(':', '').replace('T', '_')}.pdf"
+    return send_file(job['result_path'], mimetype='application/pdf', as_attachment=True, download_name=name)
 
 @app.route('/admin/dashboard')
 @login_required('admin')
 def admin_dashboard():
     q = request.args.get('q','').strip()
+    sort = request.args.get('sort', 'id')
+    if sort not in STUDENT_SORTS: sort = 'id'
+    direction = 'asc' if request.args.get('dir') == 'asc' else 'desc'
     conn = get_db()
+    where, args = '', ()
     if q:
-        cur = conn.execute("SELECT * FROM users WHERE role='student' AND (full_name LIKE ? OR reg_no LIKE ?) ORDER BY id DESC", (f"%{q}%", f"%{q}%"))
+        where, args = student_search_filter(q)
+    page = list_students_page(conn, sort, direction, request.args.get('after'), request.args.get('before'), where, args,
+                              drive_by_filter=bool(q))
+    stats = load_stats(conn)
+    return render_template("admin_dashboard.html", students=page['rows'], page=page, stats=stats, q=q, sort=sort, direction=direction)
+
+@app.route('/admin/search.json')
+@login_required('admin')
+def admin_search_json():
+    q = request.args.get('q','').strip()
+    if len(q) < 2:
+        return jsonify(results=[])
+    rows = search_students(get_db(), q)
+    return jsonify(results=[{k: r[k] for k in r.keys()} for r in rows])
+
+# ---------------- Bulk moderation ----------------
+# Approve, lock or delete many students in one transaction, picked by id
+# (dashboard checkboxes) or by a filter (course, level, status, receipt,
+# search text), so a whole cohort is moderated with one request.
+
+BULK_ACTIONS = ('approve', 'lock', 'delete')
+
+def _flag(value) -> str:
+    """'0' / '1' from a form string or JSON bool/int, '' when unset."""
+    if isinstance(value, bool):
+        return str(int(value))
+    return str(value).strip() if value is not None else ''
+
+def moderation_filter(criteria) -> tuple[str, tuple]:
+    """WHERE fragment from course, level, approved (0/1), receipt (0/1) and q (search text)."""
+    clauses, params = [], []
+    for field in ('course', 'level'):
+        if _flag(criteria.get(field)):
+            clauses.append(f"{field}=?"); params.append(_flag(criteria.get(field)))
+    if _flag(criteria.get('approved')) in ('0', '1'):
+        clauses.append("IFNULL(is_approved,0)=?"); params.append(int(_flag(criteria.get('approved'))))
+    if _flag(criteria.get('receipt')) in ('0', '1'):
+        clauses.append("IFNULL(receipt_path,'')" + ("<>''" if _flag(criteria.get('receipt')) == '1' else "=''"))
+    q = _flag(criteria.get('q'))
+    if q:
+        where, args = student_search_filter(q)
+        clauses.append(f"({where})"); params += args
+    return ' AND '.join(clauses), tuple(params)
+
+def _bulk_targets(ids, where: str, params: tuple) -> list[tuple[str, list]]:
+    """(condition, args) pairs that together select the target students; ids go in chunks of 500."""
+    base = "role='student'" + (f" AND ({where})" if where else "")
+    if ids is None:
+        return [(base, list(params))]
+    ids = sorted({int(i) for i in ids})
+    return [(f"{base} AND id IN ({','.join('?' * len(ids[i:i + 500]))})", [*params, *ids[i:i + 500]])
+            for i in range(0, len(ids), 500)]
+
+def bulk_moderate(conn, action: str, ids=None, where: str = '', params: tuple = ()) -> dict:
+    """
+    Apply action to the students in ids and/or matching where/params in one
+    transaction; admin accounts are never touched. Deleting also drops their
+    cached cards and uploads no other account uses.
+    Returns {'action', 'matched', 'changed', 'files_removed'}.
+    """
+    if action not in BULK_ACTIONS:
+        raise ValueError(f"Unknown action: {action}")
+    if not ids and not where:
+        raise ValueError("Select students or a filter first.")
+    targets = _bulk_targets(ids, where, params)
+    report = {'action': action, 'matched': 0, 'changed': 0, 'files_removed': 0}
+    deleted, paths = [], []
+    with stage("db.bulk_moderate"), conn:
+        conn.execute("BEGIN IMMEDIATE")  # the rows we report are the rows we change
+        for cond, args in targets:
+            if action == 'delete':
+                rows = conn.execute(f"SELECT id, passport_path, signature_path, receipt_path FROM users WHERE {cond}", args).fetchall()
+                conn.execute(f"DELETE FROM users WHERE {cond}", args)
+                deleted += [r[0] for r in rows]
+                paths += [p for r in rows for p in r[1:]]
+                report['matched'] += len(rows)
+                report['changed'] += len(rows)
+            else:
+                val = 1 if action == 'approve' else 0
+                report['matched'] += conn.execute(f"SELECT COUNT(*) FROM users WHERE {cond}", args).fetchone()[0]
+                report['changed'] += conn.execute(f"UPDATE users SET is_approved=? WHERE {cond} AND IFNULL(is_approved,0)<>?",
+                                                  [val, *args, val]).rowcount
+    if deleted:
+        card_cache.invalidate_users(deleted)
+        report['files_removed'] = release_blobs(conn, paths)
+    return report
+
+@app.route('/admin/bulk', methods=['POST'])
+@login_required('admin')
+def admin_bulk_moderate():
+    """
+    Dashboard form (action plus ids, or scope=filter plus filter fields) or
+    JSON {"action": ..., "ids": [...]} / {"action": ..., "filter": {...}}.
+    """
+    data = request.get_json(silent=True) if request.is_json else None
+    if data is not None:
+        if not isinstance(data, dict) or ('ids' in data) == ('filter' in data):
+            return jsonify(error='Send exactly one of "ids" or "filter".'), 400
+        action, ids, criteria = data.get('action', ''), data.get('ids'), data.get('filter', {})
+        if 'ids' in data and not (isinstance(ids, list) and all(type(i) is int for i in ids)):
+            return jsonify(error='"ids" must be a list of integers.'), 400
+        if not isinstance(criteria, dict):
+            return jsonify(error='"filter" must be an object.'), 400
     else:
-        cur = conn.execute("SELECT * FROM users WHERE role='student' ORDER BY id DESC")
-    students = cur.fetchall()
-    cur = conn.execute("SELECT COUNT(*) AS c FROM users WHERE role='student'"); total = cur.fetchone()['c']
-    cur = conn.execute("SELECT COUNT(*) AS c FROM users WHERE role='student' AND is_approved=1"); approved = cur.fetchone()['c']
-    cur = conn.execute("SELECT COUNT(*) AS c FROM users WHERE role='student' AND is_approved=0"); pending = cur.fetchone()['c']
-    cur = conn.execute("SELECT SUM(id_print_count) AS s FROM users WHERE role='student'"); prints = cur.fetchone()['s'] or 0
-    conn.close()
-    stats = { 'total': total, 'approved': approved, 'pending': pending, 'prints': prints }
-    return render_template("admin_dashboard.html", students=students, stats=stats, q=q)
+        f = request.form
+        action, criteria = f.get('action', ''), f
+        ids = None if f.get('scope') == 'filter' else f.getlist('ids', type=int)
+    try:
+        where, params = moderation_filter(criteria) if ids is None else ('', ())
+        report = bulk_moderate(get_db(), action, ids, where, params)
+    except (ValueError, TypeError, AttributeError) as e:
+        if data is not None:
+            return jsonify(error=str(e)), 400
+        flash(str(e)); return redirect(request.referrer or url_for('admin_dashboard'))
+    if data is not None:
+        return jsonify(report)
+    if action == 'delete':
+        flash(f"Deleted {report['changed']} student(s).")
+    else:
+        flash(f"{'Approved' if action == 'approve' else 'Locked'} {report['changed']} student(s); "
+              f"{report['matched'] - report['changed']} already were.")
+    return redirect(request.referrer or url_for('admin_dashboard'))
 
 @app.route('/admin/approve/<int:user_id>/<int:val>')
 @login_required('admin')
 def admin_set_approval(user_id, val):
-    conn = get_db();
+    conn = get_db()
     with conn:
         conn.execute("UPDATE users SET is_approved=? WHERE id=?", (1 if val else 0, user_id))
-    conn.close();
     flash('Status updated.')
     return redirect(url_for('admin_dashboard'))
 
@@ -535,10 +2757,25 @@ def admin_set_approval(user_id, val):
 def admin_delete_user(user_id):
     if session['user_id'] == user_id:
         flash('You cannot delete your own account here.'); return redirect(url_for('admin_dashboard'))
-    conn = get_db();
+    conn = get_db()
     with conn:
         conn.execute("DELETE FROM users WHERE id=?", (user_id,))
-    conn.close(); flash('Account deleted.')
+    card_cache.invalidate_user(user_id); flash('Account deleted.')
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/reissue-card/<int:user_id>')
+@login_required('admin')
+def admin_reissue_card(user_id):
+    """New card serial for a lost or replaced card; the old serial is revoked."""
+    u = load_user(user_id)
+    if not u or u['role']!='student': abort(404)
+    now = datetime.utcnow().isoformat()
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE card_serials SET revoked_at=? WHERE user_id=? AND revoked_at IS NULL", (now, user_id))
+        serial = conn.execute("INSERT INTO card_serials (user_id, issued_at) VALUES (?,?)", (user_id, now)).lastrowid
+        conn.execute("UPDATE users SET card_serial=? WHERE id=?", (serial, user_id))
+    card_cache.invalidate_user(user_id); flash('Card reissued. The previous card is now revoked.')
     return redirect(url_for('admin_dashboard'))
 
 @app.route('/admin/print-id/<int:user_id>')
@@ -546,30 +2783,399 @@ def admin_delete_user(user_id):
 def admin_student_card_pdf(user_id):
     u = load_user(user_id)
     if not u or u['role']!='student': abort(404)
-    img = compose_id_card(u)
-    buf = io.BytesIO(); img.save(buf, format='PDF'); buf.seek(0)
-    conn = get_db();
-    with conn:
-        conn.execute("UPDATE users SET id_print_count=id_print_count+1 WHERE id=?", (u['id'],))
-        conn.execute("INSERT INTO print_log (user_id, printed_at) VALUES (?,?)", (u['id'], datetime.utcnow().isoformat()))
-    conn.close()
-    return send_file(buf, mimetype='application/pdf', as_attachment=True, download_name=f"{u['reg_no']}_ID.pdf")
+    resp = card_response(u, 'pdf', download_name=f"{u['reg_no']}_ID.pdf")
+    record_prints(get_db(), [u['id']], session['user_id'])
+    return resp
 
-@app.route('/admin/export.csv')
+@app.route('/admin/print-id/<int:user_id>/job', methods=['POST'])
 @login_required('admin')
-def export_students_csv():
-    conn = get_db(); cur = conn.execute("SELECT full_name,reg_no,course,level,sex,dob,blood_group,email,is_approved,id_print_count FROM users WHERE role='student' ORDER BY full_name")
-    rows = cur.fetchall(); conn.close()
-    si = io.StringIO(); w = csv.writer(si)
-    w.writerow(["Full Name","Reg No","Course","Level","Sex","DOB","Blood Group","Email","Approved","Prints"])
-    for r in rows:
-        w.writerow([r['full_name'], r['reg_no'], r['course'], r['level'], r['sex'], r['dob'], r['blood_group'], r['email'], 'Yes' if r['is_approved'] else 'No', r['id_print_count']])
-    out = make_response(si.getvalue()); out.headers['Content-Disposition']='attachment; filename=students.csv'; out.mimetype='text/csv'
+def admin_student_card_pdf_job(user_id):
+    u = load_user(user_id)
+    if not u or u['role']!='student': abort(404)
+    conn = get_db()
+    job = enqueue_job(conn, 'card', session['user_id'], user_id=u['id'], dedup_key=card_cache_key(u, 'pdf'))
+    out = job_status(conn, job)
+    return jsonify(out), 202
+
+@app.route('/admin/print-batch/job', methods=['POST'])
+@login_required('admin')
+def admin_print_batch_job():
+    f = request.form
+    params = {'course': f.get('course','').strip(), 'level': f.get('level','').strip(),
+              'unprinted': bool(f.get('unprinted')), 'layout': f.get('layout','single') if f.get('layout') in LAYOUTS else 'single'}
+    conn = get_db()
+    dedup = 'batch:' + hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    job = enqueue_job(conn, 'batch', session['user_id'], params=params, dedup_key=dedup)
+    out = job_status(conn, job)
+    return jsonify(out), 202
+
+@app.route('/admin/print-batch', methods=['GET','POST'])
+@login_required('admin')
+def admin_print_batch():
+    conn = get_db()
+    if request.method == 'POST':
+        f = request.form
+        layout = f.get('layout', 'single')
+        if layout not in LAYOUTS: layout = 'single'
+        students = select_print_batch(conn, f.get('course','').strip(), f.get('level','').strip(),
+                                      approved_only=True, unprinted_only=bool(f.get('unprinted')))
+        if not students:
+            flash('No approved students match that filter.'); return redirect(url_for('admin_print_batch'))
+        operator_id = session['user_id']
+
+        def body():
+            printed = []
+            yield from iter_print_batch(students, layout, printed=printed)
+            # only reached once the whole PDF went out; an aborted download prints nothing
+            conn = connect_db()
+            try:
+                record_prints(conn, printed, operator_id)
+            finally:
+                conn.close()
+
+        out = Response(body(), mimetype='application/pdf')
+        out.headers['Content-Disposition'] = f"attachment; filename=ID_batch_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.pdf"
+        return out
+    courses = [r['course'] for r in conn.execute("SELECT DISTINCT course FROM users WHERE role='student' AND course<>'' ORDER BY course")]
+    levels = [r['level'] for r in conn.execute("SELECT DISTINCT level FROM users WHERE role='student' AND level<>'' ORDER BY level")]
+    return render_template("admin_print_batch.html", courses=courses, levels=levels, layouts=LAYOUTS, archive_formats=ARCHIVE_FORMATS)
+
+@app.route('/admin/print-batch.zip', methods=['POST'])
+@login_required('admin')
+def admin_print_batch_zip():
+    f = request.form
+    fmt = f.get('format') if f.get('format') in ARCHIVE_FORMATS else 'png'
+    students = select_print_batch(get_db(), f.get('course','').strip(), f.get('level','').strip(),
+                                  approved_only=True, unprinted_only=bool(f.get('unprinted')))
+    if not students:
+        flash('No approved students match that filter.'); return redirect(url_for('admin_print_batch'))
+    operator_id = session['user_id']
+
+    def body():
+        printed = []
+        yield from iter_card_archive(students, fmt, manifest=bool(f.get('manifest')), printed=printed)
+        # only reached once the whole archive went out; an aborted download prints nothing
+        conn = connect_db()
+        try:
+            record_prints(conn, printed, operator_id)
+        finally:
+            conn.close()
+
+    out = Response(body(), mimetype='application/zip')
+    out.headers['Content-Disposition'] = f"attachment; filename=ID_cards_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.zip"
+    return out
+
+# ---------------- Print analytics ----------------
+# Range queries over print_rollup (see PRINT_ROLLUP_SCHEMA): their cost
+# depends on the days, courses and operators in range, not on how long
+# print_log has grown. Days and hours are UTC, as printed_at is stored.
+
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_MAX_DAYS = 366
+REPRINT_ALERT = int(os.environ.get("REPRINT_ALERT", "3"))  # prints of one student's card worth a look
+
+def analytics_range(args) -> tuple[str, str]:
+    """Inclusive (from, to) ISO days from request args; ValueError on bad input."""
+    try:
+        end = date.fromisoformat(args['to']) if args.get('to') else datetime.utcnow().date()
+        start = date.fromisoformat(args['from']) if args.get('from') else end - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    except ValueError:
+        raise ValueError("Dates must look like YYYY-MM-DD.") from None
+    if start > end:
+        raise ValueError("The start date is after the end date.")
+    if (end - start).days >= ANALYTICS_MAX_DAYS:
+        raise ValueError(f"Pick at most {ANALYTICS_MAX_DAYS} days.")
+    return start.isoformat(), end.isoformat()
+
+@timed_stage("db.print_analytics")
+def print_analytics(conn, start: str, end: str, course: str = '', top: int = 20) -> dict:
+    """
+    Prints and reprints between two days (inclusive), by day, course and
+    operator, plus prints by hour of day (None when filtered to a course).
+    """
+    where, args = "r.day BETWEEN ? AND ?", [start, end]
+    if course:
+        where += " AND r.course=?"; args.append(course)
+    def rows(select: str, group: str, order: str) -> list[dict]:
+        return [dict(r) for r in conn.execute(
+            f"SELECT {select}, SUM(r.prints) AS prints, SUM(r.reprints) AS reprints FROM print_rollup r "
+            f"WHERE {where} GROUP BY {group} ORDER BY {order}", args)]
+    totals = conn.execute(f"SELECT IFNULL(SUM(prints),0) AS prints, IFNULL(SUM(reprints),0) AS reprints FROM print_rollup r WHERE {where}",
+                          args).fetchone()
+    hours = {} if course else dict(conn.execute(  # print_hourly has no course split
+        "SELECT hour, SUM(prints) FROM print_hourly WHERE day BETWEEN ? AND ? GROUP BY hour", (start, end)).fetchall())
+    operators = rows("r.operator_id", "r.operator_id", "prints DESC")
+    names = {}
+    ids = [o['operator_id'] for o in operators if o['operator_id']]
+    if ids:
+        names = dict(conn.execute(f"SELECT id, full_name FROM users WHERE id IN ({','.join('?' * len(ids))})", ids).fetchall())
+    for o in operators:
+        o['operator'] = names.get(o['operator_id'], f"#{o['operator_id']}") if o['operator_id'] else "Self-service / CLI"
+    top_reprints = [dict(r) for r in conn.execute("""
+        SELECT id, full_name, reg_no, course, IFNULL(id_print_count,0) AS prints,
+               (SELECT MAX(printed_at) FROM print_log WHERE user_id=users.id) AS last_printed
+        FROM users WHERE role='student' AND IFNULL(id_print_count,0) >= ?
+        ORDER BY IFNULL(id_print_count,0) DESC, id DESC LIMIT ?
+    """, (REPRINT_ALERT, top))]
+    return {
+        'from': start, 'to': end, 'course': course or None,
+        'prints': totals['prints'], 'reprints': totals['reprints'],
+        'by_day': rows("r.day", "r.day", "r.day"),
+        'by_day_course': rows("r.day, r.course", "r.day, r.course", "r.day, r.course"),
+        'by_course': rows("r.course", "r.course", "prints DESC"),
+        'by_hour': [{'hour': h, 'prints': hours.get(h, 0)} for h in range(24)] if not course else None,
+        'by_operator': operators,
+        'top_reprints': top_reprints,
+        'reprint_alert': REPRINT_ALERT,
+    }
+
+@app.route('/admin/analytics')
+@login_required('admin')
+def admin_analytics():
+    try:
+        start, end = analytics_range(request.args)
+    except ValueError as e:
+        flash(str(e)); start, end = analytics_range({})
+    course = request.args.get('course', '').strip()
+    return render_template("admin_analytics.html", a=print_analytics(get_db(), start, end, course))
+
+@app.route('/admin/analytics.json')
+@login_required('admin')
+def admin_analytics_json():
+    """?from=YYYY-MM-DD&to=YYYY-MM-DD&course=... (default: the last 30 days, all courses)."""
+    try:
+        start, end = analytics_range(request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(print_analytics(get_db(), start, end, request.args.get('course', '').strip()))
+
+# ---------------- Export ----------------
+
+EXPORT_COLUMNS = {
+    # key: (header, column)
+    'full_name': ("Full Name", "full_name"),
+    'reg_no': ("Reg No", "reg_no"),
+    'course': ("Course", "course"),
+    'level': ("Level", "level"),
+    'sex': ("Sex", "sex"),
+    'dob': ("DOB", "dob"),
+    'blood_group': ("Blood Group", "blood_group"),
+    'email': ("Email", "email"),
+    'approved': ("Approved", "is_approved"),
+    'prints': ("Prints", "id_print_count"),
+    'created_at': ("Registered", "created_at"),
+}
+DEFAULT_EXPORT_COLUMNS = ['full_name', 'reg_no', 'course', 'level', 'sex', 'dob', 'blood_group', 'email', 'approved', 'prints']
+EXPORT_FORMATS = {
+    # fmt: (mimetype, filename)
+    'csv': ('text/csv', 'students.csv'),
+    'csv.gz': ('application/gzip', 'students.csv.gz'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'students.xlsx'),
+}
+EXPORT_CHUNK = 64 * 1024
+
+def export_query(args) -> tuple[str, list, list[str]]:
+    """Build the export SELECT from request args: cols, course, level, approved, from, to."""
+    cols = [c for c in ','.join(args.getlist('cols')).split(',') if c in EXPORT_COLUMNS] or DEFAULT_EXPORT_COLUMNS
+    clauses, params = ["role='student'"], []
+    for field in ('course', 'level'):
+        if args.get(field):
+            clauses.append(f"{field}=?"); params.append(args[field])
+    if args.get('approved') in ('0', '1'):
+        clauses.append("is_approved=?"); params.append(int(args['approved']))
+    if args.get('from'):
+        clauses.append("created_at>=?"); params.append(args['from'])
+    if args.get('to'):
+        clauses.append("created_at<?"); params.append(args['to'] + "\uffff")  # inclusive of the whole 'to' day
+    sql = (f"SELECT {', '.join(EXPORT_COLUMNS[c][1] for c in cols)} FROM users WHERE {' AND '.join(clauses)} "
+           f"ORDER BY IFNULL(full_name,''), id")
+    return sql, params, cols
+
+def iter_export_rows(sql: str, params: list, cols: list[str]):
+    """Rows straight off a cursor on a private connection, so nothing is buffered."""
+    conn = connect_db()
+    try:
+        approved_at = cols.index('approved') if 'approved' in cols else -1
+        for r in conn.execute(sql, params):
+            row = list(r)
+            if approved_at >= 0:
+                row[approved_at] = 'Yes' if row[approved_at] else 'No'
+            yield row
+    finally:
+        conn.close()
+
+def iter_csv(headers: list[str], rows):
+    buf = io.StringIO(); w = csv.writer(buf)
+    w.writerow(headers)
+    for row in rows:
+        w.writerow(row)
+        if buf.tell() >= EXPORT_CHUNK:
+            yield buf.getvalue().encode('utf-8'); buf.seek(0); buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
+def iter_gzip(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+@app.route('/admin/export')
+@login_required('admin')
+def admin_export():
+    conn = get_db()
+    courses = [r['course'] for r in conn.execute("SELECT DISTINCT course FROM users WHERE role='student' AND course<>'' ORDER BY course")]
+    levels = [r['level'] for r in conn.execute("SELECT DISTINCT level FROM users WHERE role='student' AND level<>'' ORDER BY level")]
+    return render_template("admin_export.html", courses=courses, levels=levels, columns=EXPORT_COLUMNS, default_columns=DEFAULT_EXPORT_COLUMNS)
+
+@app.route('/admin/export.xlsx', defaults={'fmt': 'xlsx'})
+@app.route('/admin/export.csv.gz', defaults={'fmt': 'csv.gz'})
+@app.route('/admin/export.csv', defaults={'fmt': 'csv'})  # registered first, so the url_for default
+@login_required('admin')
+def export_students_csv(fmt):
+    sql, params, cols = export_query(request.args)
+    headers = [EXPORT_COLUMNS[c][0] for c in cols]
+    rows = iter_export_rows(sql, params, cols)
+    if fmt == 'xlsx':
+        body = iter_xlsx(headers, rows, sheet_name="Students")
+    elif fmt == 'csv.gz':
+        body = iter_gzip(iter_csv(headers, rows))
+    else:
+        body = iter_csv(headers, rows)
+    mimetype, filename = EXPORT_FORMATS[fmt]
+    out = Response(body, mimetype=mimetype)
+    out.headers['Content-Disposition'] = f'attachment; filename={filename}'
     return out
 
 @app.route('/developer')
 def developer():
     return render_template("developer.html")
 
+# ---------------- CLI ----------------
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Create or upgrade the database schema; run once per deploy, before starting the workers."""
+    init_db(force=True)
+    click.echo(f"Database schema at version {SCHEMA_VERSION}.")
+
+@app.cli.command("print-batch")
+@click.option("--course", default="", help="Only this course.")
+@click.option("--level", default="", help="Only this level.")
+@click.option("--unprinted", is_flag=True, help="Skip students whose card was printed before.")
+@click.option("--include-unapproved", is_flag=True, help="Also print students not yet approved.")
+@click.option("--layout", type=click.Choice(LAYOUTS), default="single", show_default=True)
+@click.option("--workers", type=int, default=0, help="Render processes (default: one per core).")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), required=True, help="PDF file to write.")
+def print_batch_command(course, level, unprinted, include_unapproved, layout, workers, output):
+    """Render many ID cards into one PDF and record the prints."""
+    conn = get_db()
+    students = select_print_batch(conn, course, level, approved_only=not include_unapproved, unprinted_only=unprinted)
+    if not students:
+        click.echo("No students match."); return
+    t0 = time.perf_counter()
+    with open(output, "wb") as fp:
+        printed = write_print_batch(fp, students, layout=layout, workers=workers or None)
+    elapsed = time.perf_counter() - t0
+    record_prints(conn, printed)
+    click.echo(f"{len(printed)} cards -> {output} in {elapsed:.1f}s ({len(printed) / elapsed:.1f} cards/s)")
+
+@app.cli.command("import-roster")
+@click.argument("csv_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--photos", type=click.Path(exists=True, dir_okay=False), help="Zip of passport photos named by reg no.")
+@click.option("--default-password", default="", help="Password for rows without one.")
+@click.option("--hash-method", default=None, help="werkzeug hash method (default: IMPORT_HASH_METHOD or werkzeug's default).")
+@click.option("--workers", type=int, default=0, help="Hashing processes (default: one per core).")
+def import_roster_command(csv_path, photos, default_password, hash_method, workers):
+    """Create student accounts from a CSV roster."""
+    with open(csv_path, encoding="utf-8-sig", newline="") as fp:
+        zf = open(photos, "rb") if photos else None
+        try:
+            report = import_roster(get_db(), fp, default_password, zf, hash_method, workers or None)
+        finally:
+            if zf:
+                zf.close()
+    for line, reg_no, msg in report['errors']:
+        click.echo(f"line {line} ({reg_no}): {msg}")
+    click.echo(f"{report['inserted']} of {report['rows']} rows imported, {report['photos']} photos matched, "
+               f"{len(report['errors'])} errors in {report['seconds']}s ({report['rows_per_sec']} rows/s)")
+
+@app.cli.command("export-verify-bundle")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), default="verify_bundle.json", show_default=True)
+def export_verify_bundle_command(output):
+    """Write the offline card verification bundle for gate devices."""
+    bundle = build_verify_bundle(get_db())
+    with open(output, "w") as f:
+        json.dump(bundle, f, indent=1)
+    click.echo(f"{output}: {bundle['alg']} key {bundle['key_id']}, {bundle['revoked_count']} revoked serials")
+
+@app.cli.command("gc-uploads")
+@click.option("--all", "sweep_all", is_flag=True, help="Sweep every shard instead of the next batch.")
+@click.option("--shards", type=int, default=BLOB_GC_SHARDS_PER_RUN, show_default=True)
+@click.option("--grace", type=int, default=BLOB_GC_GRACE_SECONDS, show_default=True, help="Keep files younger than this (seconds).")
+@click.option("--dry-run", is_flag=True)
+def gc_uploads_command(sweep_all, shards, grace, dry_run):
+    """Delete uploaded files (and their derivatives) no student references any more."""
+    report = gc_blobs(get_db(), None if sweep_all else shards, grace, dry_run)
+    click.echo(f"{'would remove' if dry_run else 'removed'} {report['removed']} of {report['scanned']} files "
+               f"in {report['shards']} directories ({report['freed_bytes'] / 1e6:.1f} MB)")
+
+@app.cli.command("check-stats")
+@click.option("--fix", is_flag=True, help="Overwrite the counters with the recomputed values.")
+def check_stats_command(fix):
+    """Compare the dashboard counters with a full recount."""
+    conn = get_db()
+    stored, actual = load_stats(conn), dict(conn.execute(STATS_AGGREGATE_SQL).fetchone())
+    click.echo(f"stored:  {stored}\nactual:  {actual}")
+    if stored == actual:
+        click.echo("OK"); return
+    if fix:
+        with conn:
+            conn.execute("UPDATE student_stats SET total=?, approved=?, pending=?, prints=? WHERE id=1",
+                         (actual['total'], actual['approved'], actual['pending'], actual['prints']))
+        click.echo("Counters repaired.")
+    else:
+        raise SystemExit("Counters differ; run with --fix to repair.")
+
+@app.cli.command("job-worker")
+def job_worker_command():
+    """Drain the render job queue in this process (run alongside the web app)."""
+    click.echo("Render job worker started; Ctrl+C to stop.")
+    try:
+        job_worker_loop()
+    except KeyboardInterrupt:
+        pass
+
+# ---------------- App factory ----------------
+# Importing this module only registers the routes. Everything heavy (Pillow,
+# fonts, card template and logo, signing keys, qrcode, cryptography, the
+# verification index) and every environment probe (schema version, FTS5,
+# WebP support) happens on first use. preload_app() does it all up front for
+# servers that fork their workers (see wsgi.py).
+
+def preload_app() -> Flask:
+    """
+    Check the schema and build the render state now, so a server that forks
+    its workers after loading the app (gunicorn --preload) shares it
+    copy-on-write instead of every worker building its own. Returns the
+    module's app; starts no threads, they would not survive the fork.
+    """
+    from PIL import Image
+    ensure_schema()
+    has_fts5(); webp_enabled()
+    for name in CARD_FONT_SIZES:
+        card_font(name)
+    for scale in (1.0, PREVIEW_SCALE):
+        get_card_template(scale)
+    _card_keys()
+    make_card_qr(CARD_CODE_PREFIX)
+    Image.init()  # registers every image plugin now rather than on a worker's first upload
+    verify_index.refresh(force=True)
+    gc.collect()
+    gc.freeze()  # the collector would otherwise touch, and so copy, the shared objects in every worker
+    return app
+
 if __name__ == '__main__':
+    get_card_signer()  # a signing key this install cannot use fails here, not on every card
     app.run(debug=True)
@@ -0,0 +1,31 @@
+"""
+Per-card render time with and without the precompiled card template.
+
+"before" rebuilds the static layer (header, logo resize, titles, labels)
+for every card the way compose_id_card() used to; "after" reuses the
+cached template and only draws the student's data.
+
+    python bench/bench_card_template.py [--repeat 30]
+"""
+from __future__ import annotations
+import argparse, json, tempfile
+
+from common import use_app_dir, make_student, timeit
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeat", type=int, default=30)
+    args = ap.parse_args()
+    use_app_dir()
+    import app as A
+
+    with tempfile.TemporaryDirectory() as tmp:
+        student = make_student(tmp)
+        before = timeit(lambda: A.compose_id_card(student, template=A.build_card_template()), args.repeat)
+        after = timeit(lambda: A.compose_id_card(student), args.repeat)
+        static = timeit(A.build_card_template, args.repeat)
+    print(json.dumps({"before": before, "after": after, "static_layer": static,
+                      "speedup": round(before["mean_ms"] / after["mean_ms"], 2)}, indent=2))
+
+if __name__ == "__main__":
+    main()
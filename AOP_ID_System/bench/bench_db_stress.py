@@ -0,0 +1,148 @@
+"""
+Concurrent logins, approvals, PDF prints, registrations and deletes against
+a fresh SQLite database. At the end the dashboard counters (student_stats)
+are checked against a full recount; the script exits non-zero if they drift.
+
+Run once as-is and once with --legacy (a plain sqlite3.connect() per call in
+rollback-journal mode, as get_db() used to do) to compare "database is
+locked" errors and tail latency:
+
+    python bench/bench_db_stress.py --threads 16 --ops 3000
+    python bench/bench_db_stress.py --threads 16 --ops 3000 --legacy
+"""
+from __future__ import annotations
+import argparse, json, random, sqlite3, threading, time
+from datetime import datetime
+
+from common import use_temp_app_dir, make_passport, make_signature, percentiles
+
+FAST_HASH = "pbkdf2:sha256:1"  # keep password hashing out of the measurement
+
+def seed(A, students: int):
+    from werkzeug.security import generate_password_hash
+    pw = generate_password_hash("secret", method=FAST_HASH)
+    passport = make_passport("uploads/pass_bench.jpg")
+    signature = make_signature("signatures/sig_bench.png")
+    now = datetime.utcnow().isoformat()
+    conn = A.connect_db()
+    with conn:
+        conn.execute("INSERT INTO users (role, full_name, email, password_hash, created_at) VALUES ('admin','Bench Admin','admin@bench',?,?)", (pw, now))
+        conn.executemany("""
+            INSERT INTO users (role, full_name, sex, dob, blood_group, course, reg_no, level, email, password_hash,
+                               passport_path, signature_path, is_approved, created_at)
+            VALUES ('student',?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """, [(f"Student {i}", "Male", "2004-01-01", "O+", f"Course {i % 8}", f"BENCH/{i:06d}", "ND1",
+               f"s{i}@bench", pw, passport, signature, i % 2, now) for i in range(students)])
+    ids = [r[0] for r in conn.execute("SELECT id FROM users WHERE role='student' ORDER BY id")]
+    admin_id = conn.execute("SELECT id FROM users WHERE role='admin'").fetchone()[0]
+    conn.close()
+    return admin_id, ids
+
+def use_legacy_db(A):
+    def legacy_connect():
+        conn = sqlite3.connect(A.DB_PATH)
+        conn.row_factory = sqlite3.Row
+        return conn
+    conn = sqlite3.connect(A.DB_PATH)
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.close()
+    A.connect_db = legacy_connect
+    A.get_db = legacy_connect
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--students", type=int, default=2000)
+    ap.add_argument("--threads", type=int, default=16)
+    ap.add_argument("--ops", type=int, default=3000, help="total operations across all threads")
+    ap.add_argument("--legacy", action="store_true", help="per-call connections, rollback journal, no pragmas")
+    args = ap.parse_args()
+
+    use_temp_app_dir()
+    import app as A
+    A.app.testing = True  # let exceptions reach us so locked errors can be counted
+    admin_id, ids = seed(A, args.students)
+    if args.legacy:
+        use_legacy_db(A)
+    printable = ids[:50]
+    deletable = ids[len(ids) // 2:]  # never printed, so deletes don't race the print pool
+    # warm the render cache so prints measure the DB path, not the renderer
+    with A.app.test_client() as c:
+        with c.session_transaction() as s:
+            s["user_id"], s["role"] = admin_id, "admin"
+        for uid in printable:
+            c.get(f"/admin/print-id/{uid}")
+
+    lat = {"login": [], "approve": [], "print": [], "register": [], "delete": []}
+    errors = {"locked": 0, "other": 0}
+    lock = threading.Lock()
+    per_thread = args.ops // args.threads
+
+    def worker(seed_: int):
+        rnd = random.Random(seed_)
+        student = A.app.test_client()
+        admin = A.app.test_client()
+        with admin.session_transaction() as s:
+            s["user_id"], s["role"] = admin_id, "admin"
+        for _ in range(per_thread):
+            roll = rnd.random()
+            t = time.perf_counter()
+            try:
+                if roll < 0.5:
+                    op = "login"
+                    i = rnd.randrange(len(ids))
+                    student.post("/login/student", data={"email": f"s{i}@bench", "password": "secret"})
+                elif roll < 0.75:
+                    op = "approve"
+                    admin.get(f"/admin/approve/{rnd.choice(ids)}/{rnd.randint(0, 1)}")
+                elif roll < 0.9:
+                    op = "print"
+                    admin.get(f"/admin/print-id/{rnd.choice(printable)}")
+                elif roll < 0.95:
+                    op = "register"
+                    n = f"{seed_}-{rnd.random()}"
+                    admin.post("/admin/add-student", data={"full_name": f"New {n}", "reg_no": f"NEW/{n}",
+                                                           "email": f"new{n}@bench", "password": "secret"})
+                else:
+                    op = "delete"
+                    with lock:
+                        victim = deletable.pop() if deletable else None
+                    if victim is None:
+                        continue
+                    admin.get(f"/admin/delete/{victim}")
+            except sqlite3.OperationalError as e:
+                with lock:
+                    errors["locked" if "locked" in str(e) else "other"] += 1
+                continue
+            except Exception:
+                with lock:
+                    errors["other"] += 1
+                continue
+            with lock:
+                lat[op].append((time.perf_counter() - t) * 1000)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    done = sum(len(v) for v in lat.values())
+    conn = sqlite3.connect(A.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    stored = dict(conn.execute("SELECT total, approved, pending, prints FROM student_stats").fetchone())
+    actual = dict(conn.execute(A.STATS_AGGREGATE_SQL).fetchone())
+    conn.close()
+    print(json.dumps({
+        "mode": "legacy" if args.legacy else "managed",
+        "threads": args.threads, "students": args.students,
+        "ops_per_sec": round(done / elapsed, 1),
+        "errors": errors,
+        **{op: percentiles(v) for op, v in lat.items()},
+        "stats": {"stored": stored, "recount": actual, "consistent": stored == actual},
+    }, indent=2))
+    if stored != actual:
+        raise SystemExit("student_stats drifted from the users table")
+
+if __name__ == "__main__":
+    main()
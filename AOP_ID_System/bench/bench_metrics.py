@@ -0,0 +1,62 @@
+"""
+Instrumentation overhead: the same request mix with metrics off, metrics on,
+and metrics on plus the sampling profiler. Rounds are interleaved so drift
+in machine load hits all three modes alike.
+
+    python bench/bench_metrics.py --requests 2000 --rounds 5
+"""
+from __future__ import annotations
+import argparse, json, random, tempfile, time
+
+from common import use_temp_app_dir, make_student
+from bench_search import seed
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=2000)
+    ap.add_argument("--rounds", type=int, default=5)
+    ap.add_argument("--profile-ms", type=float, default=5.0)
+    args = ap.parse_args()
+    tmp = use_temp_app_dir()
+    import app as A
+    seed(A, 5000, random.Random(3))
+    st = make_student(tempfile.mkdtemp(dir=tmp), 0)
+    conn = A.connect_db()
+    with conn:
+        conn.execute("UPDATE users SET passport_path=?, signature_path=? WHERE id=1", (st["passport_path"], st["signature_path"]))
+    conn.close()
+    A.VERIFY_API_TOKEN = "bench"
+    client = A.app.test_client()
+    with client.session_transaction() as s:
+        s["user_id"] = 1; s["role"] = "student"
+    mix = [("/student/card.png", {}), ("/student/dashboard", {}),
+           ("/verify?code=AOP/01/000001", {"Authorization": "Bearer bench"})]
+
+    def run():
+        t = time.perf_counter()
+        for i in range(args.requests):
+            url, headers = mix[i % len(mix)]
+            client.get(url, headers=headers)
+        return (time.perf_counter() - t) / args.requests * 1000
+
+    profiler = A.SamplingProfiler(args.profile_ms / 1000)
+    run()  # warm caches (card render, verify index)
+    times = {"off": [], "metrics": [], "metrics+profiler": []}
+    for _ in range(args.rounds):
+        for mode in times:
+            A.metrics.enabled = A.METRICS_ENABLED = mode != "off"
+            if mode == "metrics+profiler":
+                profiler.start()
+            times[mode].append(run())
+            if mode == "metrics+profiler":
+                profiler.stop()
+    best = {mode: min(v) for mode, v in times.items()}
+    print(json.dumps({
+        "requests_per_round": args.requests, "rounds": args.rounds,
+        "ms_per_request": {m: round(v, 4) for m, v in best.items()},
+        "overhead_pct": {m: round((best[m] / best["off"] - 1) * 100, 2) for m in ("metrics", "metrics+profiler")},
+        "profiler_samples": profiler.samples,
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Native preview rendering: speed and fidelity.
+
+"reference" is how previews used to be made: compose the 1012x638 print card
+and LANCZOS-downsample it to PREVIEW_SIZE. "native" draws the card directly
+at PREVIEW_SCALE. Compose and encode are timed separately, and both paths
+encode with the same PNG options (the preview's), so the speedup is the
+compose change alone. "native_cold_qr" clears the QR cache before every card
+to show what it saves. The native image is diffed against the reference for
+a few students: mean and 99th-percentile absolute channel error (0-255) and
+PSNR in dB.
+
+Exits non-zero when any card's PSNR drops below --min-psnr. The repo has no
+test suite, so this script is the image-diff test of the native preview path:
+run it with --check after layout, font or renderer changes (a few seconds, no
+timing) and treat a non-zero exit as a failed test.
+
+    python bench/bench_preview.py --check
+    python bench/bench_preview.py --students 5 --repeat 30 --min-psnr 32
+"""
+from __future__ import annotations
+import argparse, io, json, math, os, sys, tempfile, time
+
+from PIL import Image, ImageChops
+
+from common import use_temp_app_dir, make_student, timeit
+
+def reference_preview(A, student) -> Image.Image:
+    return A.compose_id_card(student).resize(A.PREVIEW_SIZE, Image.LANCZOS)
+
+def image_diff(a: Image.Image, b: Image.Image) -> dict:
+    """Per-channel absolute error statistics of two same-size RGB images."""
+    hist = ImageChops.difference(a.convert("RGB"), b.convert("RGB")).histogram()
+    counts = [sum(hist[c * 256 + v] for c in range(3)) for v in range(256)]
+    total = sum(counts)
+    mse = sum(v * v * n for v, n in enumerate(counts)) / total
+    running, p99 = 0, 0
+    for v, n in enumerate(counts):
+        running += n
+        if running >= total * 0.99:
+            p99 = v
+            break
+    return {"mean_abs": round(sum(v * n for v, n in enumerate(counts)) / total, 2), "p99_abs": p99,
+            "psnr_db": round(10 * math.log10(255 ** 2 / mse), 2) if mse else float("inf")}
+
+def cpu_ms(fn, repeat: int) -> float:
+    t = time.process_time()
+    for _ in range(repeat):
+        fn()
+    return round((time.process_time() - t) / repeat * 1000, 3)
+
+def encoded(img: Image.Image, **options) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, **options)
+    return buf.getvalue()
+
+def timings(A, st, repeat: int) -> dict:
+    """Compose and encode times of both paths for one student, plus the speedups."""
+    native = lambda: A.compose_id_card(st, scale=A.PREVIEW_SCALE)
+    cold_qr = lambda: (A.card_qr.cache_clear(), native())[1]
+    png = A.CARD_FORMATS["preview"][3]
+    encodings = {"png": png}
+    if A.webp_enabled():
+        encodings["webp"] = A.CARD_FORMATS["preview_webp"][3]
+    out = {}
+    for name, compose, formats in (("reference", lambda: reference_preview(A, st), {"png": png}),
+                                   ("native", native, encodings), ("native_cold_qr", cold_qr, {})):
+        img = compose()
+        res = {"compose": {**timeit(compose, repeat), "cpu_ms": cpu_ms(compose, repeat)}}
+        for fmt, options in formats.items():
+            res[f"encode_{fmt}"] = {**timeit(lambda: encoded(img, **options), repeat),
+                                    "cpu_ms": cpu_ms(lambda: encoded(img, **options), repeat),
+                                    "bytes": len(encoded(img, **options))}
+        out[name] = res
+    out["compose_speedup_p50"] = round(out["reference"]["compose"]["p50_ms"] / out["native"]["compose"]["p50_ms"], 1)
+    out["png_total_speedup_p50"] = round(
+        (out["reference"]["compose"]["p50_ms"] + out["reference"]["encode_png"]["p50_ms"])
+        / (out["native"]["compose"]["p50_ms"] + out["native"]["encode_png"]["p50_ms"]), 1)
+    return out
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--students", type=int, default=5, help="distinct students to diff")
+    ap.add_argument("--repeat", type=int, default=30)
+    ap.add_argument("--min-psnr", type=float, default=32.0)
+    ap.add_argument("--save", help="write reference/native PNG pairs into this folder for a visual check")
+    ap.add_argument("--check", action="store_true", help="only the fidelity test, no timing")
+    args = ap.parse_args()
+    save_dir = os.path.abspath(args.save) if args.save else None
+    tmp = use_temp_app_dir("aop-preview-")
+    import app as A
+    A.metrics.enabled = False
+
+    students = [make_student(tempfile.mkdtemp(dir=tmp), i) for i in range(args.students)]
+    for st in students:
+        A.ingest_image(st["passport_path"], 'pass'); A.ingest_image(st["signature_path"], 'sig')
+    out = {} if args.check else timings(A, students[0], args.repeat)
+
+    diffs = []
+    for st in students:
+        ref, native = reference_preview(A, st), A.compose_id_card(st, scale=A.PREVIEW_SCALE)
+        assert native.size == ref.size, (native.size, ref.size)
+        diffs.append(image_diff(ref, native))
+        if save_dir:
+            os.makedirs(save_dir, exist_ok=True)
+            ref.save(os.path.join(save_dir, f"{st['id']}_reference.png"))
+            native.save(os.path.join(save_dir, f"{st['id']}_native.png"))
+    out["fidelity"] = {"worst_psnr_db": min(d["psnr_db"] for d in diffs),
+                       "worst_mean_abs": max(d["mean_abs"] for d in diffs),
+                       "worst_p99_abs": max(d["p99_abs"] for d in diffs)}
+    print(json.dumps(out, indent=2))
+    if out["fidelity"]["worst_psnr_db"] < args.min_psnr:
+        sys.exit(f"native preview PSNR {out['fidelity']['worst_psnr_db']} dB is below {args.min_psnr} dB")
+
+if __name__ == "__main__":
+    main()
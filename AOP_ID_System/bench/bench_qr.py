@@ -0,0 +1,67 @@
+"""
+Card QR: the old multi-line text (level H) versus the signed compact code
+(level M, alphanumeric). Reports payload size, QR version, encode time,
+decode-and-verify time and, when pyzbar or OpenCV is installed, the time a
+scanner library needs to read the printed QR back from the card image.
+
+    python bench/bench_qr.py --cards 200
+"""
+from __future__ import annotations
+import argparse, json, time
+
+from common import use_temp_app_dir, percentiles
+
+def load_reader():
+    try:
+        from pyzbar.pyzbar import decode
+        return "pyzbar", lambda img: decode(img)[0].data.decode()
+    except ImportError:
+        pass
+    try:
+        import cv2, numpy as np
+        det = cv2.QRCodeDetector()
+        return "opencv", lambda img: det.detectAndDecode(np.array(img.convert("L")))[0]
+    except ImportError:
+        return None, None
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--cards", type=int, default=200)
+    args = ap.parse_args()
+    use_temp_app_dir()
+    import app as A
+    reader_name, read = load_reader()
+    students = [{"reg_no": f"AOP/CS/{i:06d}", "full_name": f"Oluwaseun Adebayo Okafor {i}", "course": "Computer Science",
+                 "level": "HND2", "dob": "2004-05-17", "created_at": "2026-01-15T09:00:00", "card_serial": 100000 + i}
+                for i in range(args.cards)]
+    out = {"cards": args.cards, "signing_alg": A.get_card_signer().bundle()["alg"], "scanner": reader_name}
+    for fmt in ("text", "signed"):
+        texts, versions, encode, images = [], set(), [], []
+        for st in students:
+            t = time.perf_counter()
+            text = A.card_qr_text(st, fmt)
+            qr = A.make_card_qr(text)
+            img = A.card_qr_image(qr, 220)
+            encode.append((time.perf_counter() - t) * 1000)
+            texts.append(text); versions.add(qr.version); images.append(img)
+        res = {"payload_chars": max(len(t) for t in texts), "qr_versions": sorted(versions),
+               "modules": 17 + 4 * max(versions), "encode": percentiles(encode)}
+        samples = []
+        for text in texts:
+            t = time.perf_counter()
+            A.verify_scan(text) if fmt == "text" else A.get_card_verifier().verify(text)
+            samples.append((time.perf_counter() - t) * 1000)
+        res["verify"] = percentiles(samples)
+        if read:
+            samples, misreads = [], 0
+            for img, text in zip(images, texts):
+                t = time.perf_counter()
+                got = read(img)
+                samples.append((time.perf_counter() - t) * 1000)
+                misreads += got != text
+            res["scan"] = {**percentiles(samples), "misreads": misreads}
+        out[fmt] = res
+    print(json.dumps(out, indent=2))
+
+if __name__ == "__main__":
+    main()
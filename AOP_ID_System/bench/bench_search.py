@@ -0,0 +1,74 @@
+"""
+Admin search latency: leading-wildcard LIKE (the old query) versus the FTS5
+index, through list_students_page() and the typeahead helper.
+
+    python bench/bench_search.py --students 100000 --queries 200
+"""
+from __future__ import annotations
+import argparse, json, random, time
+from datetime import datetime
+
+from common import use_temp_app_dir, percentiles
+
+FIRST = ["Adebayo", "Chinedu", "Fatima", "Ngozi", "Oluwaseun", "Ibrahim", "Aisha", "Emeka", "Funmilayo", "Tunde",
+         "Zainab", "Kehinde", "Segun", "Amaka", "Yusuf", "Bola", "Kunle", "Halima", "Ifeoma", "Musa"]
+LAST = ["Okafor", "Adeyemi", "Bello", "Olawale", "Eze", "Abubakar", "Ogundipe", "Nwosu", "Balogun", "Lawal",
+        "Afolabi", "Okonkwo", "Salami", "Ajayi", "Obi", "Danjuma", "Oyelaran", "Akande", "Uche", "Raji"]
+COURSES = ["Computer Science", "Accountancy", "Mass Communication", "Electrical Engineering", "Business Administration",
+           "Science Laboratory Technology", "Statistics", "Estate Management"]
+
+def seed(A, n: int, rnd: random.Random):
+    now = datetime.utcnow().isoformat()
+    conn = A.connect_db()
+    with conn:
+        conn.executemany("""
+            INSERT INTO users (role, full_name, course, reg_no, level, email, is_approved, created_at)
+            VALUES ('student',?,?,?,?,?,?,?)
+        """, ((f"{rnd.choice(FIRST)} {rnd.choice(FIRST)} {rnd.choice(LAST)}", rnd.choice(COURSES), f"AOP/{i % 97:02d}/{i:06d}",
+               rnd.choice(["ND1", "ND2", "HND1", "HND2"]), f"student{i}@aop.edu.ng", i % 2, now) for i in range(n)))
+    conn.close()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--students", type=int, default=100_000)
+    ap.add_argument("--queries", type=int, default=200)
+    args = ap.parse_args()
+    rnd = random.Random(7)
+    use_temp_app_dir()
+    import app as A
+    t = time.perf_counter()
+    seed(A, args.students, rnd)
+    seeded = time.perf_counter() - t
+
+    queries = []
+    for _ in range(args.queries):
+        kind = rnd.random()
+        if kind < 0.4:
+            queries.append(rnd.choice(LAST)[:rnd.randint(3, 6)])
+        elif kind < 0.7:
+            queries.append(f"{rnd.choice(FIRST)} {rnd.choice(LAST)[:3]}")
+        else:
+            i = rnd.randrange(args.students)
+            queries.append(f"AOP/{i % 97:02d}/{i:06d}")
+
+    conn = A.connect_db()
+    like = lambda q: ("full_name LIKE ? OR reg_no LIKE ?", (f"%{q}%", f"%{q}%"))
+    results = {}
+    for name, build, drive in (("like_page", like, False), ("fts_page", A.student_search_filter, True)):
+        samples = []
+        for q in queries:
+            where, qargs = build(q)
+            t = time.perf_counter()
+            A.list_students_page(conn, 'name', 'asc', where=where, args=qargs, drive_by_filter=drive)
+            samples.append((time.perf_counter() - t) * 1000)
+        results[name] = percentiles(samples)
+    samples = []
+    for q in queries:
+        t = time.perf_counter()
+        A.search_students(conn, q)
+        samples.append((time.perf_counter() - t) * 1000)
+    results["typeahead"] = percentiles(samples)
+    print(json.dumps({"students": args.students, "seed_seconds": round(seeded, 1), "fts5": A.has_fts5(), **results}, indent=2))
+
+if __name__ == "__main__":
+    main()
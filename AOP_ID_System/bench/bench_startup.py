@@ -0,0 +1,108 @@
+"""
+Startup cost and per-worker memory.
+
+Cold start: median wall time and peak RSS of `import app` in a fresh
+interpreter (the schema already migrated, as after `flask --app app migrate`),
+and which heavy modules the import pulled in.
+
+Worker memory: a parent loads the app (with and without preload_app),
+forks --workers children like a prefork server and each child serves a few
+requests that render cards. Reported is each worker's unique set size (USS:
+pages nobody else shares) and PSS, from /proc/<pid>/smaps_rollup (Linux).
+
+    python bench/bench_startup.py --runs 9 --workers 4
+"""
+from __future__ import annotations
+import argparse, json, os, statistics, subprocess, sys, tempfile
+
+from common import APP_DIR, use_temp_app_dir, make_student
+
+IMPORT_SNIPPET = """
+import resource, sys, time
+sys.path.insert(0, {app_dir!r})
+t = time.perf_counter()
+import app
+print((time.perf_counter() - t) * 1000, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+      ",".join(m for m in ("PIL", "qrcode", "cryptography") if m in sys.modules) or "-")
+"""
+MIGRATE_SNIPPET = """
+import sys
+sys.path.insert(0, {app_dir!r})
+import app
+app.init_db()
+"""
+
+def smaps_kb(pid: int) -> dict:
+    out = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                out[parts[0].rstrip(":")] = int(parts[1])
+    return out
+
+def cold_start(runs: int) -> dict:
+    subprocess.run([sys.executable, "-c", MIGRATE_SNIPPET.format(app_dir=APP_DIR)], check=True, capture_output=True)
+    ms, rss = [], []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET.format(app_dir=APP_DIR)],
+                             check=True, capture_output=True, text=True).stdout.split()
+        ms.append(float(out[0])); rss.append(float(out[1]))
+    return {"import_p50_ms": round(statistics.median(ms), 1), "import_max_rss_mb": round(statistics.median(rss), 1),
+            "heavy_modules_loaded": out[2]}
+
+def fork_workers(preload: bool, workers: int, requests: int) -> dict:
+    """Runs in its own interpreter (see main) so the two modes do not share state."""
+    tmp = os.getcwd()
+    import app as A
+    st = make_student(tempfile.mkdtemp(dir=tmp), 0)
+    A.ingest_image(st["passport_path"], 'pass'); A.ingest_image(st["signature_path"], 'sig')
+    if preload:
+        A.preload_app()
+    ready_r, ready_w = os.pipe()
+    go_r, go_w = os.pipe()
+    pids = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r); os.close(go_w)
+            client = A.app.test_client()
+            client.get("/login")
+            for n in range(requests):  # a different student per request, so nothing comes from the render cache
+                A.encode_card(dict(st, id=1000 * i + n, reg_no=f"AOP/CS/{i:02d}{n:04d}"), "preview")
+            os.write(ready_w, b"x")
+            os.read(go_r, 1)  # stay alive until the parent has read our smaps
+            os._exit(0)
+        pids.append(pid)
+    os.close(ready_w); os.close(go_r)
+    for _ in pids:
+        os.read(ready_r, 1)
+    stats = [smaps_kb(pid) for pid in pids]
+    os.write(go_w, b"x" * len(pids))
+    for pid in pids:
+        os.waitpid(pid, 0)
+    uss = [(s.get("Private_Clean", 0) + s.get("Private_Dirty", 0)) / 1024 for s in stats]
+    pss = [s.get("Pss", 0) / 1024 for s in stats]
+    return {"workers": workers, "worker_uss_mb": round(statistics.fmean(uss), 1), "worker_pss_mb": round(statistics.fmean(pss), 1),
+            "parent_rss_mb": round(smaps_kb(os.getpid()).get("Rss", 0) / 1024, 1)}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=9)
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--requests", type=int, default=5, help="cards each worker renders before it is measured")
+    ap.add_argument("--fork-mode", choices=["preload", "lazy"], help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    use_temp_app_dir("aop-startup-")
+    if args.fork_mode:
+        print(json.dumps(fork_workers(args.fork_mode == "preload", args.workers, args.requests)))
+        return
+    out = {"cold_start": cold_start(args.runs)}
+    for mode in ("lazy", "preload"):
+        run = subprocess.run([sys.executable, os.path.abspath(__file__), "--fork-mode", mode, "--workers", str(args.workers),
+                              "--requests", str(args.requests)], check=True, capture_output=True, text=True)
+        out[mode] = json.loads(run.stdout)
+    print(json.dumps(out, indent=2))
+
+if __name__ == "__main__":
+    main()
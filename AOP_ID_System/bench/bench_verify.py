@@ -0,0 +1,78 @@
+"""
+Gate verification: in-memory index lookups, /verify round trips through the
+Flask test client, /verify/batch throughput and the cost of picking up changes.
+
+    python bench/bench_verify.py --students 100000 --scans 20000
+"""
+from __future__ import annotations
+import argparse, json, os, random, time
+
+from common import use_temp_app_dir, percentiles
+from bench_search import seed
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--students", type=int, default=100_000)
+    ap.add_argument("--scans", type=int, default=20_000)
+    ap.add_argument("--batch", type=int, default=1000)
+    args = ap.parse_args()
+    rnd = random.Random(11)
+    use_temp_app_dir()
+    os.environ["VERIFY_API_TOKEN"] = "bench"
+    import app as A
+    A.VERIFY_API_TOKEN = "bench"
+    seed(A, args.students, rnd)
+
+    t = time.perf_counter()
+    A.verify_index.refresh(force=True)
+    load_ms = (time.perf_counter() - t) * 1000
+
+    def code(i):
+        if rnd.random() < 0.05:
+            return "REG:AOP/XX/999999"  # unknown card
+        return f"REG:AOP/{i % 97:02d}/{i:06d}\nName: x\nCourse: y\nLevel: ND1\nDOB: 2004-01-01"
+    codes = [code(rnd.randrange(args.students)) for _ in range(args.scans)]
+
+    samples = []
+    for c in codes:
+        t = time.perf_counter()
+        A.verify_scan(c)
+        samples.append((time.perf_counter() - t) * 1000)
+    results = {"lookup": percentiles(samples)}
+
+    client = A.app.test_client()
+    headers = {"Authorization": "Bearer bench"}
+    samples = []
+    for c in codes[:2000]:
+        t = time.perf_counter()
+        r = client.get("/verify", query_string={"code": c}, headers=headers)
+        samples.append((time.perf_counter() - t) * 1000)
+        assert r.status_code == 200
+    results["http_verify"] = percentiles(samples)
+
+    t = time.perf_counter()
+    sent = 0
+    for i in range(0, len(codes), args.batch):
+        chunk = codes[i:i + args.batch]
+        r = client.post("/verify/batch", json={"scans": [{"code": c, "scanned_at": "2026-01-01T08:00:00"} for c in chunk]},
+                        headers=headers)
+        assert r.status_code == 200
+        sent += len(chunk)
+    results["batch_scans_per_sec"] = round(sent / (time.perf_counter() - t))
+
+    conn = A.connect_db()
+    ids = [r[0] for r in conn.execute("SELECT id FROM users ORDER BY random() LIMIT 200")]
+    with conn:
+        conn.executemany("UPDATE users SET is_approved=1-is_approved, id_print_count=id_print_count+1 WHERE id=?", [(i,) for i in ids])
+    t = time.perf_counter()
+    A.verify_index.refresh(force=True)
+    results["refresh_200_changes_ms"] = round((time.perf_counter() - t) * 1000, 3)
+    row = conn.execute("SELECT reg_no, is_approved, id_print_count FROM users WHERE id=?", (ids[0],)).fetchone()
+    entry = A.verify_index.lookup(row["reg_no"])
+    results["refresh_consistent"] = entry["approved"] == bool(row["is_approved"]) and entry["print_count"] == row["id_print_count"]
+    conn.close()
+
+    print(json.dumps({"students": args.students, "scans": args.scans, "initial_load_ms": round(load_ms, 1), **results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Shared helpers for the benchmark scripts in this folder."""
+from __future__ import annotations
+import os, sys, time, statistics
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def use_app_dir():
+    """app.py uses paths relative to its own folder; run from there."""
+    os.chdir(APP_DIR)
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+
+def use_temp_app_dir(prefix: str = "aop-bench-") -> str:
+    """
+    Run the app against a throwaway working directory (fresh data/app.db,
+    uploads, cache) so benchmarks never touch the real database.
+    """
+    import atexit, shutil, tempfile
+    tmp = tempfile.mkdtemp(prefix=prefix)
+    atexit.register(shutil.rmtree, tmp, ignore_errors=True)
+    os.makedirs(os.path.join(tmp, "assets"), exist_ok=True)
+    logo = os.path.join(APP_DIR, "assets", "aop_logo.png")
+    if os.path.exists(logo):
+        shutil.copy(logo, os.path.join(tmp, "assets"))
+    os.chdir(tmp)
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+    return tmp
+
+def percentiles(samples_ms: list[float]) -> dict:
+    if not samples_ms:
+        return {"count": 0}
+    s = sorted(samples_ms)
+    pick = lambda q: round(s[min(len(s) - 1, int(len(s) * q))], 3)
+    return {"count": len(s), "mean_ms": round(statistics.fmean(s), 3), "p50_ms": pick(0.5),
+            "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": round(s[-1], 3)}
+
+def make_passport(path: str, size=(1200, 1600), seed: int = 0):
+    """Write a phone-sized synthetic passport photo (gradient + noise, so it compresses like a photo)."""
+    from PIL import Image, ImageDraw
+    im = Image.effect_noise(size, 40 + seed % 20).convert("RGB")
+    grad = Image.linear_gradient("L").resize(size)
+    im = Image.merge("RGB", (grad, im.getchannel(0), Image.new("L", size, 120 + seed % 100)))
+    d = ImageDraw.Draw(im)
+    w, h = size
+    d.ellipse((w * 0.25, h * 0.15, w * 0.75, h * 0.6), fill=(200, 160, 130))
+    im.save(path, quality=90)
+    return path
+
+def make_signature(path: str, seed: int = 0):
+    from PIL import Image, ImageDraw
+    im = Image.new("RGB", (600, 200), "white")
+    d = ImageDraw.Draw(im)
+    pts = [(40 + i * 26, 100 + ((i * 37 + seed) % 60) - 30) for i in range(20)]
+    d.line(pts, fill="black", width=4)
+    im.save(path)
+    return path
+
+def make_student(img_dir: str, i: int = 0) -> dict:
+    return {
+        "id": i + 1,
+        "full_name": f"Student Number {i:05d}",
+        "sex": "Female" if i % 2 else "Male",
+        "dob": "2004-05-17",
+        "blood_group": "O+",
+        "course": "Computer Science",
+        "reg_no": f"AOP/CS/{i:06d}",
+        "level": "ND1",
+        "created_at": "2026-01-15T09:00:00",
+        "card_serial": i + 1,
+        "passport_path": make_passport(os.path.join(img_dir, f"pass_{i}.jpg"), seed=i),
+        "signature_path": make_signature(os.path.join(img_dir, f"sig_{i}.png"), seed=i),
+    }
+
+def timeit(fn, repeat: int = 20, warmup: int = 2) -> dict:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t) * 1000)
+    samples.sort()
+    return {
+        "mean_ms": round(statistics.fmean(samples), 3),
+        "p50_ms": round(samples[len(samples) // 2], 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+    }
@@ -0,0 +1,229 @@
+"""
+Benchmark suite: seeds a throwaway database with synthetic students (real
+generated passport/signature images) and times card rendering, the admin
+HTTP paths, exports and print throughput. Results are written as JSON so runs
+can be compared; --compare exits non-zero when a metric regressed.
+
+    python bench/suite.py --students 20000 -o bench-20k.json
+    python bench/suite.py --students 20000 --compare bench-20k.json --threshold 0.2
+
+Metrics ending in _ms are latencies (lower is better), *_per_sec are rates.
+Only p50 latencies and rates take part in the comparison; use a --repeat
+high enough for stable medians on the machine you compare on.
+"""
+from __future__ import annotations
+import argparse, json, os, platform, random, subprocess, sys, threading, time
+from datetime import datetime
+
+from common import APP_DIR, use_temp_app_dir, make_passport, make_signature, percentiles, timeit
+from bench_search import FIRST, LAST, COURSES
+
+LEVELS = ["ND1", "ND2", "HND1", "HND2"]
+FAST_HASH = "pbkdf2:sha256:1"
+
+def seed(A, n: int, images: int, rnd: random.Random) -> float:
+    from werkzeug.security import generate_password_hash
+    t = time.perf_counter()
+    pool = []
+    for i in range(images):
+        passport = make_passport(os.path.join(A.UPLOAD_DIR, f"pass_bench{i}.jpg"), seed=i)
+        signature = make_signature(os.path.join(A.SIGN_DIR, f"sig_bench{i}.png"), seed=i)
+        A.ingest_image(passport, 'pass')
+        A.ingest_image(signature, 'sig')
+        pool.append((passport, signature))
+    now = datetime.utcnow().isoformat()
+    pw = generate_password_hash("secret", method=FAST_HASH)
+    conn = A.connect_db()
+    with conn:
+        conn.execute("INSERT INTO users (role, full_name, email, password_hash, created_at) VALUES ('admin','Bench Admin','admin@bench',?,?)",
+                     (pw, now))
+        conn.executemany("""
+            INSERT INTO users (role, full_name, sex, dob, blood_group, course, reg_no, level, email, password_hash,
+                               passport_path, signature_path, is_approved, id_print_count, created_at)
+            VALUES ('student',?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """, ((f"{rnd.choice(FIRST)} {rnd.choice(FIRST)} {rnd.choice(LAST)}", rnd.choice(["Male", "Female"]),
+               f"200{rnd.randint(0, 6)}-0{rnd.randint(1, 9)}-1{rnd.randint(0, 9)}", rnd.choice(["O+", "A+", "B+", "AB+"]),
+               rnd.choice(COURSES), f"AOP/{i % 97:02d}/{i:06d}", rnd.choice(LEVELS), f"student{i}@aop.edu.ng", pw,
+               *pool[i % len(pool)], int(rnd.random() < 0.8), 0, now) for i in range(n)))
+    conn.close()
+    return round(time.perf_counter() - t, 2)
+
+def bench_render(A, repeat: int) -> dict:
+    conn = A.connect_db()
+    student = conn.execute("SELECT * FROM users WHERE role='student' LIMIT 1").fetchone()
+    conn.close()
+    return {
+        "compose_id_card": timeit(lambda: A.compose_id_card(student), repeat),
+        "encode_preview_png": timeit(lambda: A.encode_card(student, "preview"), repeat),
+        "encode_pdf": timeit(lambda: A.encode_card(student, "pdf"), repeat),
+        "print_jpeg": timeit(lambda: A.render_card_jpeg(dict(student)), repeat),
+    }
+
+def time_gets(client, urls: list[str]) -> dict:
+    client.get(urls[0])  # warm up
+    samples = []
+    for url in urls:
+        t = time.perf_counter()
+        r = client.get(url)
+        b"".join(r.response)  # drain streamed bodies too
+        samples.append((time.perf_counter() - t) * 1000)
+        assert r.status_code == 200, (url, r.status_code)
+    return percentiles(samples)
+
+def admin_client(A):
+    client = A.app.test_client()
+    admin_id = A.connect_db().execute("SELECT id FROM users WHERE role='admin'").fetchone()[0]
+    with client.session_transaction() as s:
+        s["user_id"] = admin_id; s["role"] = "admin"
+    return client
+
+def bench_http(A, repeat: int, rnd: random.Random) -> dict:
+    client = admin_client(A)
+    out = {
+        "dashboard_first_page": time_gets(client, ["/admin/dashboard"] * repeat),
+        "dashboard_sorted_by_name": time_gets(client, ["/admin/dashboard?sort=name&dir=asc"] * repeat),
+    }
+    # walk 20 pages deep with the keyset cursor
+    conn = A.connect_db()
+    page = A.list_students_page(conn, 'name', 'asc')
+    for _ in range(20):
+        page = A.list_students_page(conn, 'name', 'asc', after=page['next']) if page['next'] else page
+    conn.close()
+    out["dashboard_page_20"] = time_gets(client, [f"/admin/dashboard?sort=name&dir=asc&after={page['next'] or ''}"] * repeat)
+    out["dashboard_search"] = time_gets(client, [f"/admin/dashboard?q={rnd.choice(LAST)[:4]}" for _ in range(repeat)])
+    out["typeahead"] = time_gets(client, [f"/admin/search.json?q={rnd.choice(FIRST)[:3]}" for _ in range(repeat)])
+    return out
+
+def bench_export(A, students: int) -> dict:
+    client = admin_client(A)
+    out = {}
+    for fmt in ("csv", "csv.gz", "xlsx"):
+        t = time.perf_counter()
+        r = client.get(f"/admin/export.{fmt}")
+        size = sum(len(chunk) for chunk in r.response)
+        secs = time.perf_counter() - t
+        out[fmt] = {"total_ms": round(secs * 1000, 1), "rows_per_sec": round(students / secs), "bytes": size}
+    return out
+
+def bench_print(A, cards: int, threads: int) -> dict:
+    conn = A.connect_db()
+    students = [dict(r) for r in conn.execute("SELECT * FROM users WHERE role='student' AND is_approved=1 LIMIT ?", (cards,))]
+    conn.close()
+
+    class Null:
+        def write(self, b): return len(b)
+    t = time.perf_counter()
+    A.write_print_batch(Null(), students, layout='a4')
+    batch = time.perf_counter() - t
+
+    # concurrent single-card downloads of distinct students (every one a cache miss)
+    ids = [s["id"] for s in students]
+    samples, lock = [], threading.Lock()
+    def worker(chunk):
+        client = admin_client(A)
+        for uid in chunk:
+            t0 = time.perf_counter()
+            r = client.get(f"/admin/print-id/{uid}")
+            assert r.status_code == 200
+            with lock:
+                samples.append((time.perf_counter() - t0) * 1000)
+    t = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(ids[i::threads],)) for i in range(threads)]
+    for th in pool: th.start()
+    for th in pool: th.join()
+    single = time.perf_counter() - t
+    return {
+        "batch_pdf": {"cards": len(students), "workers": A.BATCH_WORKERS, "cards_per_sec": round(len(students) / batch, 1)},
+        "concurrent_card_pdf": {"threads": threads, "cards_per_sec": round(len(ids) / single, 1), **percentiles(samples)},
+    }
+
+def flatten(d: dict, prefix: str = "") -> dict:
+    out = {}
+    for k, v in d.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(flatten(v, key + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[key] = v
+    return out
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    cur, base = flatten(current["results"]), flatten(baseline["results"])
+    problems = []
+    for key, old in sorted(base.items()):
+        new = cur.get(key)
+        if new is None or not old:
+            continue
+        if key.endswith("p50_ms"):
+            change = new / old - 1
+        elif key.endswith("_per_sec"):
+            change = old / new - 1 if new else float("inf")
+        else:
+            continue
+        flag = "REGRESSION" if change > threshold else ""
+        print(f"{key:55s} {old:>12} -> {new:>12}  {change * 100:+7.1f}% {flag}", file=sys.stderr)
+        if flag:
+            problems.append(key)
+    return problems
+
+def git_rev() -> str:
+    try:
+        return subprocess.run(["git", "-C", APP_DIR, "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--students", type=int, default=10_000, help="1k..200k")
+    ap.add_argument("--images", type=int, default=20, help="distinct generated photo/signature pairs")
+    ap.add_argument("--repeat", type=int, default=20)
+    ap.add_argument("--print-cards", type=int, default=100)
+    ap.add_argument("--threads", type=int, default=4)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--skip", default="", help="comma list of sections to skip: render,http,export,print")
+    ap.add_argument("-o", "--output", help="write results JSON here (default: stdout)")
+    ap.add_argument("--compare", help="baseline JSON from an earlier run")
+    ap.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown before failing (0.2 = 20%%)")
+    args = ap.parse_args()
+    rnd = random.Random(args.seed)
+    skip = set(filter(None, args.skip.split(",")))
+    output = os.path.abspath(args.output) if args.output else None  # before we chdir away
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+
+    use_temp_app_dir("aop-suite-")
+    os.environ.setdefault("JOB_WORKERS", "0")
+    import app as A
+    A.metrics.enabled = False
+    seconds = seed(A, args.students, args.images, rnd)
+    results = {}
+    if "render" not in skip:
+        results["render"] = bench_render(A, args.repeat)
+    if "http" not in skip:
+        results["http"] = bench_http(A, args.repeat, rnd)
+    if "export" not in skip:
+        results["export"] = bench_export(A, args.students)
+    if "print" not in skip:
+        results["print"] = bench_print(A, args.print_cards, args.threads)
+    report = {
+        "meta": {"git": git_rev(), "time": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+                 "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "students": args.students, "images": args.images, "repeat": args.repeat, "seed_seconds": seconds},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("students") != args.students:
+            print(f"note: baseline seeded {baseline['meta'].get('students')} students, this run {args.students}", file=sys.stderr)
+        problems = compare(report, baseline, args.threshold)
+        if problems:
+            raise SystemExit(f"{len(problems)} metric(s) regressed by more than {args.threshold:.0%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Compact signed payload for the ID card QR code.
+
+A card code is PREFIX + base45(body + signature), where body is
+
+    alg (1 byte) | serial (uint32) | expiry (uint16, days since 2000-01-01)
+    | reg_no length (1 byte) | reg_no (ASCII)
+
+Base45 only uses characters from the QR alphanumeric set, so the whole code
+is encoded in alphanumeric mode (5.5 bits per character instead of 8).
+
+Cards are signed with Ed25519 (needs the `cryptography` package) or, when
+the key is set up for it, with a truncated HMAC-SHA256. The algorithm is
+part of the key, never picked from what happens to be installed. A gate
+device verifies codes offline with a bundle (public key or shared HMAC key,
+plus the list of revoked serials) exported by the app. This module has no
+dependency on the app so it can be copied onto gate devices as is.
+"""
+from __future__ import annotations
+import base64
+import hashlib
+import hmac
+import importlib.util
+import struct
+import zlib
+from datetime import date, timedelta
+
+# cryptography is slow to import and adds several MB to every process, so it
+# is only imported once an Ed25519 signer or verifier is actually built.
+HAS_ED25519 = importlib.util.find_spec("cryptography") is not None
+
+PREFIX = "AOP1:"
+BUNDLE_FORMAT = "aop-card-bundle/1"
+ALG_ED25519, ALG_HMAC = 1, 2
+ALG_NAMES = {ALG_ED25519: "ed25519", ALG_HMAC: "hmac-sha256-128"}
+SIGNER_ALGS = ("ed25519", "hmac")
+SIG_LEN = {ALG_ED25519: 64, ALG_HMAC: 16}
+EPOCH = date(2000, 1, 1)
+
+B45_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:"
+_B45_VALUES = {c: i for i, c in enumerate(B45_ALPHABET)}
+
+
+def b45encode(data: bytes) -> str:
+    """Base45 (RFC 9285)."""
+    out = []
+    for i in range(0, len(data) - 1, 2):
+        n = data[i] * 256 + data[i + 1]
+        n, c = divmod(n, 45)
+        e, d = divmod(n, 45)
+        out += (B45_ALPHABET[c], B45_ALPHABET[d], B45_ALPHABET[e])
+    if len(data) % 2:
+        d, c = divmod(data[-1], 45)
+        out += (B45_ALPHABET[c], B45_ALPHABET[d])
+    return "".join(out)
+
+
+def b45decode(text: str) -> bytes:
+    try:
+        values = [_B45_VALUES[c] for c in text]
+    except KeyError:
+        raise ValueError("not base45") from None
+    out = bytearray()
+    for i in range(0, len(values), 3):
+        chunk = values[i:i + 3]
+        if len(chunk) == 3:
+            n = chunk[0] + chunk[1] * 45 + chunk[2] * 2025
+            if n > 0xFFFF:
+                raise ValueError("not base45")
+            out += bytes(divmod(n, 256))
+        elif len(chunk) == 2:
+            n = chunk[0] + chunk[1] * 45
+            if n > 0xFF:
+                raise ValueError("not base45")
+            out.append(n)
+        else:
+            raise ValueError("not base45")
+    return bytes(out)
+
+
+def pack_body(alg: int, reg_no: str, serial: int, expires: date) -> bytes:
+    reg = reg_no.encode("ascii", "replace")[:255]
+    days = max(0, min(0xFFFF, (expires - EPOCH).days))
+    return struct.pack(">BIHB", alg, serial & 0xFFFFFFFF, days, len(reg)) + reg
+
+
+def unpack_code(text: str) -> dict:
+    """Split a scanned code into its fields; raises ValueError if it is not a card code."""
+    if not text.startswith(PREFIX):
+        raise ValueError("not a card code")
+    raw = b45decode(text[len(PREFIX):])
+    if len(raw) < 8:
+        raise ValueError("truncated card code")
+    alg, serial, days, reg_len = struct.unpack(">BIHB", raw[:8])
+    if alg not in SIG_LEN or len(raw) != 8 + reg_len + SIG_LEN[alg]:
+        raise ValueError("malformed card code")
+    body = raw[:8 + reg_len]
+    return {
+        "alg": alg, "serial": serial, "expires": EPOCH + timedelta(days=days),
+        "reg_no": body[8:].decode("ascii", "replace"), "body": body, "signature": raw[len(body):],
+    }
+
+
+def pack_serials(serials) -> str:
+    """Revocation list: sorted serials as delta varints, deflated, base64."""
+    out = bytearray()
+    prev = 0
+    for s in sorted(set(serials)):
+        n = s - prev
+        prev = s
+        while n >= 0x80:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+    return base64.b64encode(zlib.compress(bytes(out), 9)).decode()
+
+
+def unpack_serials(text: str) -> set[int]:
+    data = zlib.decompress(base64.b64decode(text)) if text else b""
+    serials, cur, n, shift = set(), 0, 0, 0
+    for byte in data:
+        n |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            cur += n
+            serials.add(cur)
+            n = shift = 0
+    return serials
+
+
+class CardSigner:
+    """
+    Issues card codes from a 32-byte secret. alg is "ed25519" or "hmac"; the
+    secret is the Ed25519 seed or the HMAC key respectively.
+    """
+
+    def __init__(self, secret: bytes, alg: str = "ed25519"):
+        if len(secret) != 32:
+            raise ValueError("card signing key must be 32 bytes")
+        if alg == "ed25519":
+            if not HAS_ED25519:
+                raise RuntimeError("Ed25519 card signing needs the 'cryptography' package")
+            from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+            from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+            self.alg = ALG_ED25519
+            self._private = Ed25519PrivateKey.from_private_bytes(secret)
+            self.public_key = self._private.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        elif alg == "hmac":
+            self.alg = ALG_HMAC
+            self._secret = secret
+            self.public_key = None
+        else:
+            raise ValueError(f"Unknown card signing algorithm: {alg}")
+        self.alg_name = alg
+        self.key_id = hashlib.sha256(self.public_key or b"hmac:" + secret).hexdigest()[:16]
+
+    def sign(self, body: bytes) -> bytes:
+        if self.alg == ALG_ED25519:
+            return self._private.sign(body)
+        return hmac.new(self._secret, body, hashlib.sha256).digest()[:SIG_LEN[ALG_HMAC]]
+
+    def encode(self, reg_no: str, serial: int, expires: date) -> str:
+        body = pack_body(self.alg, reg_no, serial, expires)
+        return PREFIX + b45encode(body + self.sign(body))
+
+    def bundle(self, revoked_serials=(), issued_at: str = "") -> dict:
+        """Everything a gate device needs to verify codes offline."""
+        out = {
+            "format": BUNDLE_FORMAT, "alg": ALG_NAMES[self.alg], "key_id": self.key_id, "issued_at": issued_at,
+            "revoked": pack_serials(revoked_serials), "revoked_count": len(set(revoked_serials)),
+        }
+        if self.alg == ALG_ED25519:
+            out["public_key"] = base64.b64encode(self.public_key).decode()
+        else:
+            # symmetric: the bundle can mint cards too, keep it on trusted devices only
+            out["hmac_key"] = base64.b64encode(self._secret).decode()
+        return out
+
+
+class CardVerifier:
+    """Offline verification of card codes against an exported bundle."""
+
+    def __init__(self, bundle: dict):
+        if bundle.get("format") != BUNDLE_FORMAT:
+            raise ValueError("unsupported bundle format")
+        self.revoked = unpack_serials(bundle.get("revoked", ""))
+        if bundle["alg"] == ALG_NAMES[ALG_ED25519]:
+            if not HAS_ED25519:
+                raise RuntimeError("Ed25519 bundles need the 'cryptography' package")
+            from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+            self.alg = ALG_ED25519
+            self._public = Ed25519PublicKey.from_public_bytes(base64.b64decode(bundle["public_key"]))
+        elif bundle["alg"] == ALG_NAMES[ALG_HMAC]:
+            self.alg = ALG_HMAC
+            self._secret = base64.b64decode(bundle["hmac_key"])
+        else:
+            raise ValueError(f"Unknown card signing algorithm: {bundle['alg']}")
+
+    def signature_ok(self, code: dict) -> bool:
+        if code["alg"] != self.alg:
+            return False
+        if self.alg == ALG_ED25519:
+            from cryptography.exceptions import InvalidSignature
+            try:
+                self._public.verify(code["signature"], code["body"])
+                return True
+            except InvalidSignature:
+                return False
+        expected = hmac.new(self._secret, code["body"], hashlib.sha256).digest()[:SIG_LEN[ALG_HMAC]]
+        return hmac.compare_digest(expected, code["signature"])
+
+    def verify(self, text: str, today: date | None = None) -> dict:
+        """Returns reg_no, serial, expires and valid, with reason when not valid."""
+        try:
+            code = unpack_code(text.strip("\r\n\t"))  # not " ": it is a base45 digit
+        except ValueError as e:
+            return {"valid": False, "reason": str(e)}
+        out = {"reg_no": code["reg_no"], "serial": code["serial"], "expires": code["expires"].isoformat()}
+        if not self.signature_ok(code):
+            return {**out, "valid": False, "reason": "bad signature"}
+        if code["serial"] in self.revoked:
+            return {**out, "valid": False, "reason": "revoked"}
+        if (today or date.today()) > code["expires"]:
+            return {**out, "valid": False, "reason": "expired"}
+        return {**out, "valid": True}
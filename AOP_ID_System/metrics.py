@@ -0,0 +1,209 @@
+"""
+In-process metrics with Prometheus text exposition, plus an opt-in sampling
+profiler that writes folded stacks (the input format of flamegraph.pl and
+speedscope).
+
+Histograms use fixed buckets and a single lock, so an observation is a
+bisect and a few integer adds. Everything lives in the process that records
+it; code running in a ProcessPoolExecutor worker is not seen here.
+"""
+from __future__ import annotations
+import functools
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+
+class _Span:
+    __slots__ = ("registry", "name", "labels", "t0")
+
+    def __init__(self, registry, name, labels):
+        self.registry, self.name, self.labels = registry, name, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, self.labels, time.perf_counter() - self.t0)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Registry:
+    """Histograms and counters keyed by (metric name, label pairs)."""
+
+    def __init__(self, enabled: bool = True, buckets=DEFAULT_BUCKETS, prefix: str = ""):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self._help: dict[str, tuple[str, str]] = {}
+        self._hist: dict[tuple[str, tuple], list] = {}  # -> [bucket counts..., sum, count]
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._gauges: dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._help[name] = (kind, help_text)
+
+    def gauge(self, name: str, help_text: str, fn):
+        """Gauge read by calling fn() at scrape time."""
+        self._help[name] = ("gauge", help_text)
+        self._gauges[name] = fn
+
+    def observe(self, name: str, labels: tuple, seconds: float):
+        if not self.enabled:
+            return
+        i = bisect_left(self.buckets, seconds)
+        key = (name, labels)
+        with self._lock:
+            h = self._hist.get(key)
+            if h is None:
+                h = self._hist[key] = [0] * (len(self.buckets) + 3)
+            h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def inc(self, name: str, labels: tuple = (), amount: float = 1):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def span(self, name: str, labels: tuple = ()):
+        """with registry.span("stage_duration_seconds", (("stage", "x"),)): ..."""
+        return _Span(self, name, labels) if self.enabled else _NO_SPAN
+
+    def timed(self, name: str, labels: tuple = ()):
+        """Decorator form of span()."""
+        def wrap(fn):
+            @functools.wraps(fn)
+            def inner(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                t0 = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(name, labels, time.perf_counter() - t0)
+            return inner
+        return wrap
+
+    def render(self) -> str:
+        with self._lock:
+            hist = {k: list(v) for k, v in self._hist.items()}
+            counters = dict(self._counters)
+        names = sorted({k[0] for k in hist} | {k[0] for k in counters} | set(self._gauges))
+        out = []
+        for name in names:
+            full = self.prefix + name
+            kind, help_text = self._help.get(name, ("untyped", ""))
+            if help_text:
+                out.append(f"# HELP {full} {help_text}")
+            out.append(f"# TYPE {full} {kind}")
+            if name in self._gauges:
+                out.append(f"{full} {self._gauges[name]()}")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    out.append(f"{full}{_labels(labels)} {value}")
+            for (n, labels), h in sorted(hist.items()):
+                if n != name:
+                    continue
+                running = 0
+                for bound, c in zip(self.buckets, h):
+                    running += c
+                    out.append(f"{full}_bucket{_labels(labels + (('le', repr(bound)),))} {running}")
+                out.append(f"{full}_bucket{_labels(labels + (('le', '+Inf'),))} {h[-1]}")
+                out.append(f"{full}_sum{_labels(labels)} {h[-2]:.6f}")
+                out.append(f"{full}_count{_labels(labels)} {h[-1]}")
+        return "\n".join(out) + "\n"
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all other threads every `interval` seconds and
+    counts them as folded stacks ("file:func;file:func <count>").
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = 0
+        self._stacks: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        code_names: dict[object, str] = {}
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            folded = []
+            for tid, frame in frames.items():
+                if tid == me:
+                    continue
+                parts = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = code_names.get(code)
+                    if label is None:
+                        label = code_names[code] = f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}"
+                    parts.append(label)
+                    frame = frame.f_back
+                folded.append(";".join(reversed(parts)))
+            del frames
+            with self._lock:
+                self._stacks.update(folded)
+                self.samples += 1
+
+    def folded(self, reset: bool = False) -> str:
+        with self._lock:
+            stacks = self._stacks if reset else Counter(self._stacks)
+            if reset:
+                self._stacks = Counter()
+                self.samples = 0
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            f.write(self.folded())
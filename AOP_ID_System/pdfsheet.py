@@ -0,0 +1,147 @@
+"""
+Minimal streaming PDF writer for ID card sheets.
+
+Pillow's multi-page PDF export keeps every page image in memory until the
+file is closed, which does not work for a few thousand cards. This writer
+emits each page (JPEG image XObjects + a content stream) as soon as it is
+added and only keeps object offsets around for the xref table, so memory
+stays flat no matter how many cards go into one file.
+"""
+from __future__ import annotations
+
+PT_PER_INCH = 72.0
+A4_PT = (595.28, 841.89)
+# CR80 card, 3.375" x 2.125"
+CARD_PT = (3.375 * PT_PER_INCH, 2.125 * PT_PER_INCH)
+
+LAYOUTS = ("single", "a4")
+
+
+class PdfSheetWriter:
+    """
+    Write cards into a PDF on any binary file object (seekable or not).
+
+    layout="single" gives one card-sized page per card; layout="a4" places
+    cards 2 x 5 on A4 pages with cut marks around the grid.
+    """
+
+    def __init__(self, fp, layout: str = "single", cut_marks: bool = True):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout: {layout}")
+        self.fp = fp
+        self.layout = layout
+        self.cut_marks = cut_marks
+        self._pos = 0
+        self._offsets: dict[int, int] = {}
+        self._next_obj = 3  # 1 = catalog, 2 = page tree
+        self._kids: list[int] = []
+        self._pending: list[tuple[bytes, int, int]] = []
+        if layout == "a4":
+            self.cols, self.rows = 2, 5
+            self.page_size = A4_PT
+        else:
+            self.cols, self.rows = 1, 1
+            self.page_size = CARD_PT
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    @property
+    def per_page(self) -> int:
+        return self.cols * self.rows
+
+    def add_card(self, jpeg: bytes, width: int, height: int):
+        """Queue one card (baseline JPEG bytes and pixel size); flushes full pages."""
+        self._pending.append((jpeg, width, height))
+        if len(self._pending) == self.per_page:
+            self._flush_page()
+
+    def close(self):
+        if self._pending:
+            self._flush_page()
+        kids = " ".join(f"{k} 0 R" for k in self._kids)
+        self._obj(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._kids)} >>".encode())
+        self._obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref_at = self._pos
+        size = self._next_obj
+        lines = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        for num in range(1, size):
+            lines.append(f"{self._offsets[num]:010d} 00000 n \n")
+        lines.append(f"trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref_at}\n%%EOF\n")
+        self._write("".join(lines).encode())
+
+    # ---- internals ----
+
+    def _write(self, data: bytes):
+        self.fp.write(data)
+        self._pos += len(data)
+
+    def _alloc(self) -> int:
+        num = self._next_obj
+        self._next_obj += 1
+        return num
+
+    def _obj(self, num: int, body: bytes, stream: bytes | None = None):
+        self._offsets[num] = self._pos
+        self._write(f"{num} 0 obj\n".encode() + body)
+        if stream is not None:
+            self._write(b"\nstream\n")
+            self._write(stream)
+            self._write(b"\nendstream")
+        self._write(b"\nendobj\n")
+
+    def _slots(self):
+        pw, ph = self.page_size
+        cw, ch = CARD_PT
+        if self.layout == "single":
+            return [(0.0, 0.0)], (0.0, 0.0)
+        x0 = (pw - cw * self.cols) / 2
+        y0 = (ph - ch * self.rows) / 2
+        slots = []
+        # fill rows from the top of the page down
+        for r in range(self.rows):
+            for c in range(self.cols):
+                slots.append((x0 + c * cw, ph - y0 - (r + 1) * ch))
+        return slots, (x0, y0)
+
+    def _marks(self, x0: float, y0: float) -> str:
+        pw, ph = self.page_size
+        cw, ch = CARD_PT
+        gap, length = 4.0, 18.0
+        ops = ["q 0.25 w 0 G"]
+        for c in range(self.cols + 1):
+            x = x0 + c * cw
+            ops.append(f"{x:.2f} {y0 - gap:.2f} m {x:.2f} {y0 - gap - length:.2f} l S")
+            ops.append(f"{x:.2f} {ph - y0 + gap:.2f} m {x:.2f} {ph - y0 + gap + length:.2f} l S")
+        for r in range(self.rows + 1):
+            y = y0 + r * ch
+            ops.append(f"{x0 - gap:.2f} {y:.2f} m {x0 - gap - length:.2f} {y:.2f} l S")
+            ops.append(f"{pw - x0 + gap:.2f} {y:.2f} m {pw - x0 + gap + length:.2f} {y:.2f} l S")
+        ops.append("Q")
+        return "\n".join(ops)
+
+    def _flush_page(self):
+        slots, (x0, y0) = self._slots()
+        cw, ch = CARD_PT
+        xobjects = []
+        ops = []
+        for i, (jpeg, w, h) in enumerate(self._pending):
+            num = self._alloc()
+            self._obj(num, (
+                f"<< /Type /XObject /Subtype /Image /Width {w} /Height {h} "
+                f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode /Length {len(jpeg)} >>"
+            ).encode(), jpeg)
+            xobjects.append(f"/Im{i} {num} 0 R")
+            x, y = slots[i]
+            ops.append(f"q {cw:.2f} 0 0 {ch:.2f} {x:.2f} {y:.2f} cm /Im{i} Do Q")
+        if self.layout != "single" and self.cut_marks:
+            ops.append(self._marks(x0, y0))
+        content = "\n".join(ops).encode()
+        content_num = self._alloc()
+        self._obj(content_num, f"<< /Length {len(content)} >>".encode(), content)
+        page_num = self._alloc()
+        pw, ph = self.page_size
+        self._obj(page_num, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {pw:.2f} {ph:.2f}] "
+            f"/Resources << /XObject << {' '.join(xobjects)} >> >> /Contents {content_num} 0 R >>"
+        ).encode())
+        self._kids.append(page_num)
+        self._pending = []
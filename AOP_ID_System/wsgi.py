@@ -0,0 +1,19 @@
+"""
+WSGI entry point for multi-worker servers, run from this folder:
+
+    flask --app app migrate
+    gunicorn --preload -w 4 -b 0.0.0.0:8000 wsgi:app
+
+With --preload the master imports this module once and builds the fonts,
+card template, signing keys and verification index before forking, so the
+workers share them copy-on-write. PRELOAD=0 leaves all of it to first use.
+"""
+import os
+
+import app as aop
+
+if os.environ.get("PRELOAD", "1") != "0":
+    app = aop.preload_app()
+else:
+    aop.get_card_signer()  # a signing key this install cannot use fails at startup, not on every card
+    app = aop.app
@@ -0,0 +1,46 @@
+"""
+Streaming ZIP writer.
+
+zipfile writes to a ZipSink, which has no seek() or tell(), so every member
+gets a data descriptor after its data and nothing already written is
+revisited. The caller drains the sink after each member and can hand the
+chunks straight to an HTTP response. Only the central directory, a few
+dozen bytes per member, stays in memory until the end.
+"""
+from __future__ import annotations
+import zipfile
+
+
+class ZipSink:
+    """Write-only file object whose contents are taken with drain()."""
+
+    def __init__(self):
+        self._parts: list[bytes] = []
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        out = b"".join(self._parts)
+        self._parts = []
+        return out
+
+
+def iter_zip(entries):
+    """
+    Yield the bytes of a ZIP archive of entries, an iterable of
+    (name, data, compress_type). Each member is emitted as soon as it
+    has been written; large archives switch to ZIP64 on their own.
+    """
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, "w") as zf:
+        for name, data, compress_type in entries:
+            zf.writestr(name, data, compress_type=compress_type)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    yield sink.drain()